@@ -0,0 +1,57 @@
+"""
+Compares the former per-feature ``analyze_bundle`` pipeline (one process pool task per feature, each fetching its
+feature once per patient group) with the staged one (bulk fetch, in-memory matrix, shared memory tests), against the
+local stand-in feature server with a simulated round trip latency.
+
+    python benchmarks/bench_analyze_bundle.py --features 1000 --patients 1000 --latency 0.005
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+import common.fetcher_client  # noqa: E402
+from common.analytics import analyze_bundle, significance_test, get_patients_split  # noqa: E402
+from common.fetcher_client import get_feature_names  # noqa: E402
+from tests.feature_server import FeatureServer, FeatureData  # noqa: E402
+
+
+def _per_feature_analyze_bundle(mutation: str, mutation_status: bool, col: str, max_workers: int):
+    features = get_feature_names(col)
+    early, late = get_patients_split(mutation=mutation, mutation_status=mutation_status)
+    n_features = len(features)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(significance_test, [early] * n_features, [late] * n_features, features,
+                                 [col] * n_features, [mutation] * n_features, [mutation_status] * n_features))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=int, default=1000)
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.005, help='latency added to every request, in seconds')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with FeatureServer(FeatureData(n_patients=args.patients, n_features=args.features), delay=args.latency) as server:
+        common.fetcher_client.ADDR = server.addr
+        results = {}
+        for name, analyze in (('per-feature', _per_feature_analyze_bundle), ('staged', analyze_bundle)):
+            requests = server.stats['requests']
+            start = time.perf_counter()
+            results[name] = analyze('BRCA1', True, 'GeneExpression', max_workers=args.workers)
+            print(f'{name}: {time.perf_counter() - start:.2f} s ({server.stats["requests"] - requests} requests)')
+
+        difference = np.abs(np.subtract([item['pvalue'] for item in results['per-feature']],
+                                        [item['pvalue'] for item in results['staged']]))
+        print(f'max p-value difference {difference.max():.1e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares the server-side pivot of ``fetch_collection_as_table`` with the client-side streaming pivot of
+``fetch_collection_as_matrix`` on a collection of (sample, patient, name, value) documents, seeded in mongomock or
+in a real server given with ``--uri``. Mongomock lacks ``$mergeObjects``, in which case the last stages of the
+pipeline are replaced by merging the pivoted documents on the client. Mongomock runs in the benchmark process, so
+its own time and memory are included in all measures.
+
+    python benchmarks/bench_database.py --samples 300 --features 300 --subset 50
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+from common.database import init_cached_database, fetch_collection_as_matrix, _table_pipeline  # noqa: E402
+
+
+def _server_pivot(collection, supports_merge: bool) -> pd.DataFrame:
+    if supports_merge:
+        rows = list(collection.aggregate(_table_pipeline(), allowDiskUse=True))
+    else:
+        rows = [dict(patient=row['patient'], sample=row['sample'], **row['data'])
+                for row in collection.aggregate(_table_pipeline()[:-2], allowDiskUse=True)]
+    return pd.DataFrame.from_records(rows)
+
+
+def _measure(name: str, function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{name}: {elapsed:.2f} s, peak client memory {peak / 2 ** 20:.1f} MiB, {result.shape}')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', default='mongomock://localhost')
+    parser.add_argument('--samples', type=int, default=300)
+    parser.add_argument('--features', type=int, default=300)
+    parser.add_argument('--subset', type=int, default=50, help='number of features of the filtered fetch')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    db = init_cached_database(args.uri, db_name='benchmarks', alias='benchmarks')
+    collection = db['bench_features']
+    collection.drop()
+    collection.insert_many([dict(sample=f'sample-{i}', patient=f'patient-{i}', name=f'feature-{j}', value=i * j / 7)
+                            for i in range(args.samples) for j in range(args.features)])
+
+    supports_merge = not args.uri.startswith('mongomock')
+    _measure('server pivot (fetch_collection_as_table)', lambda: _server_pivot(collection, supports_merge))
+    _measure('client pivot (fetch_collection_as_matrix)',
+             lambda: fetch_collection_as_matrix(collection.name, batch_size=args.batch_size, db=db).matrix)
+    _measure('client pivot to pandas', lambda: fetch_collection_as_matrix(collection.name, batch_size=args.batch_size,
+                                                                          as_frame=True, db=db))
+    subset = [f'feature-{j}' for j in range(args.subset)]
+    _measure(f'client pivot of {args.subset} features',
+             lambda: fetch_collection_as_matrix(collection.name, feature_names=subset, batch_size=args.batch_size,
+                                                db=db).matrix)
+    collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Compares fetching a bundle one feature at a time with the batched multi-feature request for several chunk sizes,
+against the local stand-in feature server with a simulated round trip latency.
+
+    python benchmarks/bench_fetcher_batch.py --features 500 --patients 1000 --latency 0.005
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+import common.fetcher_client  # noqa: E402
+from common.fetcher_client import get_features_for_patients, get_features_for_patients_batch  # noqa: E402
+from tests.feature_server import FeatureServer, FeatureData  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=int, default=200)
+    parser.add_argument('--patients', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005, help='latency added to every request, in seconds')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[10, 50, 200])
+    args = parser.parse_args()
+
+    with FeatureServer(FeatureData(n_patients=args.patients, n_features=args.features), delay=args.latency) as server:
+        common.fetcher_client.ADDR = server.addr
+        names = server.data.features['GeneExpression']
+        patients = server.data.patients
+
+        start = time.perf_counter()
+        for name in names:
+            [item['value'] for item in get_features_for_patients('GeneExpression', name, patients)]
+        single = time.perf_counter() - start
+        print(f'one request per feature: {single:.2f} s ({len(names)} requests)')
+
+        for chunk_size in args.chunk_sizes:
+            requests = server.stats['requests']
+            start = time.perf_counter()
+            get_features_for_patients_batch('GeneExpression', names, patients, chunk_size=chunk_size)
+            batched = time.perf_counter() - start
+            print(f'chunk size {chunk_size}: {batched:.2f} s ({server.stats["requests"] - requests} requests), '
+                  f'speedup x{single / batched:.1f}')
+
+
+if __name__ == '__main__':
+    main()
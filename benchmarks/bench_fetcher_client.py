@@ -0,0 +1,60 @@
+"""
+Compares opening a new http client per request with the pooled keep-alive client of :mod:`common.fetcher_client`,
+against the local stand-in feature server.
+
+    python benchmarks/bench_fetcher_client.py --requests 500
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+import common.fetcher_client  # noqa: E402
+from common.fetcher_client import get_features_for_patients  # noqa: E402
+from tests.feature_server import FeatureServer  # noqa: E402
+
+
+def _perform_request_per_call(method: str, **params):
+    # the client creation of the previous implementation
+    with httpx.Client(timeout=None) as client:
+        r = getattr(client, method)(**params)
+        r.raise_for_status()
+    return r.json()
+
+
+def _run(n_requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(n_requests):
+        get_features_for_patients(col='GeneExpression', feature_name=f'GeneExpression-{i % 50}',
+                                  patients=['TCGA-0001', 'TCGA-0002'])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+
+    with FeatureServer() as server:
+        common.fetcher_client.ADDR = server.addr
+
+        pooled_perform_request = common.fetcher_client._perform_request
+        common.fetcher_client._perform_request = _perform_request_per_call
+        per_call = _run(args.requests)
+        per_call_connections = server.stats['connections']
+
+        common.fetcher_client._perform_request = pooled_perform_request
+        pooled = _run(args.requests)
+        pooled_connections = server.stats['connections'] - per_call_connections
+
+    print(f'{args.requests} requests: client per call {per_call * 1e3 / args.requests:.2f} ms/request '
+          f'({per_call_connections} connections), pooled {pooled * 1e3 / args.requests:.2f} ms/request '
+          f'({pooled_connections} connections), speedup x{per_call / pooled:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Compares the pure python .les decoder with the vectorized one using the files in ``resources/``.
+
+    python benchmarks/bench_les_files.py --repeats 50 --tile 20
+"""
+import argparse
+import os
+import sys
+import timeit
+from glob import glob
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+from common.les_files import read_all_maps_from_les_file, decode_all_maps_from_les_file  # noqa: E402
+
+RESOURCES = os.path.join(os.path.dirname(__file__), '../resources')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--tile', type=int, default=10, help='number of times each file is concatenated with itself')
+    args = parser.parse_args()
+
+    for path in sorted(glob(os.path.join(RESOURCES, '*.les'))):
+        with open(path, 'rb') as f:
+            raw = f.read() * args.tile
+
+        baseline = timeit.timeit(lambda: read_all_maps_from_les_file(raw), number=args.repeats) / args.repeats
+        vectorized = timeit.timeit(lambda: decode_all_maps_from_les_file(raw), number=args.repeats) / args.repeats
+
+        old_bytes = sum(item['data'].nbytes for item in read_all_maps_from_les_file(raw))
+        new_bytes = sum(item['data'].nbytes for item in decode_all_maps_from_les_file(raw))
+
+        print(f'{os.path.basename(path)} ({len(raw)} bytes, {args.tile} maps): '
+              f'python {baseline * 1e3:.3f} ms, vectorized {vectorized * 1e3:.3f} ms, '
+              f'speedup x{baseline / vectorized:.1f}, output {old_bytes} -> {new_bytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares per-feature permutation tests with :func:`scipy.stats.permutation_test` (the p-values of a subset of the
+features, extrapolated to all of them) with :func:`common.analytics.permutation_test_matrix`.
+
+    python benchmarks/bench_permutations.py --features 2000 --patients 300 --permutations 1000
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.stats import permutation_test, ks_2samp, mannwhitneyu
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+from common.analytics import permutation_test_matrix, PERMUTATION_STATISTICS  # noqa: E402
+
+SCIPY_STATISTICS = dict(
+    ks=lambda x, y: ks_2samp(x, y).statistic,
+    mannwhitney=lambda x, y: abs(mannwhitneyu(x, y).statistic - len(x) * len(y) / 2),
+    mean_difference=lambda x, y, axis: np.abs(np.mean(x, axis=axis) - np.mean(y, axis=axis)),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=int, default=2000)
+    parser.add_argument('--patients', type=int, default=300)
+    parser.add_argument('--permutations', type=int, default=1000)
+    parser.add_argument('--sampled-features', type=int, default=10, help='features tested with scipy')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(args.patients, args.features))
+    early = rng.random(args.patients) < 0.3
+
+    for statistic in PERMUTATION_STATISTICS:
+        vectorized = statistic == 'mean_difference'
+        start = time.perf_counter()
+        for j in range(args.sampled_features):
+            permutation_test((matrix[early, j], matrix[~early, j]), SCIPY_STATISTICS[statistic],
+                             vectorized=vectorized, n_resamples=args.permutations, alternative='greater',
+                             random_state=0)
+        loop = (time.perf_counter() - start) * args.features / args.sampled_features
+
+        start = time.perf_counter()
+        permutation_test_matrix(matrix, early, ~early, statistic=statistic, n_permutations=args.permutations,
+                                max_workers=args.workers)
+        engine = time.perf_counter() - start
+        print(f'{statistic}: per-feature permutation_test ~{loop:.1f} s (extrapolated), '
+              f'permutation_test_matrix {engine:.2f} s, speedup x{loop / engine:.0f}')
+
+
+if __name__ == '__main__':
+    main()
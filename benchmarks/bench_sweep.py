@@ -0,0 +1,55 @@
+"""
+Compares calling ``analyze_bundle`` in a loop over a grid of mutations, statuses, age cutoffs and bundles with
+``sweep_bundles``, against the local stand-in feature server with a simulated round trip latency.
+
+    python benchmarks/bench_sweep.py --mutations 4 --cutoffs 40 45 50 --features 500 --latency 0.005
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+import common.fetcher_client  # noqa: E402
+from common.analytics import analyze_bundle, sweep_bundles  # noqa: E402
+from tests.feature_server import FeatureServer, FeatureData  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mutations', type=int, default=4)
+    parser.add_argument('--cutoffs', type=int, nargs='+', default=[40, 45, 50])
+    parser.add_argument('--cols', type=int, default=2)
+    parser.add_argument('--features', type=int, default=500)
+    parser.add_argument('--patients', type=int, default=600)
+    parser.add_argument('--latency', type=float, default=0.005, help='latency added to every request, in seconds')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    mutations = [f'GENE{i}' for i in range(args.mutations)]
+    cols = [f'Bundle{i}' for i in range(args.cols)]
+    data = FeatureData(n_patients=args.patients, n_features=args.features, cols=cols)
+    with FeatureServer(data, delay=args.latency) as server:
+        common.fetcher_client.ADDR = server.addr
+
+        requests = server.stats['requests']
+        start = time.perf_counter()
+        n_rows = sum(len(analyze_bundle(mutation, mutation_status, col, age_cutoff=age_cutoff,
+                                         max_workers=args.workers))
+                     for col in cols for mutation in mutations for mutation_status in (True, False)
+                     for age_cutoff in args.cutoffs)
+        loop = time.perf_counter() - start
+        print(f'analyze_bundle loop: {loop:.2f} s, {n_rows} rows ({server.stats["requests"] - requests} requests)')
+
+        requests = server.stats['requests']
+        start = time.perf_counter()
+        n_rows = sum(1 for _ in sweep_bundles(mutations, cols, age_cutoffs=args.cutoffs, max_workers=args.workers))
+        sweep = time.perf_counter() - start
+        print(f'sweep_bundles: {sweep:.2f} s, {n_rows} rows ({server.stats["requests"] - requests} requests), '
+              f'speedup x{loop / sweep:.1f}')
+
+
+if __name__ == '__main__':
+    main()
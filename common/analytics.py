@@ -1,11 +1,22 @@
+import hashlib
+import itertools
+import json
 import os
-from concurrent.futures import ProcessPoolExecutor
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+from multiprocessing.shared_memory import SharedMemory
 
-from common.fetcher_client import get_patients_by_mutation
+import httpx
+from loguru import logger
+
+from common.fetcher_client import get_patients_by_mutation, get_features_for_patients_batch
 from common.fetcher_client import get_patients_age, get_features_for_patients, get_feature_names
 import typing as tp
 
-from scipy.stats import ks_2samp
+import numpy as np
+from scipy.stats import ks_2samp, kstwo, rankdata
 
 
 def get_patients_split(mutation, mutation_status, age_cutoff=45):
@@ -27,26 +38,719 @@ def significance_test(patients_1: tp.List[str], patients_2: tp.List[str], featur
                 pvalue=float(ks_2samp(data1=data_1, data2=data_2).pvalue))
 
 
-def analyze_bundle(mutation: str, mutation_status: bool, col: str, age_cutoff: int = 45) -> tp.List[dict]:
+def get_bundle_matrix(col: str, patients: tp.List[str], feature_names: tp.Optional[tp.Sequence[str]] = None,
+                      chunk_size: int = 100) -> tp.Tuple[tp.List[str], np.ndarray]:
+    """
+    Fetches all features of a "bundle" for the given patients in bulk, with
+    :func:`common.fetcher_client.get_features_for_patients_batch`, as a (patients x features) matrix holding NaN for
+    missing values. Servers lacking the batch endpoint are queried with one
+    :func:`common.fetcher_client.get_features_for_patients` request per feature instead
+
+    :param col: "bundle" to fetch
+    :type col: str
+    :param patients: patients (rows of the matrix)
+    :type patients: tp.List[str]
+    :param feature_names: features (columns of the matrix), defaults to None (all features of the bundle)
+    :type feature_names: tp.Optional[tp.Sequence[str]], optional
+    :param chunk_size: maximal number of features per request, defaults to 100
+    :type chunk_size: int, optional
+    :return: feature names and matrix
+    :rtype: tp.Tuple[tp.List[str], np.ndarray]
+    """
+    feature_names = get_feature_names(col) if feature_names is None else list(feature_names)
+    try:
+        table = get_features_for_patients_batch(col=col, feature_names=feature_names, patients=patients,
+                                                chunk_size=chunk_size)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+        logger.warning(f'batch endpoint not found, fetching the {len(feature_names)} features of {col} one by one')
+        return feature_names, _get_bundle_matrix_per_feature(col, patients, feature_names)
+    return feature_names, table.to_matrix(feature_names)
+
+
+def _get_bundle_matrix_per_feature(col: str, patients: tp.List[str], feature_names: tp.List[str]) -> np.ndarray:
+    rows = {patient: i for i, patient in enumerate(patients)}
+    matrix = np.full((len(patients), len(feature_names)), np.nan)
+    for j, feature in enumerate(feature_names):
+        for item in get_features_for_patients(col=col, feature_name=feature, patients=patients):
+            matrix[rows[item['patient']], j] = item['value']
+    return matrix
+
+
+def _call_shared(name: str, shape: tp.Tuple[int, int], function: tp.Callable, *args):
+    shm = SharedMemory(name=name)
+    try:
+        return function(np.ndarray(shape, dtype=np.float64, buffer=shm.buf), *args)
+    finally:
+        shm.close()
+
+
+def _ks_2samp_columns(matrix: np.ndarray, columns: slice, mask_1: np.ndarray,
+                      mask_2: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+    return ks_2samp_matrix(matrix[:, columns], mask_1, mask_2)
+
+
+class _SharedMatrix:
+    """
+    Copy of a (patients x features) matrix in shared memory, on which worker processes run functions without
+    receiving the matrix itself
+    """
+
+    def __init__(self, matrix: np.ndarray):
+        self.shape = matrix.shape
+        self._shm = SharedMemory(create=True, size=max(matrix.size, 1) * np.dtype(np.float64).itemsize)
+        np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)[:] = matrix
+
+    def submit(self, executor: ProcessPoolExecutor, function: tp.Callable, *args) -> Future:
+        """
+        Submits ``function(matrix, *args)``, the function must be picklable and must not return views of the matrix
+        """
+        return executor.submit(_call_shared, self._shm.name, self.shape, function, *args)
+
+    def submit_ks_2samp(self, executor: ProcessPoolExecutor, mask_1: np.ndarray, mask_2: np.ndarray, n_chunks: int,
+                        columns: tp.Optional[np.ndarray] = None) -> tp.List[Future]:
+        """
+        Submits :func:`ks_2samp_matrix` over ``n_chunks`` ranges of the columns, or of the given column indices
+        """
+        if columns is not None:
+            return [self.submit(executor, _ks_2samp_columns, chunk, mask_1, mask_2)
+                    for chunk in np.array_split(columns, max(min(n_chunks, len(columns)), 1))]
+        bounds = np.linspace(0, self.shape[1], max(min(n_chunks, self.shape[1]), 1) + 1).astype(int)
+        return [self.submit(executor, _ks_2samp_columns, slice(start, stop), mask_1, mask_2)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    @staticmethod
+    def gather(futures: tp.List[Future]) -> tp.Tuple[np.ndarray, np.ndarray]:
+        return tuple(np.concatenate(arrays) for arrays in zip(*(future.result() for future in futures)))
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self) -> '_SharedMatrix':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def parallel_ks_2samp_matrix(matrix: np.ndarray, mask_1: np.ndarray, mask_2: np.ndarray,
+                             max_workers: tp.Optional[int] = None) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    :func:`ks_2samp_matrix` with the columns split between worker processes. The matrix is copied once to shared
+    memory, from which the workers read it, so only the column ranges and the group masks are sent to them
+
+    :param matrix: (patients x features) matrix of feature values
+    :type matrix: np.ndarray
+    :param mask_1: boolean mask (or indices) of the patients of the first group
+    :type mask_1: np.ndarray
+    :param mask_2: boolean mask (or indices) of the patients of the second group
+    :type mask_2: np.ndarray
+    :param max_workers: number of worker processes, defaults to None (number of cpus)
+    :type max_workers: tp.Optional[int], optional
+    :return: statistics and p-values of every feature
+    :rtype: tp.Tuple[np.ndarray, np.ndarray]
+    """
+    max_workers = min(max_workers or os.cpu_count(), matrix.shape[1])
+    if max_workers <= 1:
+        return ks_2samp_matrix(matrix, mask_1, mask_2)
+
+    with _SharedMatrix(matrix) as shared, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return shared.gather(shared.submit_ks_2samp(executor, mask_1, mask_2, n_chunks=max_workers))
+
+
+class ResultStore:
+    """
+    SQLite store of the p-values computed by :func:`analyze_bundle` and :func:`sweep_bundles`, persisting across
+    processes and runs. Results are keyed by (mutation, mutation status, bundle, feature, age cutoff, fingerprint),
+    the fingerprint being a hash of the values of the feature in both groups, so re-runs only test the features whose
+    values or groups changed (the feature values are still fetched, see :func:`common.fetcher_client.enable_cache`).
+
+    >>> store = ResultStore('results.sqlite')
+    >>> results = analyze_bundle('BRCA1', True, 'GeneExpression', store=store)  # doctest: +SKIP
+    >>> store.top_hits(n=5, col='GeneExpression')  # doctest: +SKIP
+
+    :param path: pathway to the SQLite database
+    :type path: str
+    """
+
+    _KEY = ('mutation', 'mutation_status', 'col', 'feature_name', 'age_cutoff', 'fingerprint')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30., check_same_thread=False)
+            self._db_pid = os.getpid()
+            self._db.execute('CREATE TABLE IF NOT EXISTS results (mutation TEXT, mutation_status INTEGER, col TEXT, '
+                             'feature_name TEXT, age_cutoff NUMERIC, fingerprint TEXT, pvalue REAL, used REAL, '
+                             'PRIMARY KEY (mutation, mutation_status, col, age_cutoff, feature_name, fingerprint))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_pvalue ON results (pvalue)')
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def fingerprints(matrix: np.ndarray, mask_1: np.ndarray, mask_2: np.ndarray) -> tp.List[str]:
+        """
+        Fingerprint of the values of every feature (column) in both groups
+
+        :return: hexadecimal digest of every feature
+        :rtype: tp.List[str]
+        """
+        # column-major copies, so the values of a feature in a group are contiguous
+        group_1 = np.asfortranarray(matrix[mask_1], dtype=np.float64)
+        group_2 = np.asfortranarray(matrix[mask_2], dtype=np.float64)
+        fingerprints = []
+        for j in range(matrix.shape[1]):
+            digest = hashlib.blake2b(group_1[:, j].tobytes(), digest_size=16)
+            digest.update(b'|')
+            digest.update(group_2[:, j].tobytes())
+            fingerprints.append(digest.hexdigest())
+        return fingerprints
+
+    def get(self, mutation: str, mutation_status: bool, col: str, age_cutoff: float,
+            feature_names: tp.Sequence[str], fingerprints: tp.Sequence[str]) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """
+        Stored p-values of features of a job
+
+        :return: boolean mask of the features found in the store, and p-values (NaN for the missing features)
+        :rtype: tp.Tuple[np.ndarray, np.ndarray]
+        """
+        with self._lock:
+            db = self._connection()
+            stored = {(feature_name, fingerprint): pvalue for feature_name, fingerprint, pvalue in db.execute(
+                'SELECT feature_name, fingerprint, pvalue FROM results WHERE mutation = ? AND mutation_status = ? '
+                'AND col = ? AND age_cutoff = ?', (mutation, mutation_status, col, age_cutoff))}
+            keys = list(zip(feature_names, fingerprints))
+            found = np.array([key in stored for key in keys], dtype=bool)
+            # NaN p-values are stored as NULL
+            pvalues = np.array([stored.get(key) for key in keys], dtype=np.float64)
+            db.executemany('UPDATE results SET used = ? WHERE mutation = ? AND mutation_status = ? AND col = ? AND '
+                           'age_cutoff = ? AND feature_name = ? AND fingerprint = ?',
+                           [(time.time(), mutation, mutation_status, col, age_cutoff) + key
+                            for key, is_found in zip(keys, found) if is_found])
+            db.commit()
+            self.hits += int(found.sum())
+            self.misses += int(len(found) - found.sum())
+            return found, pvalues
+
+    def put(self, mutation: str, mutation_status: bool, col: str, age_cutoff: float,
+            feature_names: tp.Sequence[str], fingerprints: tp.Sequence[str], pvalues: tp.Sequence[float]):
+        """
+        Stores p-values of features of a job
+        """
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(mutation, mutation_status, col, feature_name, age_cutoff, fingerprint,
+                             None if np.isnan(pvalue) else float(pvalue), now)
+                            for feature_name, fingerprint, pvalue in zip(feature_names, fingerprints, pvalues)])
+            db.commit()
+
+    def top_hits(self, n: int = 10, max_pvalue: tp.Optional[float] = None, latest: bool = True,
+                 **filters) -> tp.List[dict]:
+        """
+        Results with the lowest p-values across all stored runs
+
+        :param n: maximal number of results, defaults to 10
+        :type n: int, optional
+        :param max_pvalue: if provided, only results with a p-value below or equal to it are returned, defaults to
+            None
+        :type max_pvalue: tp.Optional[float], optional
+        :param latest: if True, only the most recently computed or reused result of every (mutation, mutation status,
+            bundle, feature, age cutoff) is considered, otherwise results of outdated data are included as well,
+            defaults to True
+        :type latest: bool, optional
+        :param filters: equality filters on ``mutation``, ``mutation_status``, ``col`` and ``age_cutoff``
+        :return: rows of :func:`sweep_bundles` along with their ``fingerprint``, by increasing p-value
+        :rtype: tp.List[dict]
+        """
+        assert set(filters) <= {'mutation', 'mutation_status', 'col', 'age_cutoff'}, \
+            'filters must be among mutation, mutation_status, col and age_cutoff'
+        params = list(filters.values())
+        columns = ', '.join(self._KEY + ('pvalue',))
+        query = 'SELECT * FROM results WHERE ' + ' AND '.join([f'{name} = ?' for name in filters] + ['1'])
+        if latest:
+            # results are ranked before discarding missing p-values, so an outdated p-value never stands for a newer
+            # missing one
+            query = (f'SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY mutation, mutation_status, col, '
+                     f'age_cutoff, feature_name ORDER BY used DESC) AS recency FROM ({query})) WHERE recency = 1')
+        query = f'SELECT {columns} FROM ({query}) WHERE pvalue IS NOT NULL'
+        if max_pvalue is not None:
+            query += ' AND pvalue <= ?'
+            params.append(max_pvalue)
+        with self._lock:
+            rows = self._connection().execute(f'{query} ORDER BY pvalue LIMIT ?', params + [n]).fetchall()
+        return [dict(zip(self._KEY + ('pvalue',), row), mutation_status=bool(row[1])) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._db_pid == os.getpid():
+                self._db.close()
+            self._db, self._db_pid = None, None
+
+
+def _stored_results(store: tp.Optional[ResultStore], matrix: np.ndarray, mask_1: np.ndarray, mask_2: np.ndarray,
+                    job: tuple, feature_names: tp.List[str]) -> tp.Tuple[np.ndarray, np.ndarray, tp.List[str]]:
+    """
+    p-values of a (mutation, mutation status, col, age cutoff) job found in the store, along with the indices of the
+    features to test and the fingerprints of all features
+    """
+    if store is None:
+        return np.full(len(feature_names), np.nan), np.arange(len(feature_names)), []
+    fingerprints = store.fingerprints(matrix, mask_1, mask_2)
+    found, pvalues = store.get(*job, feature_names, fingerprints)
+    return pvalues, np.flatnonzero(~found), fingerprints
+
+
+def _result_rows(feature_names: tp.List[str], pvalues: np.ndarray, correction: tp.Optional[str],
+                 **fields) -> tp.List[dict]:
+    rows = [dict(fields, feature_name=feature, pvalue=float(pvalue)) for feature, pvalue in zip(feature_names, pvalues)]
+    if correction is not None:
+        for row, adjusted_pvalue in zip(rows, adjust_pvalues(pvalues, method=correction)):
+            row['adjusted_pvalue'] = float(adjusted_pvalue)
+    return rows
+
+
+def analyze_bundle(mutation: str, mutation_status: bool, col: str, age_cutoff: int = 45,
+                   max_workers: tp.Optional[int] = None, chunk_size: int = 100,
+                   correction: tp.Optional[str] = None, store: tp.Optional[ResultStore] = None) -> tp.List[dict]:
     """
     Computes p values for the null hypothesis where the distribution of the early onset patients and the late onset
     patients is the same for some given feature. This computation is performed for all features in a specific
-    "bundle", called col here
+    "bundle", called col here.
+
+    All feature values of the early and late onset patients are fetched at once, in
+    ``ceil(n_features / chunk_size)`` requests, and the tests of all features are then computed in parallel
+    with :func:`parallel_ks_2samp_matrix`
 
     :param mutation: mutated gene. will split the population according to the requested gene (along with age cutoff)
     :param mutation_status: if True, will use mutated patients
     :param col: "bundle" to analyze
+    :param age_cutoff: age splitting the early and late onset patients, defaults to 45
+    :param max_workers: number of processes computing the tests, defaults to None (number of cpus)
+    :param chunk_size: maximal number of features per request, defaults to 100
+    :param correction: if provided, multiple testing correction of :func:`adjust_pvalues` ('bh' or 'bonferroni')
+        across the features of the bundle, added as ``adjusted_pvalue``, defaults to None
+    :param store: if provided, only the features whose values changed since they were stored are tested, defaults to
+        None
     :return: list of dictionaries containing pvalues and feature name
     """
-    feature = get_feature_names(col)
-
     early, late = get_patients_split(mutation=mutation, mutation_status=mutation_status, age_cutoff=age_cutoff)
+    feature_names, matrix = get_bundle_matrix(col, early + late, chunk_size=chunk_size)
+
+    is_early = np.arange(len(early) + len(late)) < len(early)
+    job = (mutation, mutation_status, col, age_cutoff)
+    pvalues, missing, fingerprints = _stored_results(store, matrix, is_early, ~is_early, job, feature_names)
+    if len(missing) == len(feature_names):
+        _, pvalues = parallel_ks_2samp_matrix(matrix, is_early, ~is_early, max_workers=max_workers)
+    elif len(missing):
+        pvalues[missing] = parallel_ks_2samp_matrix(matrix[:, missing], is_early, ~is_early, max_workers=max_workers)[1]
+    if store is not None and len(missing):
+        store.put(*job, [feature_names[j] for j in missing], [fingerprints[j] for j in missing], pvalues[missing])
+
+    return _result_rows(feature_names, pvalues, correction, mutation=mutation, mutation_status=mutation_status)
+
+
+def _read_checkpoint(path: str) -> tp.Dict[tuple, tp.List[dict]]:
+    """
+    Rows of the jobs completed in a :func:`sweep_bundles` checkpoint, a json lines file where the rows of every job
+    are followed by a ``completed`` marker. The file is rewritten without the rows of an interrupted job
+    """
+    completed, rows = {}, []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line truncated by the interruption
+                    break
+                if 'completed' in item:
+                    completed[tuple(item['completed'])] = rows
+                    rows = []
+                else:
+                    rows.append(item)
+
+    with open(f'{path}.tmp', 'w') as f:
+        for job, job_rows in completed.items():
+            f.writelines(json.dumps(row) + '\n' for row in job_rows)
+            f.write(json.dumps(dict(completed=list(job))) + '\n')
+    os.replace(f'{path}.tmp', path)
+    return completed
+
+
+def sweep_bundles(mutations: tp.Sequence[str], cols: tp.Sequence[str],
+                  mutation_statuses: tp.Sequence[bool] = (True, False), age_cutoffs: tp.Sequence[int] = (45,),
+                  max_workers: tp.Optional[int] = None, chunk_size: int = 100,
+                  checkpoint_path: tp.Optional[str] = None, correction: tp.Optional[str] = None,
+                  store: tp.Optional[ResultStore] = None) -> tp.Iterator[dict]:
+    """
+    Runs :func:`analyze_bundle` over the grid of mutations, mutation statuses, age cutoffs and bundles, streaming the
+    result rows job by job, in the order of the grid (bundles first).
+
+    Every patient list and the ages of all patients are fetched once, every bundle is fetched once for all the
+    patients of the sweep and all its jobs share a single copy of its matrix in shared memory. A single process pool
+    is used for the whole sweep.
+
+    >>> rows = sweep_bundles(['BRCA1', 'TP53'], ['GeneExpression'], age_cutoffs=[40, 45, 50],
+    ...                      checkpoint_path='sweep.jsonl')  # doctest: +SKIP
+
+    :param mutations: mutated genes
+    :type mutations: tp.Sequence[str]
+    :param cols: "bundles" to analyze
+    :type cols: tp.Sequence[str]
+    :param mutation_statuses: mutation statuses, defaults to (True, False)
+    :type mutation_statuses: tp.Sequence[bool], optional
+    :param age_cutoffs: ages splitting the early and late onset patients, defaults to (45,)
+    :type age_cutoffs: tp.Sequence[int], optional
+    :param max_workers: number of processes computing the tests, defaults to None (number of cpus)
+    :type max_workers: tp.Optional[int], optional
+    :param chunk_size: maximal number of features per request, defaults to 100
+    :type chunk_size: int, optional
+    :param checkpoint_path: json lines file to which the rows of every completed job are appended. When it already
+        exists, the rows of its completed jobs are yielded again without being recomputed, defaults to None
+    :type checkpoint_path: tp.Optional[str], optional
+    :param correction: multiple testing correction of every job, see :func:`analyze_bundle`, defaults to None
+    :type correction: tp.Optional[str], optional
+    :param store: if provided, only the features whose values changed since they were stored are tested, defaults to
+        None
+    :type store: tp.Optional[ResultStore], optional
+    :return: rows of :func:`analyze_bundle` along with their ``col`` and ``age_cutoff``
+    :rtype: tp.Iterator[dict]
+    """
+    jobs = [(mutation, mutation_status, col, age_cutoff) for col in cols for mutation in mutations
+            for mutation_status in mutation_statuses for age_cutoff in age_cutoffs]
+    completed = _read_checkpoint(checkpoint_path) if checkpoint_path is not None else {}
+    for job in jobs:
+        yield from completed.get(job, [])
+    pending = [job for job in jobs if job not in completed]
+    if not pending:
+        return
+
+    patients = {key: get_patients_by_mutation(*key) for key in dict.fromkeys(job[:2] for job in pending)}
+    all_patients = list(dict.fromkeys(patient for group in patients.values() for patient in group))
+    ages = {item['patient']: item['age'] for item in get_patients_age(patients=all_patients)}
+    rows = {patient: i for i, patient in enumerate(all_patients)}
+    max_workers = max_workers or os.cpu_count()
+
+    checkpoint = open(checkpoint_path, 'a') if checkpoint_path is not None else None
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        for col in dict.fromkeys(job[2] for job in pending):
+            col_jobs = [job for job in pending if job[2] == col]
+            feature_names, matrix = get_bundle_matrix(col, all_patients, chunk_size=chunk_size)
+            with _SharedMatrix(matrix) as shared:
+                # all the jobs of the bundle are submitted at once, so the workers stay busy while rows are streamed
+                futures, stored = [], []
+                try:
+                    for job in col_jobs:
+                        mutation, mutation_status, _, age_cutoff = job
+                        group = [patient for patient in patients[(mutation, mutation_status)] if patient in ages]
+                        early = np.array([rows[patient] for patient in group if ages[patient] < age_cutoff], dtype=int)
+                        late = np.array([rows[patient] for patient in group if ages[patient] >= age_cutoff], dtype=int)
+                        pvalues, missing, fingerprints = _stored_results(store, matrix, early, late, job, feature_names)
+                        stored.append((pvalues, missing, fingerprints))
+                        futures.append([] if not len(missing) else shared.submit_ks_2samp(
+                            executor, early, late, n_chunks=max_workers,
+                            columns=None if len(missing) == len(feature_names) else missing))
+                    for job, (pvalues, missing, fingerprints), job_futures in zip(col_jobs, stored, futures):
+                        mutation, mutation_status, _, age_cutoff = job
+                        if len(missing):
+                            pvalues[missing] = shared.gather(job_futures)[1]
+                        if store is not None and len(missing):
+                            store.put(*job, [feature_names[j] for j in missing], [fingerprints[j] for j in missing],
+                                      pvalues[missing])
+                        job_rows = _result_rows(feature_names, pvalues, correction, mutation=mutation,
+                                                mutation_status=mutation_status, col=col, age_cutoff=age_cutoff)
+                        if checkpoint is not None:
+                            checkpoint.writelines(json.dumps(row) + '\n' for row in job_rows)
+                            checkpoint.write(json.dumps(dict(completed=[mutation, mutation_status, col, age_cutoff]))
+                                             + '\n')
+                            checkpoint.flush()
+                        yield from job_rows
+                finally:
+                    # the shared memory must outlive the running tests when the sweep is interrupted
+                    for future in itertools.chain.from_iterable(futures):
+                        future.cancel()
+                    wait(list(itertools.chain.from_iterable(futures)))
+    finally:
+        executor.shutdown()
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def _sort_columns(values: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Sorting order of every column, NaN values last, along with the sorted positions at which the empirical cdfs are
+    evaluated: the last of every run of equal values
+    """
+    order = np.argsort(values, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    evaluated = ~np.isnan(sorted_values)
+    evaluated[:-1] &= sorted_values[:-1] != sorted_values[1:]
+    return order, evaluated
+
+
+def _ks_statistics(sorted_is_1: np.ndarray, sorted_is_2: np.ndarray, evaluated: np.ndarray, n1: np.ndarray,
+                   n2: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cddiffs = np.cumsum(sorted_is_1, axis=0) / n1 - np.cumsum(sorted_is_2, axis=0) / n2
+    # the statistic is max(max(cddiffs), -min(cddiffs), 0) over the evaluated positions, the others are set to 0
+    return np.max(np.abs(cddiffs * evaluated), axis=0, initial=0)
+
+
+def _ks_2samp_exact_pvalue(data_1: np.ndarray, data_2: np.ndarray) -> float:
+    # ks_2samp falls back to the asymptotic distribution on its own when the exact computation fails
+    return ks_2samp(data_1[~np.isnan(data_1)], data_2[~np.isnan(data_2)]).pvalue
+
+
+def ks_2samp_matrix(matrix: np.ndarray, mask_1: np.ndarray, mask_2: np.ndarray,
+                    method: str = 'auto') -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Two-sided two-sample Kolmogorov-Smirnov test of every feature (column) of a (patients x features) matrix at once,
+    between the patients selected by ``mask_1`` and by ``mask_2``. NaN values are ignored per column, columns with no
+    values in one of the groups get NaN results.
+
+    The statistics are computed for all columns together by sorting the matrix once. With ``method='auto'`` the
+    p-values are identical to :func:`scipy.stats.ks_2samp`: exact p-values are computed once per distinct
+    (n1, n2, statistic) combination and the asymptotic ones for all columns at once. ``method='asymp'`` computes all
+    p-values with the asymptotic distribution.
+
+    >>> matrix = np.random.RandomState(0).randn(100, 3000)
+    >>> early = np.arange(100) < 40
+    >>> statistics, pvalues = ks_2samp_matrix(matrix, early, ~early)
+
+    :param matrix: (patients x features) matrix of feature values
+    :type matrix: np.ndarray
+    :param mask_1: boolean mask (or indices) of the patients of the first group
+    :type mask_1: np.ndarray
+    :param mask_2: boolean mask (or indices) of the patients of the second group
+    :type mask_2: np.ndarray
+    :param method: 'auto' (as :func:`scipy.stats.ks_2samp`) or 'asymp', defaults to 'auto'
+    :type method: str, optional
+    :return: statistics and p-values of every feature
+    :rtype: tp.Tuple[np.ndarray, np.ndarray]
+    """
+    assert method in ('auto', 'asymp'), 'method must be either "auto" or "asymp"'
+    matrix = np.asarray(matrix, dtype=np.float64)
+    group_1, group_2 = matrix[mask_1], matrix[mask_2]
+    values = np.concatenate([group_1, group_2])
+    is_1 = np.zeros(values.shape, dtype=bool)
+    is_1[:len(group_1)] = True
+    valid = ~np.isnan(values)
+    is_1 &= valid
+    is_2 = valid & ~is_1
+    n1, n2 = is_1.sum(axis=0), is_2.sum(axis=0)
+
+    order, evaluated = _sort_columns(values)
+    statistics = _ks_statistics(np.take_along_axis(is_1, order, axis=0), np.take_along_axis(is_2, order, axis=0),
+                                evaluated, n1, n2)
+
+    empty = (n1 == 0) | (n2 == 0)
+    statistics[empty] = np.nan
+    pvalues = np.full(statistics.shape, np.nan)
+    exact = ~empty & (np.maximum(n1, n2) <= 10000) if method == 'auto' else np.zeros(statistics.shape, dtype=bool)
 
-    n_features = len(feature)
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-        results = list(
-            executor.map(significance_test, [early] * n_features, [late] * n_features,
-                         feature, [col] * n_features, [mutation] * n_features, [mutation_status] * n_features)
-        )
+    # exact p-values only depend on the group sizes and on the statistic, which takes few distinct values, so they
+    # are computed once per distinct combination
+    columns = np.flatnonzero(exact)
+    keys = np.stack([n1[columns], n2[columns], np.round(statistics[columns] * n1[columns] * n2[columns])], axis=1)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    distinct = [_ks_2samp_exact_pvalue(group_1[:, j], group_2[:, j]) for j in columns[first]]
+    pvalues[columns] = np.array(distinct, dtype=np.float64)[inverse.ravel()]
+    asymp = ~empty & (~exact | np.isnan(pvalues))
+    pvalues[asymp] = kstwo.sf(statistics[asymp], np.round(n1[asymp] * n2[asymp] / (n1[asymp] + n2[asymp])))
 
-    return results
+    return statistics, np.clip(pvalues, 0, 1)
+
+
+PERMUTATION_STATISTICS = ('ks', 'mannwhitney', 'mean_difference')
+
+
+def _permutation_statistics(values: np.ndarray, labels: np.ndarray, statistic: str) -> np.ndarray:
+    """
+    Two-sided statistic of every column of ``values`` for every row of ``labels``, a (permutations x patients), or
+    (permutations x patients x columns), boolean array which is True for the patients of the first group. Whatever the
+    number of permutations, the columns are sorted (or ranked) only once
+    """
+    valid = ~np.isnan(values)
+    n_valid = valid.sum(axis=0)
+    if statistic == 'ks':
+        order, evaluated = _sort_columns(values)
+        sorted_valid = np.take_along_axis(valid, order, axis=0)
+        cumulative_valid = np.cumsum(sorted_valid, axis=0, dtype=np.int32)
+        cumulative_1 = np.empty(values.shape, dtype=np.int32)
+        all_evaluated = evaluated.all()
+        statistics, n1 = np.empty((2, len(labels), values.shape[1]))
+        for i, permuted in enumerate(labels):
+            # same computation as _ks_statistics, with the counts of the second group derived from the first one
+            permuted = permuted[order] if permuted.ndim == 1 else np.take_along_axis(permuted, order, axis=0)
+            np.cumsum(permuted & sorted_valid, axis=0, out=cumulative_1)
+            n1[i] = cumulative_1[-1] if len(values) else 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cddiffs = cumulative_1 / n1[i] - (cumulative_valid - cumulative_1) / (n_valid - n1[i])
+            if not all_evaluated:
+                cddiffs *= evaluated
+            statistics[i] = np.max(np.abs(cddiffs), axis=0, initial=0)
+    else:
+        # the sums over the first group of all permutations are computed by a single matrix product
+        labels = labels.astype(np.float64)
+        total = (lambda x: labels @ x) if labels.ndim == 2 else (lambda x: np.einsum('prc,rc->pc', labels, x))
+        n1 = total(valid.astype(np.float64))
+        n2 = n_valid - n1
+        if statistic == 'mannwhitney':
+            ranks = rankdata(np.where(valid, values, np.inf), axis=0)
+            ranks[~valid] = 0
+            statistics = np.abs(total(ranks) - n1 * (n1 + 1) / 2 - n1 * n2 / 2)
+        else:
+            values = np.where(valid, values, 0)
+            sums_1 = total(values)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                statistics = np.abs(sums_1 / n1 - (values.sum(axis=0) - sums_1) / n2)
+    statistics[(n1 == 0) | (n1 == n_valid)] = np.nan
+    return statistics
+
+
+def _conditional_labels(priorities: np.ndarray, valid: np.ndarray, n1: np.ndarray) -> np.ndarray:
+    """
+    (permutations x patients x columns) labels selecting, in every column, the ``n1`` valid patients of lowest
+    priority, so the size of the first group among the valid values is the same in all permutations
+    """
+    labels = np.empty((len(priorities),) + valid.shape, dtype=bool)
+    for i, priority in enumerate(priorities):
+        order = np.argsort(priority)
+        sorted_valid = valid[order]
+        labels[i, order] = sorted_valid & (np.cumsum(sorted_valid, axis=0) <= n1)
+    return labels
+
+
+def _permutation_counts(values: np.ndarray, n_1: int, statistic: str, observed: np.ndarray, seed: int, chunk: int,
+                        n_permutations: int) -> np.ndarray:
+    # every chunk has its own random stream, so the results do not depend on the number of workers
+    priorities = np.random.default_rng([seed, chunk]).permuted(
+        np.broadcast_to(np.arange(len(values)), (n_permutations, len(values))), axis=1)
+    valid = ~np.isnan(values)
+    complete = valid.all(axis=0)
+    statistics = np.empty((n_permutations, values.shape[1]))
+    statistics[:, complete] = _permutation_statistics(values[:, complete], priorities < n_1, statistic)
+
+    # patients with missing values are left out of the permutations of a column
+    incomplete = np.flatnonzero(~complete)
+    n1 = valid[:n_1, incomplete].sum(axis=0)
+    # bounds the memory of the labels
+    step = max(1, 2 ** 24 // max(1, valid.shape[0] * len(incomplete)))
+    for start in range(0, n_permutations if len(incomplete) else 0, step):
+        labels = _conditional_labels(priorities[start:start + step], valid[:, incomplete], n1)
+        statistics[start:start + step, incomplete] = _permutation_statistics(values[:, incomplete], labels, statistic)
+
+    # tolerance for the floating point error of statistics equal to the observed one
+    return np.sum(statistics >= observed - 1e-12 * np.maximum(np.abs(observed), 1), axis=0)
+
+
+def permutation_test_matrix(matrix: np.ndarray, mask_1: np.ndarray, mask_2: np.ndarray, statistic: str = 'ks',
+                            n_permutations: int = 1000, seed: int = 0, chunk_size: int = 100,
+                            max_workers: tp.Optional[int] = None) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Two-sided permutation test of every feature (column) of a (patients x features) matrix at once, between the
+    patients selected by ``mask_1`` and by ``mask_2``. NaN values are ignored per column: the labels of a column are
+    only permuted between its patients with a value, keeping the size of both groups.
+
+    Every permutation of the group labels is shared by all the features. Permutations are computed in chunks of
+    ``chunk_size`` by worker processes reading the matrix from shared memory, chunk ``i`` being drawn from
+    ``np.random.default_rng([seed, i])`` so the p-values only depend on ``seed``.
+    The p-value of a feature is ``(1 + k) / (1 + n_permutations)``, where ``k`` is the number of permutations with a
+    statistic at least as extreme as the observed one.
+
+    >>> matrix = np.random.RandomState(0).randn(100, 500)
+    >>> early = np.arange(100) < 40
+    >>> statistics, pvalues = permutation_test_matrix(matrix, early, ~early, statistic='mannwhitney',
+    ...                                               n_permutations=200, max_workers=1)
+    >>> pvalues.shape
+    (500,)
+
+    :param matrix: (patients x features) matrix of feature values
+    :type matrix: np.ndarray
+    :param mask_1: boolean mask (or indices) of the patients of the first group
+    :type mask_1: np.ndarray
+    :param mask_2: boolean mask (or indices) of the patients of the second group
+    :type mask_2: np.ndarray
+    :param statistic: 'ks' (Kolmogorov-Smirnov statistic), 'mannwhitney' (distance of the Mann-Whitney U statistic
+        to its mean) or 'mean_difference' (absolute difference of the means), defaults to 'ks'
+    :type statistic: str, optional
+    :param n_permutations: number of permutations, defaults to 1000
+    :type n_permutations: int, optional
+    :param seed: seed of the permutations, defaults to 0
+    :type seed: int, optional
+    :param chunk_size: number of permutations computed at once by a worker, defaults to 100
+    :type chunk_size: int, optional
+    :param max_workers: number of worker processes, defaults to None (number of cpus)
+    :type max_workers: tp.Optional[int], optional
+    :return: observed statistics and p-values of every feature
+    :rtype: tp.Tuple[np.ndarray, np.ndarray]
+    """
+    assert statistic in PERMUTATION_STATISTICS, f'statistic must be one of {PERMUTATION_STATISTICS}'
+    assert n_permutations > 0, 'n_permutations must be positive'
+    matrix = np.asarray(matrix, dtype=np.float64)
+    group_1 = matrix[mask_1]
+    values = np.concatenate([group_1, matrix[mask_2]])
+    labels = np.arange(len(values)) < len(group_1)
+    observed = _permutation_statistics(values, labels[None], statistic)[0]
+
+    chunks = [(chunk, min(chunk_size, n_permutations - start))
+              for chunk, start in enumerate(range(0, n_permutations, chunk_size))]
+    max_workers = min(max_workers or os.cpu_count(), len(chunks))
+    if max_workers <= 1:
+        counts = [_permutation_counts(values, len(group_1), statistic, observed, seed, chunk, size)
+                  for chunk, size in chunks]
+    else:
+        with _SharedMatrix(values) as shared, ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [shared.submit(executor, _permutation_counts, len(group_1), statistic, observed, seed, chunk,
+                                     size) for chunk, size in chunks]
+            counts = [future.result() for future in futures]
+
+    pvalues = (1 + np.sum(counts, axis=0)) / (1 + n_permutations)
+    pvalues[np.isnan(observed)] = np.nan
+    return observed, pvalues
+
+
+def adjust_pvalues(pvalues: np.ndarray, method: str = 'bh') -> np.ndarray:
+    """
+    Corrects p-values for multiple testing, NaN p-values are ignored and kept as is
+
+    >>> adjust_pvalues([0.01, 0.04, 0.03, 0.005])
+    array([0.02, 0.04, 0.04, 0.02])
+    >>> adjust_pvalues([0.01, 0.04, np.nan, 0.5], method='bonferroni')
+    array([0.03, 0.12,  nan, 1.  ])
+
+    :param pvalues: p-values
+    :type pvalues: np.ndarray
+    :param method: 'bh' (Benjamini-Hochberg false discovery rate) or 'bonferroni' (family-wise error rate),
+        defaults to 'bh'
+    :type method: str, optional
+    :return: adjusted p-values
+    :rtype: np.ndarray
+    """
+    assert method in ('bh', 'bonferroni'), 'method must be either "bh" or "bonferroni"'
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = pvalues.copy()
+    tested = ~np.isnan(pvalues)
+    tested_pvalues = pvalues[tested]
+    n_tests = len(tested_pvalues)
+    if method == 'bonferroni':
+        adjusted[tested] = np.minimum(tested_pvalues * n_tests, 1)
+    else:
+        order = np.argsort(tested_pvalues)
+        ranked = tested_pvalues[order] * n_tests / np.arange(1, n_tests + 1)
+        corrected = np.empty(n_tests)
+        corrected[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+        adjusted[tested] = corrected
+    return adjusted
@@ -1,10 +1,16 @@
+import asyncio
+import collections
+import itertools
 import os
+import time
 import typing as tp
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 from uuid import uuid4
 from loguru import logger
 import motor
+import numpy as np
 import pymongo.database
 from mongoengine import connect
 import motor.motor_asyncio
@@ -81,10 +87,8 @@ def init_database(config_name: str, async_flag: bool = False, config_path=None):
     return db
 
 
-def fetch_collection_as_table(col: str, patients: tp.List[str] = None, **params):
-    db = init_database(**params)
-
-    return db[col].aggregate([
+def _table_pipeline(patients: tp.Optional[tp.List[str]] = None) -> tp.List[dict]:
+    return [
         {
             "$match": {
                 "patient": {"$in": patients}
@@ -129,5 +133,419 @@ def fetch_collection_as_table(col: str, patients: tp.List[str] = None, **params)
                 'data': 0
             }
         }
-    ],
-        allowDiskUse=True)
+    ]
+
+
+RECOMMENDED_INDEXES = [[('patient', pymongo.ASCENDING), ('name', pymongo.ASCENDING)]]
+
+
+def get_patient_indexes(col: str, db: tp.Optional[pymongo.database.Database] = None, **params) -> tp.Dict[str, bool]:
+    """
+    Detects the indexes supporting patient queries: an index whose keys start with ``patient`` serves the patient
+    filter, one whose keys start with ``patient`` and ``name`` also serves the feature name filter
+
+    :param col: name of the collection
+    :type col: str
+    :param db: database handle, defaults to None (``init_database(**params)``)
+    :type db: tp.Optional[pymongo.database.Database], optional
+    :return: whether a ``patient`` index and a ``patient_name`` index exist
+    :rtype: tp.Dict[str, bool]
+    """
+    db = init_database(**params) if db is None else db
+    keys = [[field for field, _ in index['key']] for index in db[col].index_information().values()]
+    return dict(patient=any(key[:1] == ['patient'] for key in keys),
+                patient_name=any(key[:2] == ['patient', 'name'] for key in keys))
+
+
+def create_recommended_indexes(col: str, db: tp.Optional[pymongo.database.Database] = None,
+                               **params) -> tp.List[str]:
+    """
+    Creates the :data:`RECOMMENDED_INDEXES` of a feature collection, a (patient, name) index serving both the patient
+    filter and the feature name filter. Existing indexes are left as is
+
+    :param col: name of the collection
+    :type col: str
+    :param db: database handle, defaults to None (``init_database(**params)``)
+    :type db: tp.Optional[pymongo.database.Database], optional
+    :return: names of the indexes
+    :rtype: tp.List[str]
+    """
+    db = init_database(**params) if db is None else db
+    return [db[col].create_index(keys) for keys in RECOMMENDED_INDEXES]
+
+
+class ChunkTiming(tp.NamedTuple):
+    patients: int
+    rows: int
+    elapsed: float
+
+
+class PatientChunkStats:
+    """
+    Timings of the sub-queries of a fetch whose patients were split in chunks, in the order of the chunks
+    """
+
+    def __init__(self):
+        self.chunks: tp.List[ChunkTiming] = []
+        self.elapsed = 0.
+
+    @property
+    def slowest(self) -> tp.Optional[ChunkTiming]:
+        return max(self.chunks, key=lambda chunk: chunk.elapsed, default=None)
+
+    def __repr__(self):
+        slowest = self.slowest.elapsed if self.chunks else 0.
+        return f'{type(self).__name__}(chunks={len(self.chunks)}, elapsed={self.elapsed:.2f}, slowest={slowest:.2f})'
+
+
+def _patient_chunks(db: pymongo.database.Database, col: str, patients: tp.Optional[tp.List[str]],
+                    patient_chunk_size: tp.Optional[int]) -> tp.Optional[tp.List[tp.List[str]]]:
+    """
+    Chunks of a patient list larger than ``patient_chunk_size``, or None when the query should not be split
+    """
+    if not patients or patient_chunk_size is None or len(patients) <= patient_chunk_size:
+        return None
+    if not get_patient_indexes(col, db=db)['patient']:
+        # every sub-query would scan the whole collection
+        logger.warning(f'{col} has no index on patient, querying {len(patients)} patients at once, '
+                       f'see create_recommended_indexes')
+        return None
+    return [patients[start:start + patient_chunk_size] for start in range(0, len(patients), patient_chunk_size)]
+
+
+def _fetch_chunks(chunks: tp.List[tp.List[str]], fetch: tp.Callable[[tp.List[str]], tp.Any], max_workers: int,
+                  stats: tp.Optional[PatientChunkStats], count: tp.Callable[[tp.Any], int] = len) -> tp.Iterator:
+    """
+    Runs ``fetch`` on every chunk in a thread pool and yields the results in the order of the chunks, ``count``
+    giving the number of rows of a result. At most ``max_workers`` chunks are fetched ahead of the consumer, so the
+    results of the whole collection are never held at once
+    """
+    stats = stats if stats is not None else PatientChunkStats()
+    start = time.perf_counter()
+
+    def timed_fetch(chunk: tp.List[str]):
+        chunk_start = time.perf_counter()
+        result = fetch(chunk)
+        return result, ChunkTiming(patients=len(chunk), rows=count(result), elapsed=time.perf_counter() - chunk_start)
+
+    chunks = iter(chunks)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = collections.deque(executor.submit(timed_fetch, chunk)
+                                    for chunk in itertools.islice(chunks, max_workers))
+        while futures:
+            result, timing = futures.popleft().result()
+            futures.extend(executor.submit(timed_fetch, chunk) for chunk in itertools.islice(chunks, 1))
+            stats.chunks.append(timing)
+            stats.elapsed = time.perf_counter() - start
+            yield result
+    logger.debug(stats)
+
+
+def fetch_collection_as_table(col: str, patients: tp.List[str] = None, patient_chunk_size: tp.Optional[int] = None,
+                              max_workers: int = 4, stats: tp.Optional[PatientChunkStats] = None,
+                              db: tp.Optional[pymongo.database.Database] = None, **params) -> tp.Iterable[dict]:
+    """
+    Fetches a collection of (sample, patient, name, value) documents as one row per sample, pivoted by the server.
+
+    When ``patient_chunk_size`` is provided, larger patient lists are split into sub-queries run in parallel, as huge
+    ``$in`` documents make slow query plans. The rows are then returned chunk after chunk by an iterator rather than a
+    cursor. Splitting requires an index on patient (see :func:`create_recommended_indexes`), without which a single
+    query is made
+
+    :param col: name of the collection
+    :type col: str
+    :param patients: if provided, only the samples of these patients are fetched, defaults to None
+    :type patients: tp.List[str], optional
+    :param patient_chunk_size: maximal number of patients per query, e.g. 1000, defaults to None (never split)
+    :type patient_chunk_size: tp.Optional[int], optional
+    :param max_workers: maximal number of sub-queries run at once, defaults to 4
+    :type max_workers: int, optional
+    :param stats: timings of the sub-queries, filled when the patients are split, defaults to None
+    :type stats: tp.Optional[PatientChunkStats], optional
+    :param db: database handle, defaults to None (``init_database(**params)``)
+    :type db: tp.Optional[pymongo.database.Database], optional
+    :return: cursor, or iterator when the patients are split, over the rows
+    :rtype: tp.Iterable[dict]
+    """
+    db = init_database(**params) if db is None else db
+    chunks = _patient_chunks(db, col, patients, patient_chunk_size)
+    if chunks is None:
+        return db[col].aggregate(_table_pipeline(patients), allowDiskUse=True)
+
+    results = _fetch_chunks(chunks, lambda chunk: list(db[col].aggregate(_table_pipeline(chunk), allowDiskUse=True)),
+                            max_workers=max_workers, stats=stats)
+    return itertools.chain.from_iterable(results)
+
+
+class CollectionTable(tp.NamedTuple):
+    """
+    Collection of (sample, patient, name, value) documents pivoted to one row per sample and one column per feature
+    name, holding NaN for missing values
+    """
+    samples: tp.List[str]
+    patients: tp.List[str]
+    feature_names: tp.List[str]
+    matrix: np.ndarray
+
+    def to_frame(self) -> 'pandas.DataFrame':
+        """
+        :return: data frame with the columns of the rows of :func:`fetch_collection_as_table`: patient, sample and
+            one column per feature
+        :rtype: :class:`pandas.DataFrame`
+        """
+        import pandas as pd
+
+        frame = pd.DataFrame(self.matrix, columns=self.feature_names)
+        frame.insert(0, 'sample', self.samples)
+        frame.insert(0, 'patient', self.patients)
+        return frame
+
+
+class _TablePivot:
+    """
+    Pivots batches of (sample, patient, name, value) documents into a matrix growing geometrically with the number of
+    samples and feature names
+    """
+
+    def __init__(self, feature_names: tp.Optional[tp.Sequence[str]] = None):
+        self.rows = {}
+        self.patients = []
+        self.columns = {name: j for j, name in enumerate(feature_names or [])}
+        self.matrix = np.full((0, len(self.columns)), np.nan)
+
+    def _row(self, sample: str, patient: str) -> int:
+        row = self.rows.get(sample)
+        if row is None:
+            row = self.rows[sample] = len(self.patients)
+            self.patients.append(patient)
+        return row
+
+    def _column(self, name: str) -> int:
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = len(self.columns)
+        return column
+
+    def _grow(self):
+        # every axis grows on its own, only when it overflows
+        shape = tuple(max(needed, 2 * allocated) if needed > allocated else allocated
+                      for needed, allocated in zip((len(self.rows), len(self.columns)), self.matrix.shape))
+        if shape != self.matrix.shape:
+            matrix = np.full(shape, np.nan)
+            matrix[:self.matrix.shape[0], :self.matrix.shape[1]] = self.matrix
+            self.matrix = matrix
+
+    def add(self, documents: tp.List[dict]):
+        rows = np.empty(len(documents), dtype=np.int64)
+        columns = np.empty(len(documents), dtype=np.int64)
+        values = np.empty(len(documents))
+        for i, document in enumerate(documents):
+            rows[i] = self._row(document['sample'], document['patient'])
+            columns[i] = self._column(document['name'])
+            value = document.get('value')
+            values[i] = np.nan if value is None else value
+        self._grow()
+        self.matrix[rows, columns] = values
+
+    def add_table(self, table: 'CollectionTable'):
+        rows = [self._row(sample, patient) for sample, patient in zip(table.samples, table.patients)]
+        columns = [self._column(name) for name in table.feature_names]
+        self._grow()
+        block = np.ix_(rows, columns)
+        # missing values do not override values of previous tables
+        self.matrix[block] = np.where(np.isnan(table.matrix), self.matrix[block], table.matrix)
+
+    def table(self) -> CollectionTable:
+        return CollectionTable(samples=list(self.rows), patients=self.patients, feature_names=list(self.columns),
+                               matrix=self.matrix[:len(self.rows), :len(self.columns)])
+
+
+_DOCUMENT_PROJECTION = dict(_id=0, sample=1, patient=1, name=1, value=1)
+
+
+def _documents_query(patients: tp.Optional[tp.List[str]], feature_names: tp.Optional[tp.Sequence[str]]) -> dict:
+    query = {}
+    if patients:
+        query['patient'] = {'$in': list(patients)}
+    if feature_names is not None:
+        query['name'] = {'$in': list(feature_names)}
+    return query
+
+
+def fetch_collection_as_matrix(col: str, patients: tp.List[str] = None,
+                               feature_names: tp.Optional[tp.Sequence[str]] = None, batch_size: int = 10000,
+                               as_frame: bool = False, patient_chunk_size: tp.Optional[int] = None,
+                               max_workers: int = 4, stats: tp.Optional[PatientChunkStats] = None,
+                               db: tp.Optional[pymongo.database.Database] = None,
+                               **params) -> tp.Union[CollectionTable, 'pandas.DataFrame']:
+    """
+    Client-side pivoting alternative to :func:`fetch_collection_as_table`: the raw (sample, patient, name, value)
+    documents are streamed with a projection, in batches of ``batch_size``, and every batch is pivoted into a numeric
+    matrix as it arrives, so neither the server nor the client hold one wide document per sample.
+    Rows are ordered by first appearance of their sample, columns by ``feature_names`` (or by first appearance).
+    Large patient lists can be split as in :func:`fetch_collection_as_table`, the tables of the chunks being merged
+    in order with :func:`merge_tables`.
+
+    >>> db = init_cached_database('mongomock://localhost', db_name='mock', alias='mock')
+    >>> _ = db['mock_features'].insert_many([dict(sample='s1', patient='p1', name='age', value=52),
+    ...                                      dict(sample='s1', patient='p1', name='BRCA1', value=0.5),
+    ...                                      dict(sample='s2', patient='p2', name='age', value=40)])
+    >>> table = fetch_collection_as_matrix('mock_features', feature_names=['age'], db=db)
+    >>> table.samples, table.feature_names, table.matrix.tolist()
+    (['s1', 's2'], ['age'], [[52.0], [40.0]])
+
+    :param col: name of the collection
+    :type col: str
+    :param patients: if provided, only the documents of these patients are fetched, defaults to None
+    :type patients: tp.List[str], optional
+    :param feature_names: if provided, only these features are fetched, defaults to None
+    :type feature_names: tp.Optional[tp.Sequence[str]], optional
+    :param batch_size: number of documents per cursor batch and per pivoted batch, defaults to 10000
+    :type batch_size: int, optional
+    :param as_frame: if True, returns a :class:`pandas.DataFrame` (see :meth:`CollectionTable.to_frame`), defaults
+        to False
+    :type as_frame: bool, optional
+    :param patient_chunk_size: maximal number of patients per query, e.g. 1000, defaults to None (never split)
+    :type patient_chunk_size: tp.Optional[int], optional
+    :param max_workers: maximal number of sub-queries run at once, defaults to 4
+    :type max_workers: int, optional
+    :param stats: timings of the sub-queries, filled when the patients are split, defaults to None
+    :type stats: tp.Optional[PatientChunkStats], optional
+    :param db: database handle, defaults to None (``init_database(**params)``)
+    :type db: tp.Optional[pymongo.database.Database], optional
+    :return: pivoted collection
+    :rtype: tp.Union[CollectionTable, pandas.DataFrame]
+    """
+    db = init_database(**params) if db is None else db
+    chunks = _patient_chunks(db, col, patients, patient_chunk_size)
+    if chunks is not None:
+        table = merge_tables(_fetch_chunks(
+            chunks, lambda chunk: fetch_collection_as_matrix(col, chunk, feature_names, batch_size=batch_size,
+                                                             patient_chunk_size=None, db=db),
+            max_workers=max_workers, stats=stats, count=lambda table: len(table.samples)))
+        return table.to_frame() if as_frame else table
+
+    cursor = db[col].find(_documents_query(patients, feature_names), projection=_DOCUMENT_PROJECTION,
+                          batch_size=batch_size)
+    pivot = _TablePivot(feature_names)
+    for documents in iter(lambda: list(itertools.islice(cursor, batch_size)), []):
+        pivot.add(documents)
+    table = pivot.table()
+    return table.to_frame() if as_frame else table
+
+
+def merge_tables(tables: tp.Iterable[CollectionTable]) -> CollectionTable:
+    """
+    Outer join of tables on their samples, e.g. of several collections or of several patient subsets of a collection.
+    Rows and columns are ordered by first appearance, values present in several tables are taken from the last one
+
+    :param tables: tables to merge
+    :type tables: tp.Iterable[CollectionTable]
+    :return: merged table
+    :rtype: CollectionTable
+    """
+    pivot = _TablePivot()
+    for table in tables:
+        pivot.add_table(table)
+    return pivot.table()
+
+
+def _async_database(db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase],
+                    params: dict) -> motor.motor_asyncio.AsyncIOMotorDatabase:
+    return init_database(**dict(params, async_flag=True)) if db is None else db
+
+
+async def _iter_batches(cursor, batch_size: int) -> tp.AsyncIterator[tp.List[dict]]:
+    while True:
+        documents = await cursor.to_list(length=batch_size)
+        if not documents:
+            return
+        yield documents
+
+
+async def async_fetch_collection_as_table(col: str, patients: tp.List[str] = None, batch_size: int = 1000,
+                                          db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase] = None,
+                                          **params) -> tp.AsyncIterator[dict]:
+    """
+    Async version of :func:`fetch_collection_as_table`, yielding the rows as the cursor receives them in batches of
+    ``batch_size``, so at most one batch is held in memory
+
+    >>> rows = [row async for row in async_fetch_collection_as_table('GeneExpression',
+    ...                                                               config_name='features')]  # doctest: +SKIP
+
+    :param col: name of the collection
+    :type col: str
+    :param patients: if provided, only the documents of these patients are fetched, defaults to None
+    :type patients: tp.List[str], optional
+    :param batch_size: number of rows per cursor batch, defaults to 1000
+    :type batch_size: int, optional
+    :param db: motor database handle, defaults to None (``init_database(async_flag=True, **params)``)
+    :type db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase], optional
+    :return: async iterator of one row per sample
+    :rtype: tp.AsyncIterator[dict]
+    """
+    db = _async_database(db, params)
+    async for row in db[col].aggregate(_table_pipeline(patients), allowDiskUse=True, batchSize=batch_size):
+        yield row
+
+
+async def async_fetch_collection_as_matrix(col: str, patients: tp.List[str] = None,
+                                           feature_names: tp.Optional[tp.Sequence[str]] = None,
+                                           batch_size: int = 10000, as_frame: bool = False,
+                                           db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase] = None,
+                                           **params) -> tp.Union[CollectionTable, 'pandas.DataFrame']:
+    """
+    Async version of :func:`fetch_collection_as_matrix`, every batch of ``batch_size`` documents is pivoted while the
+    next one is awaited
+
+    :param db: motor database handle, defaults to None (``init_database(async_flag=True, **params)``)
+    :type db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase], optional
+    :return: pivoted collection
+    :rtype: tp.Union[CollectionTable, pandas.DataFrame]
+    """
+    db = _async_database(db, params)
+    cursor = db[col].find(_documents_query(patients, feature_names), projection=_DOCUMENT_PROJECTION,
+                          batch_size=batch_size)
+
+    pivot = _TablePivot(feature_names)
+    async for documents in _iter_batches(cursor, batch_size):
+        pivot.add(documents)
+    table = pivot.table()
+    return table.to_frame() if as_frame else table
+
+
+async def gather_collections_as_matrix(queries: tp.Sequence[tp.Union[str, dict]], max_concurrency: int = 8,
+                                       batch_size: int = 10000, as_frame: bool = False,
+                                       db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase] = None,
+                                       **params) -> tp.Union[CollectionTable, 'pandas.DataFrame']:
+    """
+    Fetches several collections, or several patient subsets of collections, concurrently with
+    :func:`async_fetch_collection_as_matrix` over the connection pool of a single motor client, and merges them with
+    :func:`merge_tables`
+
+    >>> table = await gather_collections_as_matrix(['GeneExpression', dict(col='Methylation', patients=patients)],
+    ...                                            config_name='features')  # doctest: +SKIP
+
+    :param queries: collection names, or dictionaries of ``col``, ``patients`` and ``feature_names`` arguments
+    :type queries: tp.Sequence[tp.Union[str, dict]]
+    :param max_concurrency: maximal number of collections fetched at once, defaults to 8
+    :type max_concurrency: int, optional
+    :param batch_size: number of documents per cursor batch, defaults to 10000
+    :type batch_size: int, optional
+    :param as_frame: if True, returns a :class:`pandas.DataFrame`, defaults to False
+    :type as_frame: bool, optional
+    :param db: motor database handle, defaults to None (``init_database(async_flag=True, **params)``)
+    :type db: tp.Optional[motor.motor_asyncio.AsyncIOMotorDatabase], optional
+    :return: merged table
+    :rtype: tp.Union[CollectionTable, pandas.DataFrame]
+    """
+    db = _async_database(db, params)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(query: tp.Union[str, dict]) -> CollectionTable:
+        query = dict(col=query) if isinstance(query, str) else query
+        async with semaphore:
+            return await async_fetch_collection_as_matrix(batch_size=batch_size, db=db, **query)
+
+    table = merge_tables(await asyncio.gather(*map(fetch, queries)))
+    return table.to_frame() if as_frame else table
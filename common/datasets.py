@@ -0,0 +1,274 @@
+import typing as tp
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
+
+from common.les_files import LesFile, compose_label_volume
+from common.utils import scan_dicom_series, read_dicom_series_slices, convert_intensities, DicomVolumeCache
+
+
+class _LesionVolumeSource:
+    """
+    Shared loading logic of the lesion datasets. File handles (memory mapped les files, dicom series descriptions and
+    the decoded volume cache) are opened lazily and are never pickled, so every DataLoader worker opens its own.
+
+    :param samples: list of (dicom directory, les file) pairs, one per case
+    :type samples: tp.Sequence[tp.Tuple[str, str]]
+    :param patch_shape: (z, y, x) shape of the lesion centred patches, defaults to None (full volumes)
+    :type patch_shape: tp.Optional[tp.Sequence[int]], optional
+    :param dtype: dtype of the image, defaults to np.float32
+    :type dtype: np.dtype, optional
+    :param window: (low, high) intensity range to which the image is clipped, defaults to None
+    :type window: tp.Optional[tp.Tuple[float, float]], optional
+    :param normalize: if True, maps the window to [0, 1], defaults to False
+    :type normalize: bool, optional
+    :param cache_dir: directory of a :class:`common.utils.DicomVolumeCache`, if provided volumes are decoded once and
+        then memory mapped, defaults to None
+    :type cache_dir: tp.Optional[str], optional
+    """
+
+    def __init__(self, samples: tp.Sequence[tp.Tuple[str, str]], patch_shape: tp.Optional[tp.Sequence[int]] = None,
+                 dtype: np.dtype = np.float32, window: tp.Optional[tp.Tuple[float, float]] = None,
+                 normalize: bool = False, cache_dir: tp.Optional[str] = None):
+        self.samples = list(samples)
+        self.patch_shape = tuple(patch_shape) if patch_shape is not None else None
+        self.dtype = dtype
+        self.window = window
+        self.normalize = normalize
+        self.cache_dir = cache_dir
+        self._handles = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        return state
+
+    def _handle(self, kind: str, case: int):
+        key = (kind, case)
+        if key not in self._handles:
+            dicom_dir, les_path = self.samples[case]
+            if kind == 'les':
+                self._handles[key] = LesFile(les_path)
+            elif kind == 'series':
+                self._handles[key] = scan_dicom_series(dicom_dir)[0]
+            else:
+                self._handles[key] = DicomVolumeCache(self.cache_dir).get(dicom_dir)[0]
+        return self._handles[key]
+
+    def _volume_shape(self, case: int) -> tp.Tuple[int, int, int]:
+        if self.cache_dir is not None:
+            return self._handle('memmap', case).shape
+        return tuple(self._handle('series', case)['size'][::-1])
+
+    def _read_region(self, case: int, slices: tp.Tuple[slice, slice, slice]) -> np.ndarray:
+        if self.cache_dir is not None:
+            region = self._handle('memmap', case)[slices]
+        else:
+            # only the slices of the region are decoded
+            region = read_dicom_series_slices(self._handle('series', case), slices[0].start,
+                                              slices[0].stop)[:, slices[1], slices[2]]
+        return convert_intensities(region, dtype=self.dtype, window=self.window, normalize=self.normalize)
+
+    def _to_sample(self, image: np.ndarray, mask: np.ndarray, case: int, lesion: int) -> dict:
+        return dict(image=torch.from_numpy(np.ascontiguousarray(image)[None]),
+                    mask=torch.from_numpy(np.ascontiguousarray(mask)[None]),
+                    case=case, lesion=lesion)
+
+    def load_volume(self, case: int) -> dict:
+        """
+        Loads the full image of a case along with the union of all its lesion masks
+        """
+        shape = self._volume_shape(case)
+        image = self._read_region(case, tuple(slice(0, dim) for dim in shape))
+        mask = compose_label_volume(list(self._handle('les', case)), shape=shape, multi_label=False,
+                                    out=np.zeros(shape, dtype=np.uint8))
+        return self._to_sample(image, mask, case, -1)
+
+    def load_patch(self, case: int, lesion: int) -> dict:
+        """
+        Loads a patch of ``patch_shape`` centred on a lesion, along with the union of all lesion masks inside it.
+        Patches crossing the volume border are shifted inside of it, and zero padded when the volume is smaller than
+        the patch
+        """
+        les_file = self._handle('les', case)
+        shape = self._volume_shape(case)
+        header = les_file.headers[lesion]
+        centre = np.array([sum(header[2]), sum(header[0]), sum(header[1])]) // 2
+        patch_shape = np.array(self.patch_shape)
+
+        starts = np.clip(centre - patch_shape // 2, 0, np.maximum(np.array(shape) - patch_shape, 0))
+        stops = np.minimum(starts + patch_shape, shape)
+        slices = tuple(slice(int(start), int(stop)) for start, stop in zip(starts, stops))
+
+        region = self._read_region(case, slices)
+        image = np.zeros(self.patch_shape, dtype=region.dtype)
+        image[tuple(slice(0, dim) for dim in region.shape)] = region
+        mask = compose_label_volume(list(les_file), shape=self.patch_shape, multi_label=False,
+                                    out=np.zeros(self.patch_shape, dtype=np.uint8), origin=starts)
+        return self._to_sample(image, mask, case, lesion)
+
+
+class LesionVolumeDataset(_LesionVolumeSource, Dataset):
+    """
+    Map-style dataset pairing dicom volumes with their lesion masks. Without ``patch_shape`` every item is a full case,
+    otherwise every item is a patch centred on a single lesion, of which only the covered slices are decoded.
+
+    Items are dictionaries holding contiguous ``image`` and ``mask`` tensors of shape (1, z, y, x) along with the
+    ``case`` and ``lesion`` indices (lesion is -1 for full cases).
+    See :class:`_LesionVolumeSource` for the parameters
+    """
+
+    def __init__(self, samples: tp.Sequence[tp.Tuple[str, str]], **kwargs):
+        super().__init__(samples, **kwargs)
+        if self.patch_shape is None:
+            self.index = [(case, -1) for case in range(len(self.samples))]
+        else:
+            # header-only pass over the les files
+            self.index = [(case, lesion) for case, (_, les_path) in enumerate(self.samples)
+                          for lesion in range(len(LesFile(les_path)))]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, item: int) -> dict:
+        case, lesion = self.index[item]
+        if self.patch_shape is None:
+            return self.load_volume(case)
+        return self.load_patch(case, lesion)
+
+
+class LesionPatchIterableDataset(_LesionVolumeSource, IterableDataset):
+    """
+    Iterable-style counterpart of :class:`LesionVolumeDataset`. Cases are split between the DataLoader workers and
+    every worker yields all the items of a case before moving to the next one, so its file handles are reused.
+    See :class:`_LesionVolumeSource` for the parameters
+
+    :param shuffle: if True, the order of the cases is shuffled on every epoch, defaults to False
+    :type shuffle: bool, optional
+    :param seed: seed of the shuffling, combined with the epoch set by :meth:`set_epoch`, defaults to 0
+    :type seed: int, optional
+    """
+
+    def __init__(self, samples: tp.Sequence[tp.Tuple[str, str]], shuffle: bool = False, seed: int = 0, **kwargs):
+        super().__init__(samples, **kwargs)
+        self.shuffle = shuffle
+        self.seed = seed
+        # shared memory, so epochs set in the main process reach persistent workers
+        self._epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    @property
+    def epoch(self) -> int:
+        return int(self._epoch[0])
+
+    def set_epoch(self, epoch: int):
+        """
+        Sets the epoch of the shuffling, to be called before every epoch (:class:`LesionDataModule` does it)
+        """
+        self._epoch[0] = epoch
+
+    def __iter__(self) -> tp.Iterator[dict]:
+        cases = np.arange(len(self.samples))
+        if self.shuffle:
+            np.random.default_rng(self.seed + self.epoch).shuffle(cases)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            cases = cases[worker_info.id::worker_info.num_workers]
+
+        for case in cases:
+            case = int(case)
+            if self.patch_shape is None:
+                yield self.load_volume(case)
+            else:
+                for lesion in range(len(self._handle('les', case))):
+                    yield self.load_patch(case, lesion)
+            # handles of a finished case are not needed anymore
+            self._handles = {key: value for key, value in self._handles.items() if key[1] != case}
+
+
+class _EpochDataLoader(DataLoader):
+    """
+    DataLoader calling ``set_epoch`` of its dataset every time it is iterated, before its (possibly persistent) workers
+    start a new pass over the dataset. ``epoch`` maps the number of previous iterations to the epoch
+    """
+
+    def __init__(self, *args, epoch: tp.Callable[[int], int], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.epoch = epoch
+        self.iterations = 0
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch(self.iterations))
+        self.iterations += 1
+        return super().__iter__()
+
+
+class LesionDataModule(pl.LightningDataModule):
+    """
+    LightningDataModule serving :class:`LesionVolumeDataset` (or :class:`LesionPatchIterableDataset` when ``iterable``
+    is set) through DataLoaders with pinned memory, prefetching and persistent workers.
+
+    :param train_samples: list of (dicom directory, les file) pairs used for training
+    :type train_samples: tp.Sequence[tp.Tuple[str, str]]
+    :param val_samples: list of (dicom directory, les file) pairs used for validation, defaults to None
+    :type val_samples: tp.Optional[tp.Sequence[tp.Tuple[str, str]]], optional
+    :param test_samples: list of (dicom directory, les file) pairs used for testing, defaults to None
+    :type test_samples: tp.Optional[tp.Sequence[tp.Tuple[str, str]]], optional
+    :param batch_size: batch size, defaults to 1
+    :type batch_size: int, optional
+    :param num_workers: number of DataLoader workers, defaults to 0
+    :type num_workers: int, optional
+    :param prefetch_factor: number of batches prefetched by every worker, defaults to 2
+    :type prefetch_factor: int, optional
+    :param iterable: if True, uses :class:`LesionPatchIterableDataset`, defaults to False
+    :type iterable: bool, optional
+    :param dataset_kwargs: additional arguments of the datasets (patch_shape, dtype, window, normalize, cache_dir)
+    """
+
+    def __init__(self, train_samples: tp.Sequence[tp.Tuple[str, str]],
+                 val_samples: tp.Optional[tp.Sequence[tp.Tuple[str, str]]] = None,
+                 test_samples: tp.Optional[tp.Sequence[tp.Tuple[str, str]]] = None, batch_size: int = 1,
+                 num_workers: int = 0, prefetch_factor: int = 2, iterable: bool = False, **dataset_kwargs):
+        super().__init__()
+        self.samples = dict(train=train_samples, val=val_samples, test=test_samples)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.iterable = iterable
+        self.dataset_kwargs = dataset_kwargs
+        self.datasets = {}
+
+    def _create_dataset(self, split: str, shuffle: bool) -> Dataset:
+        if self.iterable:
+            return LesionPatchIterableDataset(self.samples[split], shuffle=shuffle, **self.dataset_kwargs)
+        return LesionVolumeDataset(self.samples[split], **self.dataset_kwargs)
+
+    def setup(self, stage: tp.Optional[str] = None):
+        for split in ('train', 'val', 'test'):
+            if self.samples[split] is not None and split not in self.datasets:
+                self.datasets[split] = self._create_dataset(split, shuffle=split == 'train')
+
+    def _dataloader(self, split: str, shuffle: bool) -> tp.Optional[DataLoader]:
+        if split not in self.datasets:
+            return None
+        dataset = self.datasets[split]
+        kwargs = dict(prefetch_factor=self.prefetch_factor, persistent_workers=True) if self.num_workers else {}
+        if isinstance(dataset, LesionPatchIterableDataset):
+            # reshuffled on every epoch, the epoch of the trainer when attached
+            return _EpochDataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                                    pin_memory=True, epoch=self._epoch, **kwargs)
+        return DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=shuffle,
+                          pin_memory=True, **kwargs)
+
+    def _epoch(self, iterations: int) -> int:
+        return self.trainer.current_epoch if self.trainer is not None else iterations
+
+    def train_dataloader(self) -> DataLoader:
+        return self._dataloader('train', shuffle=True)
+
+    def val_dataloader(self) -> tp.Optional[DataLoader]:
+        return self._dataloader('val', shuffle=False)
+
+    def test_dataloader(self) -> tp.Optional[DataLoader]:
+        return self._dataloader('test', shuffle=False)
@@ -1,18 +1,534 @@
+import asyncio
+import copy
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
 import httpx
+import numpy as np
 import typing as tp
 from loguru import logger
 from pydantic import validate_arguments
 
 ADDR = 'http://medical001-5.tau.ac.il/api'
 
+_client_config = dict(timeout=httpx.Timeout(60., connect=10.),
+                      limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.))
+_client: tp.Optional[httpx.Client] = None
+_client_pid: tp.Optional[int] = None
+_client_lock = threading.Lock()
+# async clients are bound to the event loop they were created in, along with the generator closing them
+_async_clients = weakref.WeakKeyDictionary()
+_cache: tp.Optional['ResponseCache'] = None
+
+_retry_config = dict(max_retries=3, backoff=0.5, max_backoff=10., retry_statuses=(429, 500, 502, 503, 504))
+_stats = dict(requests=0, retries=0, coalesced=0)
+_stats_lock = threading.Lock()
+_inflight: tp.Dict[str, '_InflightRequest'] = {}
+_inflight_lock = threading.Lock()
+_async_inflight = weakref.WeakKeyDictionary()
+
+
+def configure_client(timeout: tp.Optional[float] = 60., connect_timeout: tp.Optional[float] = 10.,
+                     max_connections: tp.Optional[int] = 20, max_keepalive_connections: tp.Optional[int] = 10,
+                     keepalive_expiry: tp.Optional[float] = 30.):
+    """
+    Configures the pooled client used by all requests of this module. The current client, if any, is closed and a new
+    one is created with the new configuration on the next request
+
+    :param timeout: read, write and pool timeout in seconds, None disables it, defaults to 60
+    :type timeout: tp.Optional[float], optional
+    :param connect_timeout: connection timeout in seconds, None disables it, defaults to 10
+    :type connect_timeout: tp.Optional[float], optional
+    :param max_connections: maximal number of concurrent connections, defaults to 20
+    :type max_connections: tp.Optional[int], optional
+    :param max_keepalive_connections: maximal number of idle connections kept alive, defaults to 10
+    :type max_keepalive_connections: tp.Optional[int], optional
+    :param keepalive_expiry: time in seconds after which idle connections are closed, defaults to 30
+    :type keepalive_expiry: tp.Optional[float], optional
+    """
+    _client_config.update(timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                          limits=httpx.Limits(max_connections=max_connections,
+                                              max_keepalive_connections=max_keepalive_connections,
+                                              keepalive_expiry=keepalive_expiry))
+    close_client()
+
+
+def get_client() -> httpx.Client:
+    """
+    Returns the long lived client of the current process, creating it on first use. A process forked from a process
+    which already created its client (e.g. a :class:`concurrent.futures.ProcessPoolExecutor` worker) gets its own
+    client rather than sharing the connections of its parent
+
+    :return: pooled http client
+    :rtype: :class:`httpx.Client`
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = httpx.Client(**_client_config)
+            _client_pid = os.getpid()
+        return _client
+
+
+def close_client():
+    """
+    Closes the client of the current process, a client inherited from a parent process is only dropped
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client, _client_pid = None, None
+
+
+async def _close_at_shutdown(client: httpx.AsyncClient):
+    # parked until the event loop shuts its async generators down, as :func:`asyncio.run` does before closing it
+    try:
+        yield
+    finally:
+        loop = asyncio.get_running_loop()
+        if _async_clients.get(loop, (None,))[0] is client:
+            del _async_clients[loop]
+        await client.aclose()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the long lived async client of the running event loop, creating it on first use. The client shares the
+    configuration set by :func:`configure_client`, and is closed when the loop shuts down, e.g. at the end of
+    :func:`asyncio.run`, unless :func:`close_async_client` closed it before
+
+    :return: pooled async http client
+    :rtype: :class:`httpx.AsyncClient`
+    """
+    loop = asyncio.get_running_loop()
+    client, _ = _async_clients.get(loop, (None, None))
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(**_client_config)
+        closer = _close_at_shutdown(client)
+        asyncio.ensure_future(closer.__anext__())
+        _async_clients[loop] = client, closer
+    return client
+
+
+async def close_async_client():
+    """
+    Closes the async client of the running event loop
+    """
+    client, closer = _async_clients.pop(asyncio.get_running_loop(), (None, None))
+    if client is not None:
+        await client.aclose()
+        await closer.aclose()
+
+
+class ResponseCache:
+    """
+    Two level cache of decoded responses: an in-memory LRU in front of an optional SQLite store that persists across
+    processes and runs. Entries are keyed by the endpoint and the normalized request parameters and expire after the
+    TTL of their endpoint. Cached responses are shared, callers must not modify them.
+
+    :param path: pathway to the SQLite database, defaults to None (memory only)
+    :type path: tp.Optional[str], optional
+    :param max_entries: maximal number of responses held in memory, defaults to 1024
+    :type max_entries: int, optional
+    :param max_disk_bytes: maximal total size of the responses stored on disk, least recently used responses are
+        removed beyond it, defaults to None (unbounded)
+    :type max_disk_bytes: tp.Optional[int], optional
+    :param ttls: TTL in seconds per endpoint (e.g. ``feature_names``), None meaning no expiry, defaults to None
+    :type ttls: tp.Optional[tp.Dict[str, tp.Optional[float]]], optional
+    :param default_ttl: TTL in seconds of endpoints missing from ``ttls``, defaults to 3600
+    :type default_ttl: tp.Optional[float], optional
+    """
+
+    def __init__(self, path: tp.Optional[str] = None, max_entries: int = 1024, max_disk_bytes: tp.Optional[int] = None,
+                 ttls: tp.Optional[tp.Dict[str, tp.Optional[float]]] = None, default_ttl: tp.Optional[float] = 3600.):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    @staticmethod
+    def make_key(method: str, **params) -> tp.Tuple[str, str]:
+        """
+        (endpoint, key) of a request, parameters are normalized by sorting dictionary keys
+        """
+        endpoint = params['url'].rstrip('/').rsplit('/', 1)[-1]
+        return endpoint, json.dumps(dict(method=method, **params), sort_keys=True)
+
+    def _connection(self) -> tp.Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30., check_same_thread=False)
+            self._db_pid = os.getpid()
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT, '
+                             'expires REAL, accessed REAL, size INTEGER, value BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_endpoint ON responses (endpoint)')
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key: str, endpoint: str, expires: float, value):
+        self._memory[key] = (endpoint, expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, endpoint: str, key: str) -> tp.Tuple[bool, tp.Any]:
+        """
+        :return: (found, value) pair
+        :rtype: tp.Tuple[bool, tp.Any]
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+
+            db = self._connection()
+            row = db.execute('SELECT expires, value FROM responses WHERE key = ? AND expires > ?',
+                             (key, now)).fetchone() if db else None
+            if row is None:
+                self.misses += 1
+                return False, None
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            db.commit()
+            value = json.loads(row[1])
+            self._remember(key, endpoint, row[0], value)
+            self.hits += 1
+            return True, value
+
+    def set(self, endpoint: str, key: str, value):
+        ttl = self.ttls.get(endpoint, self.default_ttl)
+        now = time.time()
+        expires = float('inf') if ttl is None else now + ttl
+        with self._lock:
+            self._remember(key, endpoint, expires, value)
+            db = self._connection()
+            if db is None:
+                return
+            blob = json.dumps(value).encode()
+            db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, endpoint, expires, now, len(blob), blob))
+            if self.max_disk_bytes is not None:
+                # drop the least recently used responses beyond the size limit
+                db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER '
+                           '(ORDER BY accessed DESC, key) AS total FROM responses) WHERE total > ?)',
+                           (self.max_disk_bytes,))
+            db.commit()
+
+    def invalidate(self, endpoint: tp.Optional[str] = None):
+        """
+        Removes the cached responses of an endpoint, or all cached responses
+
+        :param endpoint: endpoint name (e.g. ``feature_names``), defaults to None (all endpoints)
+        :type endpoint: tp.Optional[str], optional
+        """
+        with self._lock:
+            for key in [key for key, entry in self._memory.items() if endpoint is None or entry[0] == endpoint]:
+                del self._memory[key]
+            db = self._connection()
+            if db is not None:
+                if endpoint is None:
+                    db.execute('DELETE FROM responses')
+                else:
+                    db.execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+                db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._db_pid == os.getpid():
+                self._db.close()
+            self._db, self._db_pid = None, None
+
+
+def enable_cache(path: tp.Optional[str] = None, **kwargs) -> ResponseCache:
+    """
+    Enables caching of the responses of all requests of this module, see :class:`ResponseCache` for the arguments
+
+    >>> cache = enable_cache('responses.sqlite', ttls=dict(feature_names=None, features_for_patients=24 * 3600))
+
+    :param path: pathway to the SQLite database, defaults to None (memory only)
+    :type path: tp.Optional[str], optional
+    :return: the enabled cache
+    :rtype: :class:`ResponseCache`
+    """
+    global _cache
+    disable_cache()
+    _cache = ResponseCache(path, **kwargs)
+    return _cache
+
+
+def disable_cache():
+    """
+    Disables response caching, stored responses are kept on disk
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def invalidate_cache(endpoint: tp.Optional[str] = None):
+    """
+    Removes cached responses of an endpoint, or all cached responses, when caching is enabled
+
+    :param endpoint: endpoint name (e.g. ``feature_names``), defaults to None (all endpoints)
+    :type endpoint: tp.Optional[str], optional
+    """
+    if _cache is not None:
+        _cache.invalidate(endpoint)
+
+
+def configure_retries(max_retries: int = 3, backoff: float = 0.5, max_backoff: float = 10.,
+                      retry_statuses: tp.Sequence[int] = (429, 500, 502, 503, 504)):
+    """
+    Configures the retries of failed requests. A request failing with a transport error (e.g. a timeout or a refused
+    connection) or with one of ``retry_statuses`` is retried after a random delay between 0 and
+    ``min(max_backoff, backoff * 2 ** attempt)`` seconds
+
+    :param max_retries: maximal number of retries of a request, defaults to 3
+    :type max_retries: int, optional
+    :param backoff: base delay in seconds, defaults to 0.5
+    :type backoff: float, optional
+    :param max_backoff: maximal delay in seconds, defaults to 10
+    :type max_backoff: float, optional
+    :param retry_statuses: http status codes considered transient, defaults to (429, 500, 502, 503, 504)
+    :type retry_statuses: tp.Sequence[int], optional
+    """
+    _retry_config.update(max_retries=max_retries, backoff=backoff, max_backoff=max_backoff,
+                         retry_statuses=tuple(retry_statuses))
+
+
+def get_request_stats() -> tp.Dict[str, int]:
+    """
+    Counters of the current process: requests sent (including retries), retries and calls served by joining an
+    identical request already in flight
+
+    :return: copy of the counters
+    :rtype: tp.Dict[str, int]
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_request_stats():
+    with _stats_lock:
+        _stats.update(requests=0, retries=0, coalesced=0)
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _retry_delay(attempt: int, error: Exception) -> tp.Optional[float]:
+    """
+    delay before retrying a request which failed with error, None when it should not be retried
+    """
+    transient = isinstance(error, httpx.TransportError) or (
+            isinstance(error, httpx.HTTPStatusError) and error.response.status_code in _retry_config['retry_statuses'])
+    if not transient or attempt >= _retry_config['max_retries']:
+        return None
+    logger.warning(f'retrying request after {error!r} (attempt {attempt + 1}/{_retry_config["max_retries"]})')
+    _count('retries')
+    return random.uniform(0, min(_retry_config['max_backoff'], _retry_config['backoff'] * 2 ** attempt))
+
+
+def _send(method: str, **params):
+    attempt = 0
+    while True:
+        _count('requests')
+        try:
+            r = getattr(get_client(), method)(**params)
+            r.raise_for_status()
+            return r.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            delay = _retry_delay(attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+async def _async_send(method: str, **params):
+    attempt = 0
+    while True:
+        _count('requests')
+        try:
+            r = await getattr(get_async_client(), method)(**params)
+            r.raise_for_status()
+            return r.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            delay = _retry_delay(attempt, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
+_JSON_ITEM_END = re.compile(r'\s*[,\]]')
+
+
+def _iter_json_array(chunks: tp.Iterable[str]) -> tp.Iterator[tp.Any]:
+    """
+    Incrementally decodes a json array received in chunks, yielding its items as soon as they are complete. Only the
+    item being received is buffered
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, started = '', 0, False
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer = buffer[pos:] + (chunk or '')
+        pos = len(buffer) - len(buffer.lstrip()) if not started else 0
+        if not started:
+            if pos == len(buffer):
+                continue
+            if buffer[pos] != '[':
+                raise ValueError('response is not a json array')
+            started, pos = True, pos + 1
+        while True:
+            pos = _JSON_SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break
+            # an item is complete once followed by a delimiter, e.g. a number may continue in the next chunk
+            if not _JSON_ITEM_END.match(buffer, end):
+                if final:
+                    raise ValueError('invalid json array')
+                break
+            yield item
+            pos = end
+    raise ValueError('truncated json array')
+
+
+def _stream(method: str, **params) -> tp.Iterator[tp.Any]:
+    attempt, yielded = 0, False
+    while True:
+        _count('requests')
+        try:
+            with get_client().stream(method.upper(), **params) as r:
+                r.raise_for_status()
+                for item in _iter_json_array(r.iter_text()):
+                    yielded = True
+                    yield item
+                return
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            # only failures occurring before the first item was yielded are retried, a restarted request would yield
+            # the received items again
+            delay = None if yielded else _retry_delay(attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+class _InflightRequest:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
 
 def _perform_request(method: str, **params):
-    with httpx.Client(timeout=None) as client:
-        req = getattr(client, method)
+    cache = _cache
+    endpoint, key = ResponseCache.make_key(method, **params)
+    if cache is not None:
+        found, value = cache.get(endpoint, key)
+        if found:
+            return value
+
+    # identical requests issued concurrently by other threads share a single network request, every waiter getting
+    # its own copy of the response
+    with _inflight_lock:
+        inflight = _inflight.get(key)
+        leader = inflight is None
+        if leader:
+            inflight = _inflight[key] = _InflightRequest()
+        else:
+            inflight.waiters += 1
+    if not leader:
+        _count('coalesced')
+        inflight.done.wait()
+        if inflight.error is not None:
+            raise inflight.error
+        return copy.deepcopy(inflight.value)
 
-        r = req(**params)
-        r.raise_for_status()
-    return r.json()
+    try:
+        value = _send(method, **params)
+        if cache is not None:
+            cache.set(endpoint, key, value)
+        return value
+    except BaseException as e:
+        inflight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        if inflight.waiters and inflight.error is None:
+            # snapshot taken before the leader gets the response and may modify it
+            inflight.value = copy.deepcopy(value)
+        inflight.done.set()
+
+
+class _AsyncInflightRequest:
+    def __init__(self):
+        self.task: tp.Optional[asyncio.Future] = None
+        self.waiters = 0
+
+
+async def _async_perform_request(method: str, **params):
+    cache = _cache
+    endpoint, key = ResponseCache.make_key(method, **params)
+    if cache is not None:
+        found, value = cache.get(endpoint, key)
+        if found:
+            return value
+
+    # identical requests issued concurrently in the same event loop share a single network request, every waiter
+    # getting its own copy of the response
+    inflights = _async_inflight.setdefault(asyncio.get_running_loop(), {})
+    inflight = inflights.get(key)
+    if inflight is not None:
+        _count('coalesced')
+        inflight.waiters += 1
+        _, snapshot = await asyncio.shield(inflight.task)
+        return copy.deepcopy(snapshot)
+
+    async def send() -> tp.Tuple[tp.Any, tp.Any]:
+        try:
+            value = await _async_send(method, **params)
+            if cache is not None:
+                cache.set(endpoint, key, value)
+        finally:
+            del inflights[key]
+        # no waiter can join anymore, the snapshot is taken before the leader may modify the response
+        return value, copy.deepcopy(value) if inflight.waiters else None
+
+    inflight = inflights[key] = _AsyncInflightRequest()
+    inflight.task = asyncio.ensure_future(send())
+    return (await asyncio.shield(inflight.task))[0]
 
 
 def get_features_for_patients(col: str, feature_name: str, patients: tp.List[str] = None) -> tp.List[dict]:
@@ -21,6 +537,134 @@ def get_features_for_patients(col: str, feature_name: str, patients: tp.List[str
                             )
 
 
+def iter_features_for_patients(col: str, feature_name: str, patients: tp.List[str] = None) -> tp.Iterator[dict]:
+    """
+    Streaming counterpart of :func:`get_features_for_patients`, yielding the records while the response is received
+    rather than buffering and decoding the whole body. Streamed responses bypass the response cache and request
+    coalescing
+
+    :param col: collection ("bundle") of the feature
+    :type col: str
+    :param feature_name: name of the feature
+    :type feature_name: str
+    :param patients: patients to fetch the feature for, defaults to None (all patients)
+    :type patients: tp.List[str], optional
+    :return: iterator of feature records
+    :rtype: tp.Iterator[dict]
+    """
+    return _stream(method='post', url=f'{ADDR}/features_for_patients',
+                   json=dict(col=col, feature_name=feature_name, patients=patients))
+
+
+def get_feature_values(col: str, feature_name: str, patients: tp.List[str] = None,
+                       out: tp.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Streams the values of a feature directly into a float array, keeping memory flat regardless of the cohort size.
+    When ``patients`` is provided, values are aligned to it (NaN for missing patients), otherwise they are in the order
+    returned by the server
+
+    >>> values = get_feature_values('GeneExpression', 'BRCA1', patients=['TCGA-GM-A2DN'])
+
+    :param col: collection ("bundle") of the feature
+    :type col: str
+    :param feature_name: name of the feature
+    :type feature_name: str
+    :param patients: patients to fetch the feature for, defaults to None (all patients)
+    :type patients: tp.List[str], optional
+    :param out: preallocated array to fill, it must hold one item per patient when ``patients`` is provided, defaults
+        to None
+    :type out: tp.Optional[np.ndarray], optional
+    :return: feature values, ``out`` when provided and large enough, truncated to the number of values received when
+        ``patients`` is not provided
+    :rtype: np.ndarray
+    """
+    records = iter_features_for_patients(col=col, feature_name=feature_name, patients=patients)
+    if patients is not None:
+        out = np.full(len(patients), np.nan) if out is None else out
+        assert len(out) == len(patients), 'out must hold one item per patient'
+        out.fill(np.nan)
+        rows = {patient: i for i, patient in enumerate(patients)}
+        for record in records:
+            out[rows[record['patient']]] = record['value']
+        return out
+
+    out = np.empty(1024) if out is None else out
+    n = 0
+    for record in records:
+        if n == len(out):
+            # grow geometrically when the preallocated array is too small
+            out = np.resize(out, max(2 * len(out), 1024))
+        out[n] = record['value']
+        n += 1
+    return out[:n]
+
+
+class FeatureTable(tp.NamedTuple):
+    """
+    Columnar feature values, every column is aligned to ``patients`` and holds NaN for missing values
+    """
+    patients: tp.List[str]
+    columns: tp.Dict[str, np.ndarray]
+
+    def to_matrix(self, feature_names: tp.Optional[tp.Sequence[str]] = None) -> np.ndarray:
+        """
+        Stacks the columns into a (patients x features) matrix
+
+        :param feature_names: columns to stack, defaults to all columns in insertion order
+        :type feature_names: tp.Optional[tp.Sequence[str]], optional
+        :return: float matrix
+        :rtype: np.ndarray
+        """
+        feature_names = list(self.columns) if feature_names is None else feature_names
+        matrix = np.empty((len(self.patients), len(feature_names)))
+        for j, name in enumerate(feature_names):
+            matrix[:, j] = self.columns[name]
+        return matrix
+
+
+def get_features_for_patients_batch(col: str, feature_names: tp.Sequence[str], patients: tp.List[str] = None,
+                                    chunk_size: int = 100) -> FeatureTable:
+    """
+    Fetches many features of a set of patients in ``ceil(len(feature_names) / chunk_size)`` requests instead of one
+    request per feature
+
+    >>> table = get_features_for_patients_batch('GeneExpression', ['BRCA1', 'TP53'], patients=['TCGA-GM-A2DN'])
+    >>> table.columns['BRCA1'].shape
+    (1,)
+
+    :param col: collection ("bundle") of the features
+    :type col: str
+    :param feature_names: names of the features to fetch
+    :type feature_names: tp.Sequence[str]
+    :param patients: patients to fetch the features for, defaults to None (all patients, in the order returned by the
+        server)
+    :type patients: tp.List[str], optional
+    :param chunk_size: maximal number of features per request, defaults to 100
+    :type chunk_size: int, optional
+    :return: feature values aligned to the patients
+    :rtype: :class:`FeatureTable`
+    """
+    feature_names = list(feature_names)
+    records = []
+    for start in range(0, len(feature_names), chunk_size):
+        records.extend(_perform_request(method='post', url=f'{ADDR}/features_for_patients_batch',
+                                        json=dict(col=col, feature_names=feature_names[start:start + chunk_size],
+                                                  patients=patients)))
+    return _records_to_table(records, feature_names, patients)
+
+
+def _records_to_table(records: tp.Iterable[dict], feature_names: tp.List[str],
+                      patients: tp.Optional[tp.List[str]]) -> FeatureTable:
+    if patients is None:
+        records = list(records)
+        patients = list(dict.fromkeys(record['patient'] for record in records))
+    rows = {patient: i for i, patient in enumerate(patients)}
+    columns = {name: np.full(len(patients), np.nan) for name in feature_names}
+    for record in records:
+        columns[record['name']][rows[record['patient']]] = record['value']
+    return FeatureTable(patients=list(patients), columns=columns)
+
+
 def get_patients_by_mutation(mutation: str, mutation_status: bool) -> tp.List[str]:
     return _perform_request(method='get', url=f'{ADDR}/patients_by_mutation',
                             params=dict(mutation=mutation, mutation_status=mutation_status)
@@ -33,3 +677,51 @@ def get_patients_age(patients: tp.List[str]) -> tp.List[dict]:
 
 def get_feature_names(col: str) -> tp.List[str]:
     return _perform_request('get', url=f'{ADDR}/feature_names', params=dict(col=col))
+
+
+async def async_get_features_for_patients(col: str, feature_name: str,
+                                          patients: tp.List[str] = None) -> tp.List[dict]:
+    return await _async_perform_request(method='post', url=f'{ADDR}/features_for_patients',
+                                        json=dict(col=col, feature_name=feature_name, patients=patients)
+                                        )
+
+
+async def async_get_patients_by_mutation(mutation: str, mutation_status: bool) -> tp.List[str]:
+    return await _async_perform_request(method='get', url=f'{ADDR}/patients_by_mutation',
+                                        params=dict(mutation=mutation, mutation_status=mutation_status)
+                                        )
+
+
+async def async_get_patients_age(patients: tp.List[str]) -> tp.List[dict]:
+    return await _async_perform_request(method='post', url=f'{ADDR}/patients_age', json=patients)
+
+
+async def async_get_feature_names(col: str) -> tp.List[str]:
+    return await _async_perform_request('get', url=f'{ADDR}/feature_names', params=dict(col=col))
+
+
+async def gather_features_for_patients(features: tp.Iterable[tp.Tuple[str, str]], patients: tp.List[str] = None,
+                                       max_concurrency: int = 16) -> tp.List[tp.List[dict]]:
+    """
+    Fetches many features concurrently over the pooled async client, with at most ``max_concurrency`` requests in
+    flight at any time
+
+    >>> pairs = [('GeneExpression', 'BRCA1'), ('GeneExpression', 'TP53')]
+    >>> responses = asyncio.run(gather_features_for_patients(pairs, patients=['TCGA-GM-A2DN']))
+
+    :param features: (col, feature_name) pairs to fetch
+    :type features: tp.Iterable[tp.Tuple[str, str]]
+    :param patients: patients to fetch the features for, defaults to None (all patients)
+    :type patients: tp.List[str], optional
+    :param max_concurrency: maximal number of concurrent requests, defaults to 16
+    :type max_concurrency: int, optional
+    :return: the response of every requested feature, in the order of ``features``
+    :rtype: tp.List[tp.List[dict]]
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(col: str, feature_name: str) -> tp.List[dict]:
+        async with semaphore:
+            return await async_get_features_for_patients(col=col, feature_name=feature_name, patients=patients)
+
+    return await asyncio.gather(*(fetch(col, feature_name) for col, feature_name in features))
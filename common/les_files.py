@@ -1,5 +1,12 @@
-import numpy as np
+import hashlib
+import io
+import os
+import time
 import typing as tp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+import numpy as np
 
 from loguru import logger
 
@@ -80,12 +87,14 @@ def read_les_file_data(arr: tp.Union[str, bytes], header: tp.List[tp.Tuple[int,
     return output
 
 
-def read_all_maps_from_les_file(arr: tp.Union[str, bytes]) -> tp.List[dict]:
+def read_all_maps_from_les_file(arr: tp.Union[str, bytes], sparse: bool = False) -> tp.List[dict]:
     """
     Reads all segmentation maps from the provided file into a list of headers and segmentations
 
     :param arr: array of data or a path to a les file containing data to be read
     :type arr: tp.Union[str, bytes]
+    :param sparse: if True, segmentation maps are returned as :class:`SparseLesionMask`, defaults to False
+    :type sparse: bool, optional
     :return: list of 3D segmentation maps
     :rtype: tp.List[dict]
     """
@@ -104,7 +113,615 @@ def read_all_maps_from_les_file(arr: tp.Union[str, bytes]) -> tp.List[dict]:
         offset += 12
 
         data = read_les_file_data(arr, header, offset=offset)
+        if sparse:
+            data = SparseLesionMask.from_dense(data, header)
 
         segmentation_maps.append({'header': header, 'data': data})
 
         offset += _get_data_length(header)
+
+
+_HEADER_DTYPE = np.dtype('<u2')
+_VOXEL_DTYPE = np.dtype(np.uint8)
+_HEADER_LENGTH = 6 * _HEADER_DTYPE.itemsize
+
+
+def _check_header_extents(values: np.ndarray):
+    """
+    Bounds are inclusive, so a lesion may span a single slice but a single row or column
+    """
+    (ymin, xmin, zmin), (ymax, xmax, zmax) = values
+    assert ymax > ymin and xmax > xmin and zmax >= zmin, \
+        'max values must be greater than min values in header (or equal for z)'
+
+
+def decode_les_file_header(arr: tp.Union[str, bytes], offset: int = 0) -> tp.List[tp.Tuple[int, int]]:
+    """
+    Vectorized counterpart of :func:`read_les_file_header`. The 6 uint16 values are read in a single
+    :func:`np.frombuffer` call using an explicit little endian dtype.
+
+    :param arr: array of data or a path to a les file containing data to be read
+    :type arr: tp.Union[str, bytes]
+    :param offset: offset value from the beginning of the file defining the current segment, defaults to 0
+    :type offset: int, optional
+    :return: list of start end pairs ordered as (y, x, z)
+    :rtype: tp.List[tp.Tuple[int, int]]
+    """
+    arr = _parse_arr(arr)
+    assert len(arr) - offset >= _HEADER_LENGTH, 'not enough bytes left to read a header'
+    values = np.frombuffer(arr, dtype=_HEADER_DTYPE, count=6, offset=offset).astype(np.int64).reshape(2, 3)
+    _check_header_extents(values)
+
+    # returns ((ymin, ymax), (xmin, xmax), (zmin, zmax))
+    return [(int(values[0, i]), int(values[1, i])) for i in range(3)]
+
+
+def decode_les_file_data(arr: tp.Union[str, bytes], header: tp.List[tp.Tuple[int, int]],
+                         offset: tp.Optional[int] = 12) -> np.ndarray:
+    """
+    Vectorized counterpart of :func:`read_les_file_data`. The voxels are returned as a uint8 view into the source
+    buffer, no bytes are copied. Since the view shares memory with ``arr``, it is read-only when ``arr`` is a
+    :class:`bytes` object; call ``.copy()`` on the result if it needs to be modified.
+
+    :param arr: raw bytes array of a les file
+    :type arr: bytes
+    :param header: header of the current segmentation map
+    :type header: List[Tuple[int, int]]
+    :param offset: offset value from which the reading should begin, defaults to 12
+    :type offset: int, optional
+    :return: 3D uint8 array corresponding to different slices of the segmentation map
+    :rtype: np.array
+    """
+    arr = _parse_arr(arr)
+    assert offset >= _HEADER_LENGTH, 'offset must be greater than 12 bytes, the length of the first header in the file'
+    length = int(_get_data_length(header))
+    assert len(arr) - offset >= length, 'number of bytes to read must the length defined by the header'
+
+    output = np.frombuffer(arr, dtype=_VOXEL_DTYPE, count=length, offset=offset).reshape(_get_data_shape(header))
+    return output.transpose((0, 2, 1))
+
+
+def decode_all_maps_from_les_file(arr: tp.Union[str, bytes], sparse: bool = False) -> tp.List[dict]:
+    """
+    Vectorized counterpart of :func:`read_all_maps_from_les_file`. Returns the same headers and segmentation maps,
+    with every map being a uint8 view into the file buffer (see :func:`decode_les_file_data`)
+
+    :param arr: array of data or a path to a les file containing data to be read
+    :type arr: tp.Union[str, bytes]
+    :param sparse: if True, segmentation maps are returned as :class:`SparseLesionMask`, defaults to False
+    :type sparse: bool, optional
+    :return: list of 3D segmentation maps
+    :rtype: tp.List[dict]
+    """
+    arr = _parse_arr(arr)
+    offset = 0
+
+    segmentation_maps = []
+
+    while offset < len(arr):
+        header = decode_les_file_header(arr, offset=offset)
+        offset += _HEADER_LENGTH
+
+        data = decode_les_file_data(arr, header, offset=offset)
+        if sparse:
+            data = SparseLesionMask.from_dense(data, header)
+
+        segmentation_maps.append({'header': header, 'data': data})
+
+        offset += int(_get_data_length(header))
+
+    return segmentation_maps
+
+
+class SparseLesionMask:
+    """
+    Run-length encoded binary lesion mask. Every run is stored as a (z, y, x start, length) row of uint16 values in
+    absolute image coordinates, i.e. 8 bytes per run of foreground voxels along the x axis instead of one byte per voxel
+    of the header cuboid. Masks coming from different headers can therefore be combined directly.
+
+    >>> maps = read_all_maps_from_les_file('resources/TCGA-AO-A0JI-1.les', sparse=True)
+    >>> mask = maps[0]['data']
+    >>> mask.voxel_count
+    311
+    >>> mask.bounding_box
+    [(101, 114), (115, 127), (19, 22)]
+    >>> mask.to_dense(maps[0]['header']).shape
+    (4, 16, 14)
+
+    :param runs: array of shape (n_runs, 4) with (z, y, x start, length) rows
+    :type runs: np.ndarray
+    """
+    _SHIFT = 16
+
+    def __init__(self, runs: np.ndarray):
+        self.runs = np.asarray(runs, dtype=_HEADER_DTYPE).reshape(-1, 4)
+
+    @classmethod
+    def from_dense(cls, data: np.ndarray, header: tp.List[tp.Tuple[int, int]]) -> 'SparseLesionMask':
+        """
+        Encodes a segmentation map, as returned by :func:`read_les_file_data`, into runs. Any non zero voxel is
+        considered part of the lesion
+
+        :param data: 3D segmentation map ordered as (z, y, x)
+        :type data: np.ndarray
+        :param header: header of the segmentation map
+        :type header: List[Tuple[int, int]]
+        :return: run-length encoded mask
+        :rtype: :class:`SparseLesionMask`
+        """
+        nz, ny, nx = data.shape
+        padded = np.zeros((nz * ny, nx + 2), dtype=np.int8)
+        padded[:, 1:-1] = data.reshape(nz * ny, nx) != 0
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+
+        origin = np.array([header[2][0], header[0][0], header[1][0]])
+        runs = np.stack([rows // ny + origin[0], rows % ny + origin[1], starts + origin[2], ends - starts], axis=1)
+        return cls(runs)
+
+    @classmethod
+    def _from_keys(cls, keys: np.ndarray) -> 'SparseLesionMask':
+        if not len(keys):
+            return cls(np.empty((0, 4)))
+        rows = keys >> cls._SHIFT
+        breaks = np.flatnonzero((np.diff(keys) != 1) | (np.diff(rows) != 0)) + 1
+        starts = np.concatenate([[0], breaks])
+        lengths = np.diff(np.concatenate([starts, [len(keys)]]))
+        start_keys = keys[starts]
+        return cls(np.stack([start_keys >> (2 * cls._SHIFT), rows[starts] & 0xFFFF, start_keys & 0xFFFF, lengths],
+                            axis=1))
+
+    def _keys(self) -> np.ndarray:
+        """
+        sorted int64 keys of all foreground voxels, packed as (z << 32) | (y << 16) | x
+        """
+        runs = self.runs.astype(np.int64)
+        lengths = runs[:, 3]
+        start_keys = (runs[:, 0] << (2 * self._SHIFT)) | (runs[:, 1] << self._SHIFT) | runs[:, 2]
+        run_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.sort(np.repeat(start_keys, lengths) + run_offsets)
+
+    def __len__(self) -> int:
+        return self.voxel_count
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, SparseLesionMask) and np.array_equal(self._keys(), other._keys())
+
+    def __or__(self, other: 'SparseLesionMask') -> 'SparseLesionMask':
+        return self.union(other)
+
+    def __and__(self, other: 'SparseLesionMask') -> 'SparseLesionMask':
+        return self.intersection(other)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(runs={len(self.runs)}, voxels={self.voxel_count})'
+
+    @property
+    def nbytes(self) -> int:
+        return self.runs.nbytes
+
+    @property
+    def voxel_count(self) -> int:
+        """
+        Number of foreground voxels
+        """
+        return int(self.runs[:, 3].astype(np.int64).sum())
+
+    @property
+    def bounding_box(self) -> tp.Optional[tp.List[tp.Tuple[int, int]]]:
+        """
+        Tight bounding box of the foreground voxels as a header, ((ymin, ymax), (xmin, xmax), (zmin, zmax)), or None
+        for an empty mask
+        """
+        if not len(self.runs):
+            return None
+        runs = self.runs.astype(np.int64)
+        x_ends = runs[:, 2] + runs[:, 3] - 1
+        return [(int(runs[:, 1].min()), int(runs[:, 1].max())),
+                (int(runs[:, 2].min()), int(x_ends.max())),
+                (int(runs[:, 0].min()), int(runs[:, 0].max()))]
+
+    @property
+    def centroid(self) -> tp.Optional[tp.Tuple[float, float, float]]:
+        """
+        Center of mass of the foreground voxels ordered as (y, x, z), or None for an empty mask
+        """
+        count = self.voxel_count
+        if not count:
+            return None
+        runs = self.runs.astype(np.float64)
+        lengths = runs[:, 3]
+        x_centers = runs[:, 2] + (lengths - 1) / 2
+        return (float(lengths @ runs[:, 1] / count), float(lengths @ x_centers / count),
+                float(lengths @ runs[:, 0] / count))
+
+    def union(self, other: 'SparseLesionMask') -> 'SparseLesionMask':
+        return self._from_keys(np.union1d(self._keys(), other._keys()))
+
+    def intersection(self, other: 'SparseLesionMask') -> 'SparseLesionMask':
+        return self._from_keys(np.intersect1d(self._keys(), other._keys(), assume_unique=True))
+
+    def to_dense(self, header: tp.Optional[tp.List[tp.Tuple[int, int]]] = None) -> np.ndarray:
+        """
+        Densifies the mask into the cuboid defined by ``header``, laid out as the output of :func:`read_les_file_data`.
+        Foreground voxels outside of the cuboid are dropped
+
+        :param header: cuboid to densify into, defaults to the bounding box of the mask
+        :type header: List[Tuple[int, int]], optional
+        :return: 3D uint8 array ordered as (z, y, x)
+        :rtype: np.ndarray
+        """
+        header = header or self.bounding_box
+        if header is None:
+            return np.zeros((0, 0, 0), dtype=_VOXEL_DTYPE)
+        shape = (header[2][1] - header[2][0] + 1, header[0][1] - header[0][0] + 1, header[1][1] - header[1][0] + 1)
+        output = np.zeros(shape, dtype=_VOXEL_DTYPE)
+
+        keys = self._keys()
+        coords = np.stack([keys >> (2 * self._SHIFT), (keys >> self._SHIFT) & 0xFFFF, keys & 0xFFFF], axis=1)
+        coords -= np.array([header[2][0], header[0][0], header[1][0]])
+        coords = coords[((coords >= 0) & (coords < shape)).all(axis=1)]
+        output[coords[:, 0], coords[:, 1], coords[:, 2]] = 1
+        return output
+
+
+def _encode_les_map(header: tp.List[tp.Tuple[int, int]], data: tp.Union[np.ndarray, 'SparseLesionMask']) \
+        -> tp.Tuple[np.ndarray, np.ndarray]:
+    values = np.array(header, dtype=np.int64).T
+    assert values.shape == (2, 3), 'header must be composed of 3 (min, max) pairs'
+    _check_header_extents(values)
+    assert values.min() >= 0 and values.max() <= np.iinfo(_HEADER_DTYPE).max, 'header values must fit in uint16'
+
+    if isinstance(data, SparseLesionMask):
+        data = data.to_dense(header)
+    shape = _get_data_shape(header)
+    assert data.shape == (shape[0], shape[2], shape[1]), 'data shape must match the cuboid defined by the header'
+
+    # reverse the transpose done in read_les_file_data
+    voxels = np.ascontiguousarray(np.transpose(data, (0, 2, 1)), dtype=_VOXEL_DTYPE)
+    return values.astype(_HEADER_DTYPE), voxels
+
+
+def write_les_file(file: tp.Union[str, os.PathLike, tp.BinaryIO],
+                   maps: tp.Iterable[tp.Union[dict, tp.Tuple[tp.List[tp.Tuple[int, int]], np.ndarray]]]) -> int:
+    """
+    Writes segmentation maps in the les file layout. Maps are encoded and written one at a time, so ``maps`` may be a
+    generator and the file content is never held in memory as a whole
+
+    >>> maps = read_all_maps_from_les_file('resources/TCGA-AO-A0JI-1.les')
+    >>> f = io.BytesIO()
+    >>> write_les_file(f, maps)
+    908
+
+    :param file: path of the les file to write or a binary file handle
+    :type file: tp.Union[str, os.PathLike, tp.BinaryIO]
+    :param maps: segmentation maps as returned by :func:`read_all_maps_from_les_file` or (header, data) pairs. data may
+        also be a :class:`SparseLesionMask`
+    :type maps: tp.Iterable[tp.Union[dict, tp.Tuple[tp.List[tp.Tuple[int, int]], np.ndarray]]]
+    :return: number of bytes written
+    :rtype: int
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'wb') as f:
+            return write_les_file(f, maps)
+
+    written = 0
+    for item in maps:
+        header, data = (item['header'], item['data']) if isinstance(item, dict) else item
+        header_values, voxels = _encode_les_map(header, data)
+        written += file.write(header_values.tobytes())
+        written += file.write(memoryview(voxels).cast('B'))
+    return written
+
+
+def encode_les_file(maps: tp.Iterable[tp.Union[dict, tp.Tuple[tp.List[tp.Tuple[int, int]], np.ndarray]]]) -> bytes:
+    """
+    Encodes segmentation maps into the raw bytes of a les file, see :func:`write_les_file`
+
+    :param maps: segmentation maps as returned by :func:`read_all_maps_from_les_file` or (header, data) pairs
+    :type maps: tp.Iterable[tp.Union[dict, tp.Tuple[tp.List[tp.Tuple[int, int]], np.ndarray]]]
+    :return: raw bytes of a les file
+    :rtype: bytes
+    """
+    f = io.BytesIO()
+    write_les_file(f, maps)
+    return f.getvalue()
+
+
+def _as_maps(arr: tp.Union[str, bytes, tp.List[dict]]) -> tp.List[dict]:
+    return arr if isinstance(arr, list) else decode_all_maps_from_les_file(arr)
+
+
+def _header_slices(header: tp.List[tp.Tuple[int, int]], shape: tp.Sequence[int], margin: int = 0,
+                   origin: tp.Sequence[int] = (0, 0, 0)) -> tp.Tuple[tp.Tuple[slice, ...], tp.Tuple[slice, ...]]:
+    """
+    slices of the header cuboid, grown by margin, in a (z, y, x) volume starting at origin and in the lesion data,
+    clipped to the volume
+    """
+    starts = np.array([header[2][0], header[0][0], header[1][0]]) - origin
+    stops = np.array([header[2][1], header[0][1], header[1][1]]) + 1 - origin
+    volume_starts = np.clip(starts - margin, 0, shape)
+    volume_stops = np.clip(stops + margin, 0, shape)
+    volume_slices = tuple(slice(int(start), int(stop)) for start, stop in zip(volume_starts, volume_stops))
+    data_slices = tuple(slice(int(start), int(stop)) for start, stop in
+                        zip(np.maximum(volume_starts - starts, 0), np.maximum(volume_stops - starts, 0)))
+    return volume_slices, data_slices
+
+
+def compose_label_volume(arr: tp.Union[str, bytes, tp.List[dict]], shape: tp.Sequence[int], multi_label: bool = True,
+                         out: tp.Optional[np.ndarray] = None, origin: tp.Sequence[int] = (0, 0, 0)) -> np.ndarray:
+    """
+    Writes all segmentation maps of a les file into a single volume aligned with the images returned by
+    :func:`common.utils.read_dicom_images`, using the header ROI of every map as its position in the volume. Only the
+    output volume is allocated, lesions are written in place.
+
+    >>> volume = compose_label_volume('resources/TCGA-AO-A0JI-1.les', shape=(34, 256, 256))
+    >>> volume.shape, int(volume.max())
+    ((34, 256, 256), 1)
+
+    :param arr: array of data, a path to a les file or maps as returned by :func:`read_all_maps_from_les_file`
+    :type arr: tp.Union[str, bytes, tp.List[dict]]
+    :param shape: shape of the target volume ordered as (z, y, x)
+    :type shape: tp.Sequence[int]
+    :param multi_label: if True, the i-th lesion is labeled i + 1 (later lesions overwrite earlier ones where they
+        overlap), otherwise a boolean union of all lesions is returned, defaults to True
+    :type multi_label: bool, optional
+    :param out: preallocated volume to write into, defaults to None
+    :type out: tp.Optional[np.ndarray], optional
+    :param origin: (z, y, x) image coordinates of the first voxel of the output, allowing to compose only a patch of
+        the image, defaults to (0, 0, 0)
+    :type origin: tp.Sequence[int], optional
+    :return: label volume
+    :rtype: np.ndarray
+    """
+    maps = _as_maps(arr)
+    shape = tuple(shape)
+    if out is None:
+        dtype = (np.uint8 if len(maps) <= np.iinfo(np.uint8).max else np.uint16) if multi_label else bool
+        out = np.zeros(shape, dtype=dtype)
+    assert out.shape == shape, 'out must match the requested volume shape'
+
+    for label, item in enumerate(maps, start=1):
+        volume_slices, data_slices = _header_slices(item['header'], shape, origin=origin)
+        region = out[volume_slices]
+        lesion = item['data'] if isinstance(item['data'], np.ndarray) else item['data'].to_dense(item['header'])
+        lesion = lesion[data_slices] != 0
+        if multi_label:
+            np.copyto(region, label, where=lesion, casting='unsafe')
+        else:
+            np.logical_or(region, lesion, out=region, casting='unsafe')
+    return out
+
+
+def crop_lesion_patches(arr: tp.Union[str, bytes, tp.List[dict]], volume: np.ndarray, margin: int = 0) \
+        -> tp.List[dict]:
+    """
+    Crops a patch around every lesion of a les file instead of composing a full size label volume. The image patch is
+    a view into ``volume``, only the (small) mask patch is allocated.
+
+    :param arr: array of data, a path to a les file or maps as returned by :func:`read_all_maps_from_les_file`
+    :type arr: tp.Union[str, bytes, tp.List[dict]]
+    :param volume: image volume ordered as (z, y, x), e.g. the output of :func:`common.utils.read_dicom_images`
+    :type volume: np.ndarray
+    :param margin: number of voxels added around the header cuboid on every side, clipped to the volume, defaults to 0
+    :type margin: int, optional
+    :return: list of dictionaries with the header, the volume slices, the image patch and the uint8 mask patch
+    :rtype: tp.List[dict]
+    """
+    patches = []
+    for item in _as_maps(arr):
+        header = item['header']
+        volume_slices, _ = _header_slices(header, volume.shape, margin=margin)
+        lesion_slices, data_slices = _header_slices(header, volume.shape)
+
+        lesion = item['data'] if isinstance(item['data'], np.ndarray) else item['data'].to_dense(header)
+        mask = np.zeros(tuple(s.stop - s.start for s in volume_slices), dtype=_VOXEL_DTYPE)
+        mask[tuple(slice(ls.start - vs.start, ls.stop - vs.start)
+                   for ls, vs in zip(lesion_slices, volume_slices))] = lesion[data_slices] != 0
+
+        patches.append({'header': header, 'slices': volume_slices, 'image': volume[volume_slices], 'mask': mask})
+    return patches
+
+
+class LesSegment(tp.NamedTuple):
+    """
+    Index entry of a single segmentation map inside a les file
+    """
+    header: tp.List[tp.Tuple[int, int]]
+    offset: int
+    length: int
+
+
+class LesFile:
+    """
+    Lazily indexed reader for les files. The file is memory mapped and a single header-only pass builds an index of
+    the segmentation maps it contains, voxel data is decoded only when a map is accessed.
+
+    >>> les_file = LesFile('resources/TCGA-E2-A1IJ-1.les')
+    >>> len(les_file)
+    1
+    >>> les_file.headers
+    [[(94, 128), (109, 136), (97, 103)]]
+    >>> les_file[0]['data'].shape
+    (7, 35, 28)
+
+    :param path: pathway to a les file
+    :type path: str
+    """
+
+    def __init__(self, path: tp.Union[str, os.PathLike]):
+        self.path = os.fspath(path)
+        if os.path.getsize(self.path):
+            self._buffer = np.memmap(self.path, dtype=_VOXEL_DTYPE, mode='r')
+        else:
+            # an empty file can not be memory mapped
+            self._buffer = np.empty(0, dtype=_VOXEL_DTYPE)
+        self.index = self._build_index(self._buffer)
+
+    @staticmethod
+    def _build_index(buffer) -> tp.List[LesSegment]:
+        index = []
+        offset = 0
+        while offset < len(buffer):
+            header = decode_les_file_header(buffer, offset=offset)
+            offset += _HEADER_LENGTH
+            length = int(_get_data_length(header))
+            assert offset + length <= len(buffer), 'number of bytes to read must the length defined by the header'
+            index.append(LesSegment(header=header, offset=offset, length=length))
+            offset += length
+        return index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, item: int) -> dict:
+        segment = self.index[item]
+        return {'header': segment.header, 'data': self.read_data(item)}
+
+    def __iter__(self) -> tp.Iterator[dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path!r}, maps={len(self)})'
+
+    @property
+    def headers(self) -> tp.List[tp.List[tp.Tuple[int, int]]]:
+        """
+        Headers of all segmentation maps in the file, read from the index without touching the voxel data
+        """
+        return [segment.header for segment in self.index]
+
+    @property
+    def bounding_boxes(self) -> np.ndarray:
+        """
+        Headers of all segmentation maps as an integer array of shape (n_maps, 3, 2), ordered as (y, x, z) and
+        (min, max)
+        """
+        return np.array(self.headers, dtype=np.int64).reshape(len(self), 3, 2)
+
+    def read_data(self, item: int) -> np.ndarray:
+        """
+        Decodes the voxel data of a single segmentation map. The result is a read-only view into the memory mapped file
+
+        :param item: index of the segmentation map
+        :type item: int
+        :return: 3D uint8 array corresponding to different slices of the segmentation map
+        :rtype: np.array
+        """
+        segment = self.index[item]
+        return decode_les_file_data(self._buffer, segment.header, offset=segment.offset)
+
+    def close(self):
+        """
+        Drops the reference to the memory map. Arrays previously returned keep the mapping alive until released
+        """
+        self._buffer = np.empty(0, dtype=_VOXEL_DTYPE)
+        self.index = []
+
+
+class LesBatchStats:
+    """
+    Throughput counters of a :func:`load_les_files` run
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.cache_hits = 0
+        self.elapsed = 0.
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.elapsed if self.elapsed else 0.
+
+    @property
+    def cache_hit_rate(self) -> float:
+        return self.cache_hits / self.files if self.files else 0.
+
+    def __repr__(self):
+        return (f'{type(self).__name__}(files={self.files}, files_per_second={self.files_per_second:.1f}, '
+                f'cache_hit_rate={self.cache_hit_rate:.2f})')
+
+
+def _resolve_les_paths(source: str) -> tp.List[str]:
+    if os.path.isdir(source):
+        return sorted(glob(os.path.join(source, '*.les')))
+    return sorted(glob(source))
+
+
+def _save_cached_maps(path: str, maps: tp.List[dict]):
+    headers = np.array([item['header'] for item in maps], dtype=np.int64).reshape(len(maps), 3, 2)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, headers=headers, **{f'data_{i}': item['data'] for i, item in enumerate(maps)})
+    os.replace(tmp_path, path)
+
+
+def _load_cached_maps(path: str) -> tp.List[dict]:
+    with np.load(path) as cached:
+        headers = cached['headers']
+        return [{'header': [tuple(int(v) for v in axis) for axis in header], 'data': cached[f'data_{i}']}
+                for i, header in enumerate(headers)]
+
+
+def _load_les_file_cached(path: str, cache_dir: tp.Optional[str] = None) -> tp.Tuple[tp.List[dict], bool]:
+    arr = _parse_arr(path)
+    if cache_dir is None:
+        return decode_all_maps_from_les_file(arr), False
+
+    cache_path = os.path.join(cache_dir, f'{hashlib.sha256(arr).hexdigest()}.npz')
+    if os.path.exists(cache_path):
+        return _load_cached_maps(cache_path), True
+
+    maps = decode_all_maps_from_les_file(arr)
+    _save_cached_maps(cache_path, maps)
+    return maps, False
+
+
+def load_les_files(source: str, cache_dir: tp.Optional[str] = None, max_workers: tp.Optional[int] = None,
+                   stats: tp.Optional[LesBatchStats] = None) -> tp.Iterator[tp.Tuple[str, tp.List[dict]]]:
+    """
+    Decodes a batch of les files across a process pool, yielding the results as soon as each file is done (not in
+    input order). When ``cache_dir`` is provided, decoded maps are stored there as .npz files keyed by the sha256 of the
+    file content, so later runs skip decoding unchanged files entirely.
+
+    >>> stats = LesBatchStats()
+    >>> for path, maps in load_les_files('resources', cache_dir='/tmp/les_cache', stats=stats):
+    ...     pass
+    >>> stats.files
+    2
+
+    :param source: directory containing les files or a glob pattern
+    :type source: str
+    :param cache_dir: directory of the decoded maps cache, defaults to None (no caching)
+    :type cache_dir: tp.Optional[str], optional
+    :param max_workers: number of worker processes, defaults to the number of cpus
+    :type max_workers: tp.Optional[int], optional
+    :param stats: counters updated while iterating, holding files per second and cache hit rate, defaults to None
+    :type stats: tp.Optional[LesBatchStats], optional
+    :return: iterator of (path, segmentation maps) pairs
+    :rtype: tp.Iterator[tp.Tuple[str, tp.List[dict]]]
+    """
+    stats = stats if stats is not None else LesBatchStats()
+    paths = _resolve_les_paths(source)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {executor.submit(_load_les_file_cached, path, cache_dir): path for path in paths}
+        for future in as_completed(futures):
+            maps, cache_hit = future.result()
+            stats.files += 1
+            stats.cache_hits += cache_hit
+            stats.elapsed = time.perf_counter() - start
+            yield futures[future], maps
+
+    logger.info(stats)
@@ -1,15 +1,47 @@
+import hashlib
+import json
+import os
+import threading
+import time
 import typing as tp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pymongo
 import SimpleITK as sitk
 import numpy as np
 
 
-def read_dicom_images(dicom_dir: str) -> np.ndarray:
+class _ImageArrayView(np.ndarray):
+    """
+    ndarray view of a SimpleITK image buffer, keeping the image alive for as long as the view is referenced
+    """
+    _image = None
+
+
+def read_dicom_images(dicom_dir: str, dtype: tp.Optional[np.dtype] = None,
+                      window: tp.Optional[tp.Tuple[float, float]] = None, normalize: bool = False,
+                      copy: bool = True) -> np.ndarray:
     """
     Reads dicom images from a directories
 
+    The decoded image is accessed through :func:`sitk.GetArrayViewFromImage`, so casting, windowing and normalization
+    are applied while filling the single output array instead of on intermediate full size copies.
+
+    >>> nda = read_dicom_images('resources/dcm_files', dtype=np.float32, window=(0, 500), normalize=True)
+    >>> nda.dtype, float(nda.min()), float(nda.max())
+    (dtype('float32'), 0.0, 1.0)
+
     :param dicom_dir: pathway to a directory containing dicom files
     :type dicom_dir: str
+    :param dtype: output dtype, defaults to None (the pixel type chosen by the reader)
+    :type dtype: tp.Optional[np.dtype], optional
+    :param window: (low, high) intensity range to which values are clipped, defaults to None
+    :type window: tp.Optional[tp.Tuple[float, float]], optional
+    :param normalize: if True, linearly maps the window (or the image range when no window is given) to [0, 1],
+        requires a floating point dtype, defaults to False
+    :type normalize: bool, optional
+    :param copy: if False and no conversion is requested, returns a view of the SimpleITK image buffer instead of an
+        owned copy, defaults to True
+    :type copy: bool, optional
     :return: array stack of dicom images
     :rtype: :class:`np.ndarray`
     """
@@ -17,5 +49,405 @@ def read_dicom_images(dicom_dir: str) -> np.ndarray:
     dicom_names = reader.GetGDCMSeriesFileNames(dicom_dir)
     reader.SetFileNames(dicom_names)
     image = reader.Execute()
-    nda = sitk.GetArrayFromImage(image)
+    view = sitk.GetArrayViewFromImage(image)
+
+    if window is None and not normalize and (dtype is None or np.dtype(dtype) == view.dtype) and not copy:
+        nda = view.view(_ImageArrayView)
+        nda._image = image
+        return nda
+    return convert_intensities(view, dtype=dtype, window=window, normalize=normalize)
+
+
+def _saturation_limits(source: np.dtype, dtype: np.dtype) -> tp.Tuple[tp.Optional[int], tp.Optional[int]]:
+    """
+    Bounds of ``dtype`` which values of ``source`` may exceed, so unsafe casts saturate instead of wrapping around
+    """
+    if not np.issubdtype(dtype, np.integer) or np.can_cast(source, dtype):
+        return None, None
+    target = np.iinfo(dtype)
+    if not np.issubdtype(source, np.integer):
+        return target.min, target.max
+    source = np.iinfo(source)
+    return target.min if source.min < target.min else None, target.max if source.max > target.max else None
+
+
+def convert_intensities(view: np.ndarray, dtype: tp.Optional[np.dtype] = None,
+                        window: tp.Optional[tp.Tuple[float, float]] = None, normalize: bool = False) -> np.ndarray:
+    """
+    Casts, windows and normalizes an image into a single newly allocated array, see :func:`read_dicom_images`
+
+    :param view: image to convert, left untouched
+    :type view: np.ndarray
+    :param dtype: output dtype, values out of the range of a narrower integer dtype are saturated, defaults to None
+        (the dtype of ``view``)
+    :type dtype: tp.Optional[np.dtype], optional
+    :param window: (low, high) intensity range to which values are clipped, defaults to None
+    :type window: tp.Optional[tp.Tuple[float, float]], optional
+    :param normalize: if True, linearly maps the window (or the image range when no window is given) to [0, 1],
+        requires a floating point dtype, defaults to False
+    :type normalize: bool, optional
+    :return: converted image
+    :rtype: :class:`np.ndarray`
+    """
+    dtype = view.dtype if dtype is None else np.dtype(dtype)
+    assert not normalize or np.issubdtype(dtype, np.floating), 'normalize requires a floating point dtype'
+
+    low, high = window if window is not None else (None, None)
+    low, high = [bound if limit is None else limit if bound is None else function(bound, limit)
+                 for bound, limit, function in zip((low, high), _saturation_limits(view.dtype, dtype), (max, min))]
+    nda = np.empty(view.shape, dtype=dtype)
+    if low is not None or high is not None:
+        np.clip(view, low, high, out=nda, casting='unsafe')
+    else:
+        np.copyto(nda, view, casting='unsafe')
+
+    if normalize:
+        low, high = window if window is not None else (nda.min(), nda.max())
+        nda -= low
+        nda /= (high - low) or 1
     return nda
+
+
+_SERIES_INDEX_VERSION = 3
+
+
+def _read_dicom_series_info(dicom_dir: str, series_uid: str) -> dict:
+    file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dicom_dir, series_uid)
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_names[0])
+    reader.ReadImageInformation()
+    origin = reader.GetOrigin()
+    spacing = list(reader.GetSpacing())
+    if len(file_names) > 1:
+        # slice thickness is not reliable, use the distance between the first two slices instead
+        reader.SetFileName(file_names[1])
+        reader.ReadImageInformation()
+        spacing[2] = float(np.linalg.norm(np.subtract(reader.GetOrigin(), origin)))
+
+    return dict(directory=dicom_dir,
+                series_uid=series_uid,
+                file_names=list(file_names),
+                slice_count=len(file_names),
+                size=[*reader.GetSize()[:2], len(file_names)],
+                spacing=spacing,
+                origin=list(origin),
+                direction=list(reader.GetDirection()),
+                modality=reader.GetMetaData('0008|0060').strip() if reader.HasMetaDataKey('0008|0060') else None,
+                pixel_type=sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+                pixel_id=reader.GetPixelID(),
+                components=reader.GetNumberOfComponents())
+
+
+def _dicom_dir_signature(dicom_dir: str) -> str:
+    """
+    fingerprint of the directory listing, changes whenever a file is added, removed or modified
+    """
+    entries = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                     for entry in os.scandir(dicom_dir) if entry.is_file())
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def _load_series_index(index_path: tp.Optional[str]) -> dict:
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') == _SERIES_INDEX_VERSION:
+            return index
+    return dict(version=_SERIES_INDEX_VERSION, directories={})
+
+
+def _save_series_index(index_path: str, index: dict):
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def scan_dicom_series(root: str, index_path: tp.Optional[str] = None) -> tp.List[dict]:
+    """
+    Scans a directory tree for dicom series, reading only the dicom headers. Every series is described by its series
+    uid, sorted file names, slice count, size, spacing, origin, direction, modality and pixel type (all geometry
+    ordered as x, y, z like SimpleITK).
+    When ``index_path`` is provided, the results are persisted there as json keyed by directory path along with the
+    size and modification time of its files (as :class:`DicomVolumeCache`), and directories that did not change since
+    the previous scan are not read again.
+
+    >>> series = scan_dicom_series('resources/dcm_files')
+    >>> series[0]['slice_count'], series[0]['modality']
+    (34, 'MR')
+
+    :param root: pathway to a directory tree containing dicom files
+    :type root: str
+    :param index_path: pathway to a json file holding the series index, defaults to None (no persistence)
+    :type index_path: tp.Optional[str], optional
+    :return: list of series descriptions
+    :rtype: tp.List[dict]
+    """
+    index = _load_series_index(index_path)
+    directories = {}
+    for dicom_dir, _, file_names in os.walk(root):
+        if not file_names:
+            continue
+        dicom_dir = os.path.abspath(dicom_dir)
+        signature = _dicom_dir_signature(dicom_dir)
+        cached = index['directories'].get(dicom_dir)
+        if cached is not None and cached['signature'] == signature:
+            directories[dicom_dir] = cached
+            continue
+        series = [_read_dicom_series_info(dicom_dir, series_uid)
+                  for series_uid in sitk.ImageSeriesReader.GetGDCMSeriesIDs(dicom_dir)]
+        directories[dicom_dir] = dict(signature=signature, series=series)
+
+    if index_path:
+        root = os.path.abspath(root)
+        # keep entries of directories outside of the scanned tree
+        index['directories'] = {**{key: value for key, value in index['directories'].items()
+                                   if os.path.commonpath([root, key]) != root}, **directories}
+        _save_series_index(index_path, index)
+
+    return [series for directory in sorted(directories) for series in directories[directory]['series']]
+
+
+def read_dicom_series_slices(series: dict, start: int = 0, stop: tp.Optional[int] = None) -> np.ndarray:
+    """
+    Reads a range of slices of a series found by :func:`scan_dicom_series`. Only the files of the requested slices are
+    decoded
+
+    :param series: series description as returned by :func:`scan_dicom_series`
+    :type series: dict
+    :param start: index of the first slice, defaults to 0
+    :type start: int, optional
+    :param stop: index after the last slice, defaults to None (last slice of the series)
+    :type stop: tp.Optional[int], optional
+    :return: array stack of dicom images
+    :rtype: :class:`np.ndarray`
+    """
+    file_names = series['file_names'][start:stop]
+    assert file_names, 'requested slice range is empty'
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(file_names)
+    return sitk.GetArrayFromImage(reader.Execute())
+
+
+_worker_state = threading.local()
+
+
+class DicomLoadResult(tp.NamedTuple):
+    """
+    A decoded series yielded by :func:`load_dicom_series`
+    """
+    source: tp.Union[str, dict]
+    image: np.ndarray
+    nbytes: int
+    elapsed: float
+
+
+def _get_series_reader() -> sitk.ImageSeriesReader:
+    """
+    one reader per worker thread (or process), set up on first use
+    """
+    if not hasattr(_worker_state, 'reader'):
+        _worker_state.reader = sitk.ImageSeriesReader()
+    return _worker_state.reader
+
+
+def _series_nbytes(series: dict) -> int:
+    pixel = sitk.Image([1, 1], series['pixel_id'], series['components'])
+    return int(np.prod(series['size'])) * pixel.GetSizeOfPixelComponent() * pixel.GetNumberOfComponentsPerPixel()
+
+
+def _decode_dicom_series(file_names: tp.List[str]) -> tp.Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    reader = _get_series_reader()
+    reader.SetFileNames(file_names)
+    nda = sitk.GetArrayFromImage(reader.Execute())
+    return nda, time.perf_counter() - start
+
+
+def _first_dicom_series_info(dicom_dir: str) -> dict:
+    series_uids = sitk.ImageSeriesReader.GetGDCMSeriesIDs(dicom_dir)
+    assert series_uids, f'no dicom series found in {dicom_dir}'
+    return _read_dicom_series_info(dicom_dir, series_uids[0])
+
+
+def load_dicom_series(sources: tp.Iterable[tp.Union[str, dict]], max_workers: tp.Optional[int] = None,
+                      max_inflight_bytes: tp.Optional[int] = None,
+                      use_processes: bool = False) -> tp.Iterator[DicomLoadResult]:
+    """
+    Decodes many dicom series concurrently and yields every series as soon as it is decoded (not in input order).
+    New series are only submitted while the estimated size of the series being decoded or waiting to be yielded stays
+    below ``max_inflight_bytes``; a single series larger than the budget is still loaded, on its own.
+
+    Sources given as directories are resolved to their first series in the calling thread by reading the dicom
+    headers, pass the output of :func:`scan_dicom_series` to avoid that.
+
+    >>> results = list(load_dicom_series(['resources/dcm_files'], max_inflight_bytes=2 ** 30))
+    >>> results[0].image.shape
+    (34, 256, 256)
+
+    :param sources: directories containing dicom files or series descriptions as returned by :func:`scan_dicom_series`
+    :type sources: tp.Iterable[tp.Union[str, dict]]
+    :param max_workers: number of workers, defaults to the number of cpus
+    :type max_workers: tp.Optional[int], optional
+    :param max_inflight_bytes: cap on the estimated decoded bytes in flight, defaults to None (no cap)
+    :type max_inflight_bytes: tp.Optional[int], optional
+    :param use_processes: decode in a process pool rather than a thread pool, defaults to False
+    :type use_processes: bool, optional
+    :return: iterator of decoded series along with their size and decoding time
+    :rtype: tp.Iterator[:class:`DicomLoadResult`]
+    """
+    pending = iter(sources)
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    inflight = {}
+    inflight_bytes = 0
+    next_item = None
+
+    with executor_cls(max_workers=max_workers or os.cpu_count()) as executor:
+        while True:
+            while True:
+                if next_item is None:
+                    source = next(pending, None)
+                    if source is None:
+                        break
+                    series = source if isinstance(source, dict) else _first_dicom_series_info(source)
+                    next_item = (source, series, _series_nbytes(series))
+                _, series, nbytes = next_item
+                if inflight and max_inflight_bytes is not None and inflight_bytes + nbytes > max_inflight_bytes:
+                    break
+                inflight[executor.submit(_decode_dicom_series, series['file_names'])] = next_item
+                inflight_bytes += nbytes
+                next_item = None
+
+            if not inflight:
+                return
+
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, _, nbytes = inflight.pop(future)
+                nda, elapsed = future.result()
+                yield DicomLoadResult(source=source, image=nda, nbytes=nda.nbytes, elapsed=elapsed)
+                inflight_bytes -= nbytes
+
+
+class DicomVolumeCache:
+    """
+    On-disk cache of decoded dicom series. Every series is decoded once into a .npy file, along with a json sidecar
+    holding the geometry of the SimpleITK image, and later reads return a read-only :class:`np.memmap` without decoding.
+    Entries are invalidated when a file in the source directory is added, removed or modified, and the least recently
+    used entries are evicted once the cache grows beyond ``max_bytes``.
+
+    >>> cache = DicomVolumeCache('/tmp/dicom_cache')
+    >>> volume, meta = cache.get('resources/dcm_files')
+    >>> volume.shape, meta['spacing']
+    ((34, 256, 256), [0.703125, 0.703125, 3.0])
+
+    :param cache_dir: directory in which decoded series are stored
+    :type cache_dir: str
+    :param max_bytes: maximal total size of the cached arrays, defaults to None (unbounded)
+    :type max_bytes: tp.Optional[int], optional
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: tp.Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, dicom_dir: str) -> tp.Tuple[str, str]:
+        key = hashlib.sha1(os.path.abspath(dicom_dir).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.npy'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def _entries(self) -> tp.List[tp.Tuple[int, str, str, int]]:
+        """
+        (last access, array path, sidecar path, size) of every cached series
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            array_path = f'{meta_path[:-len(".json")]}.npy'
+            if os.path.exists(array_path):
+                entries.append((os.stat(meta_path).st_mtime_ns, array_path, meta_path, os.path.getsize(array_path)))
+        return entries
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry[3] for entry in self._entries())
+
+    def get(self, dicom_dir: str) -> tp.Tuple[np.memmap, dict]:
+        """
+        Returns the decoded series of ``dicom_dir``, decoding and storing it first when it is not cached or the
+        directory changed since it was cached
+
+        :param dicom_dir: pathway to a directory containing dicom files
+        :type dicom_dir: str
+        :return: memory mapped array stack of dicom images and its geometry (spacing, origin and direction)
+        :rtype: tp.Tuple[:class:`np.memmap`, dict]
+        """
+        array_path, meta_path = self._paths(dicom_dir)
+        signature = _dicom_dir_signature(dicom_dir)
+        if os.path.exists(meta_path) and os.path.exists(array_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['signature'] == signature:
+                # touching the sidecar marks the entry as recently used
+                os.utime(meta_path)
+                return np.load(array_path, mmap_mode='r'), meta
+
+        meta = self._store(dicom_dir, array_path, meta_path, signature)
+        self.evict()
+        return np.load(array_path, mmap_mode='r'), meta
+
+    def _store(self, dicom_dir: str, array_path: str, meta_path: str, signature: str) -> dict:
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(dicom_dir))
+        image = reader.Execute()
+
+        tmp_suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(array_path + tmp_suffix, 'wb') as f:
+            np.save(f, sitk.GetArrayViewFromImage(image))
+        os.replace(array_path + tmp_suffix, array_path)
+
+        meta = dict(source=os.path.abspath(dicom_dir), signature=signature,
+                    spacing=list(image.GetSpacing()), origin=list(image.GetOrigin()),
+                    direction=list(image.GetDirection()))
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + tmp_suffix, meta_path)
+        return meta
+
+    def evict(self):
+        """
+        Removes the least recently used series until the cache fits in ``max_bytes``
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(entry[3] for entry in entries)
+        # never evict the most recently used entry, it may have just been stored
+        for _, array_path, meta_path, size in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(meta_path)
+            os.remove(array_path)
+            total -= size
+
+    def invalidate(self, dicom_dir: str):
+        """
+        Removes the cached series of ``dicom_dir``, if any
+
+        :param dicom_dir: pathway to a directory containing dicom files
+        :type dicom_dir: str
+        """
+        for path in self._paths(dicom_dir):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        """
+        Removes all cached series
+        """
+        for _, array_path, meta_path, _ in self._entries():
+            os.remove(meta_path)
+            os.remove(array_path)
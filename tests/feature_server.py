@@ -0,0 +1,200 @@
+"""
+Local stand-in for the feature server queried by :mod:`common.fetcher_client`, serving deterministic synthetic data.
+Used by the tests and benchmarks to exercise the client offline.
+"""
+import json
+import threading
+import time
+import typing as tp
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FeatureData:
+    """
+    Synthetic cohort: every patient has an age, a mutation status per gene and a value per feature of every collection
+
+    :param n_patients: number of patients
+    :type n_patients: int
+    :param n_features: number of features in every collection
+    :type n_features: int
+    :param cols: names of the collections
+    :type cols: tp.Sequence[str]
+    """
+
+    def __init__(self, n_patients: int = 200, n_features: int = 50, cols: tp.Sequence[str] = ('GeneExpression',)):
+        self.patients = [f'TCGA-{i:04d}' for i in range(n_patients)]
+        self.features = {col: [f'{col}-{j}' for j in range(n_features)] for col in cols}
+
+    @staticmethod
+    def _hash(*keys) -> int:
+        return zlib.crc32('/'.join(map(str, keys)).encode())
+
+    def age(self, patient: str) -> int:
+        return 25 + self._hash('age', patient) % 60
+
+    def is_mutated(self, patient: str, mutation: str) -> bool:
+        return self._hash('mutation', mutation, patient) % 3 == 0
+
+    def value(self, col: str, feature_name: str, patient: str) -> float:
+        value = (self._hash(col, feature_name, patient) % 10000) / 1000
+        # features ending with 0 differ between early and late onset patients
+        if feature_name.endswith('0') and self.age(patient) < 45:
+            value += 5
+        return value
+
+    def patients_by_mutation(self, mutation: str, mutation_status: bool) -> tp.List[str]:
+        return [patient for patient in self.patients if self.is_mutated(patient, mutation) == mutation_status]
+
+    def patients_age(self, patients: tp.List[str]) -> tp.List[dict]:
+        return [dict(patient=patient, age=self.age(patient)) for patient in patients]
+
+    def features_for_patients(self, col: str, feature_name: str, patients: tp.Optional[tp.List[str]]) -> tp.List[dict]:
+        return self.features_for_patients_batch(col, [feature_name], patients)
+
+    def features_for_patients_batch(self, col: str, feature_names: tp.List[str],
+                                    patients: tp.Optional[tp.List[str]]) -> tp.List[dict]:
+        known = set(self.patients)
+        patients = self.patients if patients is None else [patient for patient in patients if patient in known]
+        return [dict(patient=patient, name=feature_name, value=self.value(col, feature_name, patient))
+                for feature_name in feature_names for patient in patients]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent in a single segment, avoiding delayed acks
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, payload, status: int = 200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.server.lock:
+            disconnecting = status == 200 and self.server.disconnects > 0
+            self.server.disconnects -= disconnecting
+        if disconnecting:
+            # the connection is dropped halfway through the body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def _dispatch(self, method: str):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        endpoint = url.path.rsplit('/', 1)[-1]
+        stats = self.server.stats
+        with self.server.lock:
+            stats['requests'] += 1
+            stats[endpoint] = stats.get(endpoint, 0) + 1
+            stats['inflight'] += 1
+            stats['max_inflight'] = max(stats['max_inflight'], stats['inflight'])
+
+        try:
+            time.sleep(self.server.delay)
+            with self.server.lock:
+                failing = self.server.failures > 0
+                self.server.failures -= failing
+            if failing:
+                return self._respond(dict(detail='Service Unavailable'), status=503)
+            handler = self.server.routes.get((method, endpoint))
+            if handler is None:
+                return self._respond(dict(detail='Not Found'), status=404)
+            self._respond(handler(params, body))
+        finally:
+            with self.server.lock:
+                stats['inflight'] -= 1
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class FeatureServer:
+    """
+    Threaded http server serving :class:`FeatureData` on a free local port, to be used as a context manager.
+    ``stats`` counts the opened connections and the requests, in total and per endpoint, along with the maximal number
+    of requests handled concurrently
+
+    :param data: served data, defaults to a :class:`FeatureData` with default arguments
+    :type data: tp.Optional[FeatureData], optional
+    :param delay: latency in seconds added to every request, defaults to 0
+    :type delay: float, optional
+
+    Setting :attr:`failures` makes the server answer that many of the following requests with a 503 status, and setting
+    :attr:`disconnects` makes it drop the connection halfway through the body of that many of the following responses
+    """
+
+    def __init__(self, data: tp.Optional[FeatureData] = None, delay: float = 0.):
+        self.data = data or FeatureData()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.stats = dict(connections=0, requests=0, inflight=0, max_inflight=0)
+        self._server.delay = delay
+        self._server.failures = 0
+        self._server.disconnects = 0
+        self._server.routes = self.routes()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def routes(self) -> tp.Dict[tp.Tuple[str, str], tp.Callable[[dict, tp.Any], tp.Any]]:
+        data = self.data
+        return {
+            ('GET', 'feature_names'): lambda params, body: data.features[params['col']],
+            ('GET', 'patients_by_mutation'): lambda params, body: data.patients_by_mutation(
+                params['mutation'], params['mutation_status'].lower() == 'true'),
+            ('POST', 'patients_age'): lambda params, body: data.patients_age(body),
+            ('POST', 'features_for_patients'): lambda params, body: data.features_for_patients(**body),
+            ('POST', 'features_for_patients_batch'): lambda params, body: data.features_for_patients_batch(**body),
+        }
+
+    @property
+    def addr(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api'
+
+    @property
+    def stats(self) -> dict:
+        return self._server.stats
+
+    @property
+    def failures(self) -> int:
+        return self._server.failures
+
+    @failures.setter
+    def failures(self, failures: int):
+        with self._server.lock:
+            self._server.failures = failures
+
+    @property
+    def disconnects(self) -> int:
+        return self._server.disconnects
+
+    @disconnects.setter
+    def disconnects(self, disconnects: int):
+        with self._server.lock:
+            self._server.disconnects = disconnects
+
+    def __enter__(self) -> 'FeatureServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,280 @@
+import itertools
+
+import numpy as np
+import pytest
+from scipy.stats import ks_2samp, mannwhitneyu
+
+import common.analytics
+import common.fetcher_client
+from common.analytics import ks_2samp_matrix, parallel_ks_2samp_matrix, analyze_bundle, significance_test
+from common.analytics import get_patients_split, sweep_bundles, permutation_test_matrix, adjust_pvalues, ResultStore
+from common.fetcher_client import close_client
+from tests.feature_server import FeatureServer, FeatureData
+
+
+@pytest.fixture(scope='module')
+def matrix():
+    rng = np.random.RandomState(0)
+    matrix = rng.randn(90, 300)
+    # ties, shifted features, missing values and columns without values in a group
+    matrix[:, ::3] = np.round(matrix[:, ::3])
+    matrix[:30, 1::5] += 1
+    matrix[rng.rand(*matrix.shape) < 0.05] = np.nan
+    matrix[:, 4] = np.nan
+    matrix[:30, 7] = np.nan
+    return matrix
+
+
+def _ks_2samp_per_feature(matrix, mask_1, mask_2, **kwargs):
+    results = []
+    for column in matrix.T:
+        data_1, data_2 = column[mask_1], column[mask_2]
+        data_1, data_2 = data_1[~np.isnan(data_1)], data_2[~np.isnan(data_2)]
+        results.append(tuple(ks_2samp(data_1, data_2, **kwargs)[:2]) if len(data_1) and len(data_2)
+                       else (np.nan, np.nan))
+    return np.array(results).T
+
+
+def test_ks_2samp_matrix(matrix):
+    mask_1 = np.arange(len(matrix)) < 30
+
+    statistics, pvalues = ks_2samp_matrix(matrix, mask_1, ~mask_1)
+
+    expected_statistics, expected_pvalues = _ks_2samp_per_feature(matrix, mask_1, ~mask_1)
+    np.testing.assert_allclose(statistics, expected_statistics, rtol=1e-12)
+    np.testing.assert_array_equal(pvalues, expected_pvalues)
+    assert np.isnan(pvalues[[4, 7]]).all()
+    assert np.nanmedian(pvalues[1::5]) < np.nanmedian(pvalues[2::5])
+
+
+def test_ks_2samp_matrix_asymp(matrix):
+    mask_1 = np.arange(len(matrix)) % 3 == 0
+    mask_2 = np.flatnonzero(np.arange(len(matrix)) % 3 == 1)
+
+    statistics, pvalues = ks_2samp_matrix(matrix, mask_1, mask_2, method='asymp')
+
+    expected_statistics, expected_pvalues = _ks_2samp_per_feature(matrix, mask_1, mask_2, method='asymp')
+    np.testing.assert_allclose(statistics, expected_statistics, rtol=1e-12)
+    np.testing.assert_allclose(pvalues, expected_pvalues, rtol=1e-10)
+
+
+def test_ks_2samp_matrix_raises_for_unknown_method(matrix):
+    with pytest.raises(AssertionError):
+        ks_2samp_matrix(matrix, [0, 1], [2, 3], method='exact')
+
+
+def test_parallel_ks_2samp_matrix(matrix):
+    mask_1 = np.arange(len(matrix)) < 30
+
+    for expected, result in zip(ks_2samp_matrix(matrix, mask_1, ~mask_1),
+                                parallel_ks_2samp_matrix(matrix, mask_1, ~mask_1, max_workers=3)):
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.fixture
+def feature_server(monkeypatch):
+    with FeatureServer(FeatureData(n_patients=150, n_features=120)) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        yield server
+    close_client()
+
+
+def test_analyze_bundle(feature_server):
+    early, late = get_patients_split('BRCA1', mutation_status=True)
+    expected = [significance_test(early, late, feature, 'GeneExpression', 'BRCA1', True)
+                for feature in feature_server.data.features['GeneExpression']]
+    requests = feature_server.stats['features_for_patients']
+
+    results = analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=2, chunk_size=50)
+
+    assert [result['feature_name'] for result in results] == [item['feature_name'] for item in expected]
+    np.testing.assert_allclose([result['pvalue'] for result in results], [item['pvalue'] for item in expected])
+    # the values of the whole bundle are fetched in bulk
+    assert requests == 240
+    assert feature_server.stats['features_for_patients'] == 240
+    assert feature_server.stats['features_for_patients_batch'] == 3
+    assert all(result['pvalue'] < 0.05 for result in results if result['feature_name'].endswith('0'))
+
+    corrected = analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=1,
+                               correction='bonferroni')
+    np.testing.assert_allclose([result['adjusted_pvalue'] for result in corrected],
+                               [min(result['pvalue'] * 120, 1) for result in results])
+
+
+def test_analyze_bundle_without_batch_endpoint(monkeypatch):
+    class Server(FeatureServer):
+        def routes(self):
+            routes = super().routes()
+            del routes['POST', 'features_for_patients_batch']
+            return routes
+
+    with Server(FeatureData(n_patients=150, n_features=30)) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        early, late = get_patients_split('BRCA1', mutation_status=True)
+        expected = [significance_test(early, late, feature, 'GeneExpression', 'BRCA1', True)
+                    for feature in server.data.features['GeneExpression']]
+
+        results = analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=1, chunk_size=50)
+        close_client()
+
+    np.testing.assert_allclose([result['pvalue'] for result in results], [item['pvalue'] for item in expected])
+    # a single failed batch request, then one request per feature over both groups
+    assert server.stats['features_for_patients_batch'] == 1
+    assert server.stats['features_for_patients'] == 60 + 30
+
+
+def test_sweep_bundles(monkeypatch, tmp_path):
+    with FeatureServer(FeatureData(n_patients=150, n_features=30, cols=('GeneExpression', 'Methylation'))) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        grid = dict(mutations=['BRCA1', 'TP53'], cols=['GeneExpression', 'Methylation'], age_cutoffs=[40, 50])
+        checkpoint_path = (tmp_path / 'sweep.jsonl').as_posix()
+
+        # interrupted during the second bundle, after which the checkpoint ends with a truncated row
+        interrupted = list(itertools.islice(sweep_bundles(**grid, max_workers=2, checkpoint_path=checkpoint_path),
+                                            8 * 30 + 45))
+        with open(checkpoint_path, 'a') as f:
+            f.write('{"mutation": "TP5')
+        assert server.stats['patients_by_mutation'] == 4
+        assert server.stats['patients_age'] == 1
+        assert server.stats['features_for_patients_batch'] == 2
+
+        rows = list(sweep_bundles(**grid, max_workers=2, checkpoint_path=checkpoint_path))
+        assert rows[:len(interrupted)] == interrupted
+        # only the second bundle is fetched again
+        assert server.stats['features_for_patients_batch'] == 3
+        assert len(rows) == 16 * 30
+        assert list(sweep_bundles(**grid, checkpoint_path=checkpoint_path)) == rows
+        assert server.stats['features_for_patients_batch'] == 3
+
+        for mutation, mutation_status, col, age_cutoff in [('TP53', False, 'Methylation', 40),
+                                                           ('BRCA1', True, 'GeneExpression', 50)]:
+            expected = analyze_bundle(mutation, mutation_status, col, age_cutoff=age_cutoff, max_workers=1)
+            assert [dict(row, col=col, age_cutoff=age_cutoff) for row in expected] == [
+                row for row in rows if (row['mutation'], row['mutation_status'], row['col'], row['age_cutoff']) ==
+                (mutation, mutation_status, col, age_cutoff)]
+    close_client()
+
+
+@pytest.mark.parametrize('statistic', ['ks', 'mannwhitney', 'mean_difference'])
+def test_permutation_test_matrix(matrix, statistic):
+    mask_1 = np.arange(len(matrix)) < 30
+    matrix = matrix[:, :60]
+
+    statistics, pvalues = permutation_test_matrix(matrix, mask_1, ~mask_1, statistic=statistic, n_permutations=500,
+                                                  chunk_size=64, max_workers=1)
+
+    for j in (0, 1, 2, 6):
+        data_1, data_2 = matrix[mask_1, j], matrix[~mask_1, j]
+        data_1, data_2 = data_1[~np.isnan(data_1)], data_2[~np.isnan(data_2)]
+        expected = dict(ks=lambda: ks_2samp(data_1, data_2).statistic,
+                        mannwhitney=lambda: abs(mannwhitneyu(data_1, data_2).statistic - len(data_1) * len(data_2) / 2),
+                        mean_difference=lambda: abs(data_1.mean() - data_2.mean()))[statistic]()
+        assert statistics[j] == pytest.approx(expected)
+    assert np.isnan(pvalues[[4, 7]]).all()
+    assert np.nanmax(pvalues[1::5]) < 0.05
+    assert 0.3 < np.nanmean(np.delete(pvalues, np.s_[1::5])) < 0.7
+    counts = pvalues[~np.isnan(pvalues)] * 501
+    np.testing.assert_allclose(counts, np.round(counts))
+
+    # the permutations only depend on the seed
+    _, parallel_pvalues = permutation_test_matrix(matrix, mask_1, ~mask_1, statistic=statistic, n_permutations=500,
+                                                  chunk_size=64, max_workers=3)
+    np.testing.assert_array_equal(parallel_pvalues, pvalues)
+    _, other_pvalues = permutation_test_matrix(matrix, mask_1, ~mask_1, statistic=statistic, n_permutations=500,
+                                               chunk_size=64, seed=1, max_workers=1)
+    assert not np.array_equal(other_pvalues, pvalues, equal_nan=True)
+
+
+@pytest.mark.parametrize('statistic', ['ks', 'mean_difference'])
+def test_permutation_test_matrix_missing_values(matrix, statistic):
+    mask_1 = np.arange(len(matrix)) < 30
+    valid = ~np.isnan(matrix[:, :20])
+    n1 = valid[:30].sum(axis=0)
+
+    # labels are only permuted between the patients with a value, keeping the size of the first group
+    priorities = np.random.default_rng(0).permuted(np.broadcast_to(np.arange(len(matrix)), (50, len(matrix))), axis=1)
+    labels = common.analytics._conditional_labels(priorities, valid, n1)
+    assert not (labels & ~valid).any()
+    assert (labels.sum(axis=1) == n1).all()
+    assert len({labels[:, :, j].tobytes() for j in range(20)}) > 1
+
+    # the other patients play no part, as if they were not in the matrix
+    kept = ~np.isnan(matrix[:, 2])
+    assert not kept.all()
+    _, pvalues = permutation_test_matrix(matrix[:, [0, 2]], mask_1, ~mask_1, statistic=statistic,
+                                         n_permutations=2000, max_workers=1)
+    _, expected = permutation_test_matrix(matrix[kept][:, [2]], mask_1[kept], ~mask_1[kept], statistic=statistic,
+                                          n_permutations=2000, max_workers=1)
+    assert pvalues[1] == pytest.approx(expected[0], abs=0.03)
+
+    with pytest.raises(AssertionError):
+        permutation_test_matrix(matrix, mask_1, ~mask_1, n_permutations=0)
+
+
+def test_permutation_test_matrix_agrees_with_ks_2samp(matrix):
+    mask_1 = np.arange(len(matrix)) < 30
+
+    _, pvalues = permutation_test_matrix(matrix, mask_1, ~mask_1, n_permutations=2000, max_workers=2)
+
+    _, expected = ks_2samp_matrix(matrix, mask_1, ~mask_1)
+    # the exact distribution of ks_2samp does not account for the ties of every third feature
+    without_ties = np.arange(matrix.shape[1]) % 3 != 0
+    assert np.nanmax(np.abs(pvalues - expected)[without_ties]) < 0.06
+
+
+def test_adjust_pvalues():
+    pvalues = np.array([0.01, 0.04, np.nan, 0.03, 0.005])
+
+    np.testing.assert_allclose(adjust_pvalues(pvalues), [0.02, 0.04, np.nan, 0.04, 0.02])
+    np.testing.assert_allclose(adjust_pvalues(pvalues, method='bonferroni'), [0.04, 0.16, np.nan, 0.12, 0.02])
+    np.testing.assert_allclose(adjust_pvalues([0.8, 0.9]), [0.9, 0.9])
+
+
+def test_result_store(feature_server, monkeypatch, tmp_path):
+    store = ResultStore((tmp_path / 'results.sqlite').as_posix())
+    results = analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=1, store=store)
+    assert (store.hits, store.misses) == (0, 120)
+
+    assert analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=1, store=store) == results
+    assert (store.hits, store.misses) == (120, 120)
+
+    # only the changed feature is tested again
+    value = feature_server.data.value
+    monkeypatch.setattr(feature_server.data, 'value', lambda col, feature_name, patient: value(
+        col, feature_name, patient) * (2 if feature_name == 'GeneExpression-3' else 1))
+    changed = analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=2, store=store)
+    assert (store.hits, store.misses) == (239, 121)
+    assert changed[:3] + changed[4:] == results[:3] + results[4:]
+    assert changed[3] == analyze_bundle('BRCA1', mutation_status=True, col='GeneExpression', max_workers=1)[3]
+
+    grid = dict(mutations=['BRCA1'], cols=['GeneExpression'], mutation_statuses=[True], age_cutoffs=[45, 50])
+    rows = list(sweep_bundles(**grid, max_workers=2, store=store))
+    assert (store.hits, store.misses) == (359, 241)
+    assert [dict(row, col='GeneExpression', age_cutoff=45) for row in changed] == rows[:120]
+    assert list(sweep_bundles(**grid, max_workers=2, store=store)) == rows
+    assert (store.hits, store.misses) == (599, 241)
+    store.close()
+
+    store = ResultStore(store.path)
+    top_hits = store.top_hits(n=5, col='GeneExpression', mutation_status=True, age_cutoff=45)
+    assert [hit['pvalue'] for hit in top_hits] == sorted(row['pvalue'] for row in changed)[:5]
+    assert all(hit['feature_name'].endswith('0') and hit['mutation_status'] is True for hit in top_hits)
+    assert len(store.top_hits(n=1000)) == 240
+    assert len(store.top_hits(n=1000, latest=False)) == 241
+    assert all(hit['pvalue'] <= 0.01 for hit in store.top_hits(n=1000, max_pvalue=0.01))
+    store.close()
+
+
+def test_result_store_latest_missing_pvalue(tmp_path, monkeypatch):
+    store = ResultStore((tmp_path / 'results.sqlite').as_posix())
+    job = ('BRCA1', True, 'GeneExpression', 45)
+    monkeypatch.setattr(common.analytics.time, 'time', lambda: 1.)
+    store.put(*job, ['feature-0', 'feature-1'], ['old', 'old'], [1e-6, 0.5])
+    # the newest result of feature-0 has no p-value, e.g. its values are all missing in a group
+    monkeypatch.setattr(common.analytics.time, 'time', lambda: 2.)
+    store.put(*job, ['feature-0'], ['new'], [np.nan])
+
+    assert [hit['feature_name'] for hit in store.top_hits()] == ['feature-1']
+    assert store.top_hits(max_pvalue=0.01) == []
+    assert [hit['fingerprint'] for hit in store.top_hits(latest=False)] == ['old', 'old']
+    store.close()
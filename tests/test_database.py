@@ -1,10 +1,15 @@
+import asyncio
+import itertools
 import os
+import typing as tp
 from glob import glob
 from pathlib import Path
 
+import numpy as np
 import pytest
 from bson import json_util
 
+import common.database
 from common.database import *
 import mongoengine
 import mongomock
@@ -36,3 +41,226 @@ def test_init_cached_database():
 def test_connect_to_database(db_config: dict):
     db = connect_to_database(db_config=db_config)
     assert db['segmentation_files'].find().alive
+
+
+@pytest.fixture
+def features_db():
+    db = init_cached_database(connection_string='mongomock://localhost', db_name='features', alias='features')
+    db['GeneExpression'].drop()
+    # every sample misses the feature matching its index, patient 3 has two samples
+    db['GeneExpression'].insert_many([
+        dict(sample=f'sample-{i}', patient=f'patient-{min(i, 3)}', name=f'feature-{j}', value=float(10 * i + j))
+        for i in range(5) for j in range(4) if i != j])
+    return db
+
+
+def test_fetch_collection_as_matrix(features_db):
+    table = fetch_collection_as_matrix('GeneExpression', batch_size=3, db=features_db)
+
+    assert table.samples == [f'sample-{i}' for i in range(5)]
+    assert table.patients == ['patient-0', 'patient-1', 'patient-2', 'patient-3', 'patient-3']
+    assert table.feature_names == ['feature-1', 'feature-2', 'feature-3', 'feature-0']
+    expected = [[np.nan if i == j else 10. * i + j for j in (1, 2, 3, 0)] for i in range(5)]
+    np.testing.assert_array_equal(table.matrix, expected)
+
+
+def test_fetch_collection_as_matrix_filters(features_db):
+    table = fetch_collection_as_matrix('GeneExpression', patients=['patient-1', 'patient-3'],
+                                       feature_names=['feature-3', 'feature-1'], db=features_db)
+
+    assert table.samples == ['sample-1', 'sample-3', 'sample-4']
+    np.testing.assert_array_equal(table.matrix, [[13., np.nan], [np.nan, 31.], [43., 41.]])
+
+    frame = fetch_collection_as_matrix('GeneExpression', feature_names=['feature-0'], as_frame=True, db=features_db)
+    assert list(frame.columns) == ['patient', 'sample', 'feature-0']
+    assert frame['feature-0'].tolist() == [10., 20., 30., 40.]
+
+
+class _AsyncCursor:
+    """
+    Motor-like cursor over a mongomock cursor, mongomock not supporting motor
+    """
+
+    def __init__(self, cursor, stats: dict, batch_size: tp.Optional[int] = None):
+        self._cursor = cursor
+        self._stats = stats
+        self._batch_size = batch_size or 101
+
+    async def to_list(self, length: int) -> tp.List[dict]:
+        self._stats['inflight'] += 1
+        self._stats['max_inflight'] = max(self._stats['max_inflight'], self._stats['inflight'])
+        await asyncio.sleep(0.001)
+        self._stats['inflight'] -= 1
+        self._stats['batches'] += 1
+        return list(itertools.islice(self._cursor, length))
+
+    async def __aiter__(self) -> tp.AsyncIterator[dict]:
+        while True:
+            documents = await self.to_list(self._batch_size)
+            if not documents:
+                return
+            for document in documents:
+                yield document
+
+
+class _AsyncCollection:
+    def __init__(self, col, stats: dict):
+        self._col = col
+        self._stats = stats
+
+    def find(self, *args, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self._col.find(*args, **kwargs), self._stats)
+
+    def aggregate(self, pipeline: tp.List[dict], batchSize: tp.Optional[int] = None, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self._col.aggregate(pipeline), self._stats, batch_size=batchSize)
+
+
+class _AsyncDatabase:
+    def __init__(self, db):
+        self._db = db
+        self.stats = dict(batches=0, inflight=0, max_inflight=0)
+
+    def __getitem__(self, col: str) -> _AsyncCollection:
+        return _AsyncCollection(self._db[col], self.stats)
+
+
+def test_async_fetch_collection_as_table(features_db, monkeypatch):
+    # mongomock does not support $mergeObjects, the pivoted data is kept in a nested document instead
+    table_pipeline = common.database._table_pipeline
+    monkeypatch.setattr(common.database, '_table_pipeline', lambda patients: table_pipeline(patients)[:3])
+    features_db['Methylation'].drop()
+    features_db['Methylation'].insert_many([dict(sample=f'sample-{i}', patient=f'patient-{i}', name='feature-0',
+                                                 value=float(i)) for i in range(6)])
+    async_db = _AsyncDatabase(features_db)
+
+    async def fetch(col: str) -> tp.List[dict]:
+        rows = async_fetch_collection_as_table(col, batch_size=2, db=async_db)
+        # rows are yielded as soon as the first batch is received
+        first = await rows.__anext__()
+        assert async_db.stats['batches'] <= 2
+        return [first] + [row async for row in rows]
+
+    async def run() -> tp.List[tp.List[dict]]:
+        return await asyncio.gather(fetch('GeneExpression'), fetch('Methylation'))
+
+    gene_expression, methylation = asyncio.run(run())
+
+    # both collections are fetched concurrently
+    assert async_db.stats['max_inflight'] == 2
+    assert async_db.stats['batches'] == 3 + 1 + 3 + 1
+    assert [row['sample'] for row in gene_expression] == [f'sample-{i}' for i in range(5)]
+    assert gene_expression[4]['data'] == {'feature-0': 40., 'feature-1': 41., 'feature-2': 42., 'feature-3': 43.}
+    assert [row['data'] for row in methylation] == [{'feature-0': float(i)} for i in range(6)]
+
+
+def test_async_fetch_collection_as_matrix(features_db):
+    async_db = _AsyncDatabase(features_db)
+
+    table = asyncio.run(async_fetch_collection_as_matrix('GeneExpression', batch_size=3, db=async_db))
+
+    expected = fetch_collection_as_matrix('GeneExpression', db=features_db)
+    assert table.samples == expected.samples and table.feature_names == expected.feature_names
+    np.testing.assert_array_equal(table.matrix, expected.matrix)
+    assert async_db.stats['batches'] == 7
+
+
+def test_gather_collections_as_matrix(features_db):
+    async_db = _AsyncDatabase(features_db)
+    queries = [dict(col='GeneExpression', patients=[f'patient-{i}'], feature_names=['feature-0', 'feature-2'])
+               for i in range(4)] + [dict(col='GeneExpression', feature_names=['feature-1'])]
+
+    frame = asyncio.run(gather_collections_as_matrix(queries, max_concurrency=3, batch_size=2, as_frame=True,
+                                                     db=async_db))
+
+    assert async_db.stats['max_inflight'] == 3
+    expected = fetch_collection_as_matrix('GeneExpression', feature_names=['feature-0', 'feature-2', 'feature-1'],
+                                          as_frame=True, db=features_db)
+    assert frame.sort_values('sample').reset_index(drop=True).equals(expected)
+
+
+def test_merge_tables():
+    table_1 = CollectionTable(['s1', 's2'], ['p1', 'p2'], ['a', 'b'], np.array([[1., np.nan], [3., 4.]]))
+    table_2 = CollectionTable(['s3', 's1'], ['p3', 'p1'], ['b', 'c'], np.array([[5., 6.], [2., np.nan]]))
+
+    merged = merge_tables([table_1, table_2])
+
+    assert merged.samples == ['s1', 's2', 's3'] and merged.patients == ['p1', 'p2', 'p3']
+    assert merged.feature_names == ['a', 'b', 'c']
+    np.testing.assert_array_equal(merged.matrix, [[1., 2., np.nan], [3., 4., np.nan], [np.nan, 5., 6.]])
+
+
+def test_table_pivot_grows_axes_independently():
+    pivot = common.database._TablePivot([f'feature-{j}' for j in range(200)])
+    for i in range(1000):
+        pivot.add([dict(sample=f'sample-{i}', patient=f'patient-{i}', name='feature-0', value=float(i))])
+        assert pivot.matrix.shape[0] <= 2 * len(pivot.rows) and pivot.matrix.shape[1] <= 2 * len(pivot.columns)
+
+    pivot.add([dict(sample='sample-0', patient='patient-0', name='feature-200', value=1.)])
+    assert pivot.matrix.shape == (1024, 400)
+    table = pivot.table()
+    assert table.matrix.shape == (1000, 201)
+    np.testing.assert_array_equal(table.matrix[:, 0], np.arange(1000))
+    assert table.matrix[0, 200] == 1.
+
+
+def test_patient_indexes(features_db):
+    assert get_patient_indexes('GeneExpression', db=features_db) == dict(patient=False, patient_name=False)
+    features_db['GeneExpression'].create_index('patient')
+    assert get_patient_indexes('GeneExpression', db=features_db) == dict(patient=True, patient_name=False)
+
+    create_recommended_indexes('GeneExpression', db=features_db)
+    assert get_patient_indexes('GeneExpression', db=features_db) == dict(patient=True, patient_name=True)
+
+
+def test_fetch_collection_as_matrix_chunks_patients(features_db):
+    patients = ['patient-3', 'patient-0', 'patient-2', 'patient-1', 'patient-9']
+    stats = PatientChunkStats()
+    expected = fetch_collection_as_matrix('GeneExpression', patients, db=features_db)
+
+    # without an index on patient the query is not split
+    fetch_collection_as_matrix('GeneExpression', patients, patient_chunk_size=2, stats=stats, db=features_db)
+    assert stats.chunks == []
+
+    create_recommended_indexes('GeneExpression', db=features_db)
+    table = fetch_collection_as_matrix('GeneExpression', patients, patient_chunk_size=2, stats=stats, db=features_db)
+
+    assert [(chunk.patients, chunk.rows) for chunk in stats.chunks] == [(2, 3), (2, 2), (1, 0)]
+    assert all(chunk.elapsed > 0 for chunk in stats.chunks)
+    # rows follow the order of the chunks, (patient-3, patient-0) then (patient-2, patient-1)
+    assert table.samples == ['sample-0', 'sample-3', 'sample-4', 'sample-1', 'sample-2']
+    order = [expected.samples.index(sample) for sample in table.samples]
+    columns = [expected.feature_names.index(name) for name in table.feature_names]
+    np.testing.assert_array_equal(table.matrix, expected.matrix[np.ix_(order, columns)])
+
+
+def test_fetch_collection_as_table_chunks_patients(features_db, monkeypatch):
+    # mongomock does not support $mergeObjects, the pivoted data is kept in a nested document instead
+    table_pipeline = common.database._table_pipeline
+    monkeypatch.setattr(common.database, '_table_pipeline', lambda patients: table_pipeline(patients)[:3])
+    create_recommended_indexes('GeneExpression', db=features_db)
+    stats = PatientChunkStats()
+
+    rows = list(fetch_collection_as_table('GeneExpression', [f'patient-{i}' for i in range(4)], patient_chunk_size=3,
+                                          max_workers=2, stats=stats, db=features_db))
+
+    assert [row['sample'] for row in rows] == [f'sample-{i}' for i in range(5)]
+    assert rows[4]['data'] == {'feature-0': 40., 'feature-1': 41., 'feature-2': 42., 'feature-3': 43.}
+    assert [(chunk.patients, chunk.rows) for chunk in stats.chunks] == [(3, 3), (1, 2)]
+
+    # splitting is opt-in, by default a cursor is returned without looking up the indexes
+    patients = [f'patient-{i}' for i in range(2000)]
+    monkeypatch.setattr(common.database, 'get_patient_indexes', None)
+    cursor = fetch_collection_as_table('GeneExpression', patients, db=features_db)
+    assert isinstance(cursor, mongomock.command_cursor.CommandCursor)
+    assert len(list(cursor)) == 5
+
+
+def test_fetch_chunks_bounds_chunks_in_flight():
+    started = []
+    results = common.database._fetch_chunks([[i] for i in range(20)], lambda chunk: started.append(chunk) or chunk,
+                                            max_workers=3, stats=None)
+
+    assert next(results) == [0]
+    # the chunks running ahead of the consumer are bounded by the number of workers
+    assert len(started) <= 4
+    assert list(results) == [[i] for i in range(1, 20)]
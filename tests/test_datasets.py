@@ -0,0 +1,105 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from common.datasets import LesionVolumeDataset, LesionPatchIterableDataset, LesionDataModule
+from common.les_files import write_les_file, read_all_maps_from_les_file, compose_label_volume
+from common.utils import read_dicom_images
+
+DICOM_DIR = os.path.join(os.path.dirname(__file__), '../resources/dcm_files')
+LES_PATH = os.path.join(os.path.dirname(__file__), '../resources/TCGA-AO-A0JI-1.les')
+
+
+@pytest.fixture(scope='module')
+def volume():
+    return read_dicom_images(DICOM_DIR, dtype=np.float32)
+
+
+@pytest.fixture
+def samples(tmp_path):
+    # the first lesion is at the top of the volume and the second one at its bottom corner
+    data = np.ones((2, 3, 4), dtype=np.uint8)
+    les_path = (tmp_path / 'two_lesions.les').as_posix()
+    write_les_file(les_path, [([(10, 12), (20, 23), (0, 1)], data), ([(252, 254), (251, 254), (32, 33)], data)])
+    return [(DICOM_DIR, LES_PATH), (DICOM_DIR, les_path)]
+
+
+def test_lesion_volume_dataset(samples, volume):
+    dataset = LesionVolumeDataset(samples)
+
+    assert len(dataset) == 2
+    item = dataset[0]
+    assert item['image'].shape == item['mask'].shape == (1, 34, 256, 256)
+    assert item['image'].is_contiguous()
+    np.testing.assert_array_equal(item['image'][0].numpy(), volume)
+    np.testing.assert_array_equal(item['mask'][0].numpy(),
+                                  compose_label_volume(LES_PATH, shape=volume.shape, multi_label=False))
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_lesion_volume_dataset_patches(samples, volume, tmp_path, cache):
+    dataset = LesionVolumeDataset(samples, patch_shape=(8, 32, 32), cache_dir=(tmp_path / 'cache').as_posix() if cache
+                                  else None)
+
+    assert dataset.index == [(0, 0), (1, 0), (1, 1)]
+    for item in (dataset[i] for i in range(len(dataset))):
+        assert item['image'].shape == item['mask'].shape == (1, 8, 32, 32)
+        assert item['mask'].sum() > 0
+
+    (ymin, ymax), (xmin, xmax), (zmin, zmax) = read_all_maps_from_les_file(LES_PATH)[0]['header']
+    z, y, x = (zmin + zmax) // 2 - 4, (ymin + ymax) // 2 - 16, (xmin + xmax) // 2 - 16
+    np.testing.assert_array_equal(dataset[0]['image'][0].numpy(), volume[z:z + 8, y:y + 32, x:x + 32])
+
+    # patches crossing the border are shifted inside of the volume
+    np.testing.assert_array_equal(dataset[2]['image'][0].numpy(), volume[-8:, -32:, -32:])
+    assert dataset[2]['mask'][0, -2:, -4:-1, -5:-1].all()
+    assert dataset[2]['mask'].sum() == 24
+
+
+def test_lesion_volume_dataset_is_picklable(samples):
+    dataset = LesionVolumeDataset(samples, patch_shape=(8, 32, 32))
+    dataset[0]
+    assert dataset._handles
+
+    assert pickle.loads(pickle.dumps(dataset))._handles == {}
+
+
+def test_lesion_patch_iterable_dataset(samples):
+    dataset = LesionPatchIterableDataset(samples, patch_shape=(8, 32, 32), shuffle=True, seed=1)
+
+    items = list(dataset)
+    assert sorted((item['case'], item['lesion']) for item in items) == [(0, 0), (1, 0), (1, 1)]
+    assert dataset._handles == {}
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=3, num_workers=2)
+    batches = list(loader)
+    assert sum(len(batch['case']) for batch in batches) == 3
+
+
+def test_lesion_data_module(samples):
+    data_module = LesionDataModule(train_samples=samples, val_samples=samples[:1], batch_size=2,
+                                   patch_shape=(8, 32, 32), normalize=True, window=(0, 500))
+    data_module.setup()
+
+    batch = next(iter(data_module.train_dataloader()))
+    assert batch['image'].shape == (2, 1, 8, 32, 32)
+    assert 0 <= batch['image'].min() <= batch['image'].max() <= 1
+    assert len(data_module.val_dataloader()) == 1
+    assert data_module.test_dataloader() is None
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_lesion_data_module_reshuffles_every_epoch(samples, num_workers):
+    data_module = LesionDataModule(train_samples=samples * 4, batch_size=1, num_workers=num_workers, iterable=True,
+                                   patch_shape=(8, 32, 32))
+    data_module.setup()
+    loader = data_module.train_dataloader()
+
+    orders = [[(int(batch['case']), int(batch['lesion'])) for batch in loader] for _ in range(2)]
+
+    assert orders[0] != orders[1]
+    assert sorted(orders[0]) == sorted(orders[1])
+    assert data_module.datasets['train'].epoch == 1
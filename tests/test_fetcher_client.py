@@ -1,4 +1,17 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import pytest
+
+import common.fetcher_client
 from common.fetcher_client import *
+from common.fetcher_client import _perform_request, _iter_json_array
+from tests.feature_server import FeatureServer, FeatureData
 
 
 def test_get_feature_names():
@@ -22,3 +35,331 @@ def test_get_patients_age():
     assert isinstance(get_patients_age(get_patients_by_mutation('BRCA1', mutation_status=True)), list)
     assert all(
         [isinstance(item, dict) for item in get_patients_age(get_patients_by_mutation('BRCA1', mutation_status=True))])
+
+
+@pytest.fixture
+def feature_server(monkeypatch):
+    with FeatureServer() as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        yield server
+    close_client()
+
+
+def _client_pid_in_child(_):
+    get_client()
+    return common.fetcher_client._client_pid == os.getpid()
+
+
+def test_client_reuses_connections(feature_server):
+    patients = get_patients_by_mutation('BRCA1', mutation_status=True)
+    for _ in range(10):
+        assert len(get_patients_age(patients)) == len(patients)
+        assert len(get_features_for_patients(col='GeneExpression', feature_name='GeneExpression-1',
+                                             patients=patients)) == len(patients)
+
+    assert feature_server.stats['requests'] == 21
+    assert feature_server.stats['connections'] == 1
+
+
+def test_client_is_fork_safe(feature_server):
+    get_feature_names('GeneExpression')
+    parent_client = get_client()
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert all(executor.map(_client_pid_in_child, range(4)))
+    assert get_client() is parent_client
+
+
+def test_configure_client(feature_server):
+    client = get_client()
+    configure_client(timeout=5., max_connections=2)
+
+    assert get_client() is not client
+    assert client.is_closed
+    assert get_client().timeout.read == 5.
+    assert get_feature_names('GeneExpression') == feature_server.data.features['GeneExpression']
+    configure_client()
+
+
+def test_async_api(feature_server):
+    async def run():
+        try:
+            patients = await async_get_patients_by_mutation('BRCA1', mutation_status=True)
+            return (patients, await async_get_patients_age(patients), await async_get_feature_names('GeneExpression'),
+                    await async_get_features_for_patients(col='GeneExpression', feature_name='GeneExpression-3',
+                                                          patients=patients))
+        finally:
+            await close_async_client()
+
+    patients, ages, names, features = asyncio.run(run())
+
+    assert patients == get_patients_by_mutation('BRCA1', mutation_status=True)
+    assert ages == get_patients_age(patients)
+    assert names == get_feature_names('GeneExpression')
+    assert features == get_features_for_patients(col='GeneExpression', feature_name='GeneExpression-3',
+                                                 patients=patients)
+
+
+def test_gather_features_for_patients(monkeypatch):
+    with FeatureServer(delay=0.02) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        pairs = [('GeneExpression', name) for name in server.data.features['GeneExpression']]
+
+        async def run():
+            try:
+                return await gather_features_for_patients(pairs, patients=['TCGA-0001', 'TCGA-0002'],
+                                                          max_concurrency=4)
+            finally:
+                await close_async_client()
+
+        results = asyncio.run(run())
+
+    assert [result[0]['name'] for result in results] == [name for _, name in pairs]
+    assert all(len(result) == 2 for result in results)
+    assert server.stats['max_inflight'] == 4
+
+
+def test_async_client_is_closed_with_its_loop(feature_server):
+    async def run():
+        names = await gather_features_for_patients([('GeneExpression', 'GeneExpression-1')], patients=['TCGA-0001'])
+        return names, get_async_client()
+
+    clients = [asyncio.run(run())[1] for _ in range(2)]
+
+    assert clients[0] is not clients[1]
+    assert all(client.is_closed for client in clients)
+    assert not common.fetcher_client._async_clients
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100])
+def test_get_features_for_patients_batch(feature_server, chunk_size):
+    names = feature_server.data.features['GeneExpression'][:20]
+    patients = get_patients_by_mutation('BRCA1', mutation_status=True)[::-1] + ['TCGA-UNKNOWN']
+
+    table = get_features_for_patients_batch('GeneExpression', names, patients=patients, chunk_size=chunk_size)
+
+    assert feature_server.stats['features_for_patients_batch'] == -(-len(names) // chunk_size)
+    assert table.patients == patients
+    assert list(table.columns) == names
+    for name in names:
+        expected = [item['value'] for item in get_features_for_patients('GeneExpression', name, patients)]
+        np.testing.assert_array_equal(table.columns[name][:-1], expected)
+        assert np.isnan(table.columns[name][-1])
+    assert table.to_matrix(names[::-1]).shape == (len(patients), len(names))
+    np.testing.assert_array_equal(table.to_matrix()[:, 3], table.columns[names[3]])
+
+
+def test_get_features_for_patients_batch_all_patients(feature_server):
+    table = get_features_for_patients_batch('GeneExpression', ['GeneExpression-1'])
+
+    assert table.patients == feature_server.data.patients
+    assert not np.isnan(table.columns['GeneExpression-1']).any()
+
+
+@pytest.fixture
+def response_cache(tmp_path):
+    yield enable_cache((tmp_path / 'responses.sqlite').as_posix(), ttls=dict(patients_age=60))
+    disable_cache()
+
+
+def test_response_cache(feature_server, response_cache):
+    patients = get_patients_by_mutation('BRCA1', mutation_status=True)
+    for _ in range(3):
+        assert get_patients_by_mutation('BRCA1', mutation_status=True) == patients
+        assert get_patients_age(patients) == feature_server.data.patients_age(patients)
+    get_patients_by_mutation('BRCA1', mutation_status=False)
+
+    assert feature_server.stats['patients_by_mutation'] == 2
+    assert feature_server.stats['patients_age'] == 1
+    assert (response_cache.hits, response_cache.misses) == (5, 3)
+
+    # a new cache over the same database is served from disk
+    cache = enable_cache(response_cache.path)
+    assert get_patients_age(patients) == feature_server.data.patients_age(patients)
+    assert feature_server.stats['patients_age'] == 1
+    assert cache.hits == 1
+
+    invalidate_cache('patients_age')
+    get_patients_age(patients)
+    get_patients_by_mutation('BRCA1', mutation_status=True)
+    assert feature_server.stats['patients_age'] == 2
+    assert feature_server.stats['patients_by_mutation'] == 2
+
+
+def test_response_cache_ttl(feature_server, response_cache, monkeypatch):
+    now = time.time()
+    get_patients_age(['TCGA-0001'])
+    get_feature_names('GeneExpression')
+
+    monkeypatch.setattr(common.fetcher_client.time, 'time', lambda: now + 120)
+    get_patients_age(['TCGA-0001'])
+    get_feature_names('GeneExpression')
+
+    assert feature_server.stats['patients_age'] == 2
+    assert feature_server.stats['feature_names'] == 1
+
+
+def test_response_cache_size_limits(tmp_path):
+    cache = ResponseCache((tmp_path / 'responses.sqlite').as_posix(), max_entries=2, max_disk_bytes=100)
+    for i in range(5):
+        cache.set('feature_names', f'key-{i}', ['x' * 20])
+
+    assert list(cache._memory) == ['key-3', 'key-4']
+    keys = [row[0] for row in cache._connection().execute('SELECT key FROM responses ORDER BY key')]
+    assert keys == ['key-1', 'key-2', 'key-3', 'key-4']
+    assert cache.get('feature_names', 'key-1') == (True, ['x' * 20])
+    assert cache.get('feature_names', 'key-0') == (False, None)
+    cache.close()
+
+
+@pytest.fixture
+def fast_retries():
+    configure_retries(max_retries=3, backoff=0.001)
+    reset_request_stats()
+    yield
+    configure_retries()
+
+
+def test_retries(feature_server, fast_retries):
+    feature_server.failures = 3
+    assert get_feature_names('GeneExpression') == feature_server.data.features['GeneExpression']
+    assert get_request_stats() == dict(requests=4, retries=3, coalesced=0)
+
+    feature_server.failures = 4
+    with pytest.raises(httpx.HTTPStatusError):
+        get_feature_names('GeneExpression')
+    assert get_request_stats()['retries'] == 6
+
+
+def test_retries_do_not_apply_to_client_errors(feature_server, fast_retries):
+    with pytest.raises(httpx.HTTPStatusError):
+        _perform_request('get', url=f'{feature_server.addr}/missing_endpoint')
+    assert get_request_stats()['requests'] == 1
+
+
+def test_async_retries(feature_server, fast_retries):
+    feature_server.failures = 2
+
+    async def run():
+        try:
+            return await async_get_feature_names('GeneExpression')
+        finally:
+            await close_async_client()
+
+    assert asyncio.run(run()) == feature_server.data.features['GeneExpression']
+    assert get_request_stats()['retries'] == 2
+
+
+def test_request_coalescing(monkeypatch, fast_retries):
+    with FeatureServer(delay=0.2) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        patients = server.data.patients[:10]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: get_patients_age(patients), range(8)))
+
+        assert all(result == results[0] for result in results)
+        assert server.stats['patients_age'] == 1
+        assert get_request_stats()['coalesced'] == 7
+        # every caller gets its own response, which it may modify
+        assert len({id(result[0]) for result in results}) == 8
+        results[0][0]['age'] = -1
+        assert all(result[0]['age'] >= 0 for result in results[1:])
+        close_client()
+
+
+def test_async_request_coalescing(monkeypatch, fast_retries):
+    with FeatureServer(delay=0.1) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+
+        async def run():
+            try:
+                return await asyncio.gather(*(async_get_patients_by_mutation('TP53', True) for _ in range(5)),
+                                            async_get_patients_by_mutation('TP53', False))
+            finally:
+                await close_async_client()
+
+        results = asyncio.run(run())
+
+    assert all(result == results[0] for result in results[:5])
+    assert server.stats['patients_by_mutation'] == 2
+    assert get_request_stats()['coalesced'] == 4
+    assert len({id(result) for result in results}) == 6
+
+
+def test_request_coalescing_copies_responses(feature_server, fast_retries):
+    async def modify():
+        patients = await async_get_patients_by_mutation('TP53', True)
+        patients.append('TCGA-MODIFIED')
+        return patients
+
+    async def run():
+        return await asyncio.gather(modify(), async_get_patients_by_mutation('TP53', True))
+
+    modified, patients = asyncio.run(run())
+
+    # the first caller resumes first and modifies its response before the waiter gets its copy
+    assert modified[:-1] == patients
+    assert get_request_stats()['coalesced'] == 1
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1000])
+def test_iter_json_array(chunk_size):
+    data = [dict(patient='TCGA-0001', value=1.5e-10, tags=[1, 2]), 12345, 'x, ]y', None, True, -0.25]
+    text = ' ' + json.dumps(data)
+
+    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    assert list(_iter_json_array(chunks)) == data
+    assert list(_iter_json_array(['[', ' ]'])) == []
+
+    with pytest.raises(ValueError):
+        list(_iter_json_array(chunks[:-1]))
+    with pytest.raises(ValueError):
+        list(_iter_json_array(['{"a": 1}']))
+
+
+def test_iter_features_for_patients(feature_server):
+    patients = feature_server.data.patients[:50]
+
+    records = iter_features_for_patients('GeneExpression', 'GeneExpression-2', patients)
+
+    assert not isinstance(records, list)
+    assert list(records) == get_features_for_patients('GeneExpression', 'GeneExpression-2', patients)
+
+
+def test_get_feature_values(monkeypatch):
+    with FeatureServer(FeatureData(n_patients=3000)) as server:
+        monkeypatch.setattr(common.fetcher_client, 'ADDR', server.addr)
+        expected = [item['value'] for item in get_features_for_patients('GeneExpression', 'GeneExpression-2')]
+
+        np.testing.assert_array_equal(get_feature_values('GeneExpression', 'GeneExpression-2'), expected)
+        out = np.empty(3000)
+        assert np.shares_memory(get_feature_values('GeneExpression', 'GeneExpression-2', out=out), out)
+        np.testing.assert_array_equal(out, expected)
+
+        patients = ['TCGA-UNKNOWN'] + server.data.patients[10::-1]
+        values = get_feature_values('GeneExpression', 'GeneExpression-2', patients=patients)
+        assert np.isnan(values[0])
+        np.testing.assert_array_equal(values[1:], expected[10::-1])
+        close_client()
+
+
+def test_iter_features_for_patients_disconnects(feature_server, fast_retries):
+    patients = feature_server.data.patients[:50]
+    expected = get_features_for_patients('GeneExpression', 'GeneExpression-2', patients)
+
+    # a failure before the first item is retried
+    feature_server.failures = 1
+    assert list(iter_features_for_patients('GeneExpression', 'GeneExpression-2', patients)) == expected
+
+    # a failure in the middle of the body is raised rather than yielding the first items again
+    feature_server.disconnects = 1
+    records = []
+    with pytest.raises(httpx.TransportError):
+        for record in iter_features_for_patients('GeneExpression', 'GeneExpression-2', patients):
+            records.append(record)
+    assert 0 < len(records) < len(expected)
+    assert records == expected[:len(records)]
+    feature_server.disconnects = 1
+    with pytest.raises(httpx.TransportError):
+        get_feature_values('GeneExpression', 'GeneExpression-2')
@@ -1,4 +1,5 @@
 import pickle
+from glob import glob
 
 from common.les_files import *
 from loguru import logger
@@ -50,3 +51,258 @@ def test_read_all_maps_from_les_file():
 
     assert gt[0]['header'] == maps[0]['header']
     np.testing.assert_array_almost_equal(gt[0]['data'], maps[0]['data'])
+
+
+def test_decode_les_file_header(arr):
+    assert decode_les_file_header(arr) == read_les_file_header(arr)
+
+
+@pytest.mark.parametrize('header', [[(5, 3), (0, 1), (0, 1)], [(0, 1), (2, 2), (0, 1)], [(0, 1), (0, 1), (4, 3)]])
+def test_decode_les_file_header_raises_for_malformed_header(header):
+    raw = np.array([item[0] for item in header] + [item[1] for item in header], dtype='<u2').tobytes()
+
+    with pytest.raises(AssertionError):
+        decode_les_file_header(raw)
+    with pytest.raises(AssertionError):
+        encode_les_file([(header, np.zeros((2, 2, 2), dtype=np.uint8))])
+
+
+def test_decode_les_file_header_single_slice():
+    header = [(0, 1), (3, 5), (7, 7)]
+    data = np.arange(6, dtype=np.uint8).reshape(1, 2, 3) % 2
+    raw = encode_les_file([(header, data)])
+
+    assert decode_les_file_header(raw) == header
+    np.testing.assert_array_equal(decode_all_maps_from_les_file(raw)[0]['data'], data)
+
+
+def test_decode_les_file_data(arr):
+    header = decode_les_file_header(arr)
+
+    data = decode_les_file_data(arr, header, offset=12)
+
+    with open(os.path.join(os.path.dirname(__file__), '../resources/les_file_image.pkl'), 'rb') as f:
+        gt = pkl.load(f)
+
+    assert data.dtype == np.uint8
+    assert np.shares_memory(data, np.frombuffer(arr, dtype=np.uint8))
+    np.testing.assert_array_equal(gt, data)
+
+
+def test_decode_les_file_data_raises_for_offset_too_small(arr):
+    header = decode_les_file_header(arr)
+
+    with pytest.raises(AssertionError):
+        decode_les_file_data(arr, header, offset=0)
+
+
+@pytest.mark.parametrize('name', ['TCGA-AO-A0JI-1.les', 'TCGA-E2-A1IJ-1.les'])
+def test_decode_all_maps_from_les_file(name):
+    path = os.path.join(os.path.dirname(__file__), '../resources', name)
+
+    # concatenating the file with itself gives a multi map file
+    with open(path, 'rb') as f:
+        raw = f.read() * 3
+
+    expected = read_all_maps_from_les_file(raw)
+    maps = decode_all_maps_from_les_file(raw)
+
+    assert len(maps) == len(expected) == 3
+    for item, gt in zip(maps, expected):
+        assert item['header'] == gt['header']
+        np.testing.assert_array_equal(gt['data'], item['data'])
+
+
+def test_les_file():
+    path = os.path.join(os.path.dirname(__file__), '../resources/TCGA-E2-A1IJ-1.les')
+
+    expected = read_all_maps_from_les_file(path)
+    with LesFile(path) as les_file:
+        assert len(les_file) == len(expected)
+        assert les_file.headers == [item['header'] for item in expected]
+        assert les_file.bounding_boxes.shape == (len(expected), 3, 2)
+        for item, gt in zip(les_file, expected):
+            assert item['header'] == gt['header']
+            np.testing.assert_array_equal(gt['data'], item['data'])
+        np.testing.assert_array_equal(expected[-1]['data'], les_file[-1]['data'])
+
+
+def test_les_file_multiple_maps(tmp_path):
+    path = os.path.join(os.path.dirname(__file__), '../resources/TCGA-AO-A0JI-1.les')
+    with open(path, 'rb') as f:
+        raw = f.read()
+    (tmp_path / 'multi.les').write_bytes(raw * 4)
+    (tmp_path / 'empty.les').write_bytes(b'')
+
+    les_file = LesFile(tmp_path / 'multi.les')
+    assert len(les_file) == 4
+    assert [segment.offset for segment in les_file.index] == [12 + i * len(raw) for i in range(4)]
+    np.testing.assert_array_equal(les_file[3]['data'], read_les_file_data(raw, read_les_file_header(raw)))
+
+    assert len(LesFile(tmp_path / 'empty.les')) == 0
+
+
+def test_les_file_raises_for_truncated_file(tmp_path, arr):
+    (tmp_path / 'truncated.les').write_bytes(arr[:-1])
+
+    with pytest.raises(AssertionError):
+        LesFile(tmp_path / 'truncated.les')
+
+
+def test_load_les_files(tmp_path):
+    resources = os.path.join(os.path.dirname(__file__), '../resources')
+    cache_dir = (tmp_path / 'cache').as_posix()
+
+    for expected_hit_rate in (0., 1.):
+        stats = LesBatchStats()
+        results = dict(load_les_files(resources, cache_dir=cache_dir, max_workers=2, stats=stats))
+
+        assert sorted(results) == sorted(glob(os.path.join(resources, '*.les')))
+        assert stats.files == 2
+        assert stats.cache_hit_rate == expected_hit_rate
+        assert stats.files_per_second > 0
+        for path, maps in results.items():
+            expected = read_all_maps_from_les_file(path)
+            assert [item['header'] for item in maps] == [item['header'] for item in expected]
+            for item, gt in zip(maps, expected):
+                np.testing.assert_array_equal(gt['data'], item['data'])
+
+
+def test_load_les_files_glob_without_cache():
+    pattern = os.path.join(os.path.dirname(__file__), '../resources/TCGA-AO-*.les')
+
+    results = list(load_les_files(pattern, max_workers=1))
+
+    assert len(results) == 1
+    assert results[0][1][0]['header'] == [(99, 114), (115, 128), (19, 22)]
+
+
+@pytest.mark.parametrize('name', ['TCGA-AO-A0JI-1.les', 'TCGA-E2-A1IJ-1.les'])
+def test_sparse_lesion_mask(name):
+    path = os.path.join(os.path.dirname(__file__), '../resources', name)
+
+    dense = read_all_maps_from_les_file(path)[0]
+    mask = read_all_maps_from_les_file(path, sparse=True)[0]['data']
+
+    assert isinstance(mask, SparseLesionMask)
+    assert mask == decode_all_maps_from_les_file(path, sparse=True)[0]['data']
+    assert mask.voxel_count == np.count_nonzero(dense['data'])
+    np.testing.assert_array_equal(mask.to_dense(dense['header']), dense['data'] != 0)
+
+    z, y, x = np.nonzero(dense['data'])
+    (ymin, _), (xmin, _), (zmin, _) = dense['header']
+    assert mask.bounding_box == [(ymin + y.min(), ymin + y.max()), (xmin + x.min(), xmin + x.max()),
+                                 (zmin + z.min(), zmin + z.max())]
+    np.testing.assert_allclose(mask.centroid, (ymin + y.mean(), xmin + x.mean(), zmin + z.mean()))
+
+
+def test_sparse_lesion_mask_set_operations():
+    header = [(10, 13), (20, 22), (5, 6)]
+    data_1 = np.zeros((2, 4, 3), dtype=np.uint8)
+    data_1[0, :2] = 1
+    data_2 = np.zeros((2, 4, 3), dtype=np.uint8)
+    data_2[0, 1:, 1:] = 1
+    data_2[1, 3, 2] = 1
+    mask_1 = SparseLesionMask.from_dense(data_1, header)
+    mask_2 = SparseLesionMask.from_dense(data_2, header)
+
+    np.testing.assert_array_equal((mask_1 | mask_2).to_dense(header), data_1 | data_2)
+    np.testing.assert_array_equal((mask_1 & mask_2).to_dense(header), data_1 & data_2)
+    assert (mask_1 & mask_2).voxel_count == 2
+
+    # masks with disjoint cuboids
+    shifted = SparseLesionMask.from_dense(data_1, [(100, 103), (20, 22), (5, 6)])
+    assert (mask_1 & shifted).voxel_count == 0
+    assert (mask_1 & shifted).bounding_box is None
+    assert (mask_1 | shifted).voxel_count == 2 * mask_1.voxel_count
+
+
+@pytest.mark.parametrize('name', ['TCGA-AO-A0JI-1.les', 'TCGA-E2-A1IJ-1.les'])
+def test_encode_les_file_round_trip(name):
+    path = os.path.join(os.path.dirname(__file__), '../resources', name)
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    assert encode_les_file(read_all_maps_from_les_file(raw)) == raw
+    assert encode_les_file(decode_all_maps_from_les_file(raw)) == raw
+    maps = read_all_maps_from_les_file(raw, sparse=True)
+    assert encode_les_file((item['header'], item['data']) for item in maps) == raw
+
+
+def test_write_les_file(tmp_path):
+    header_1 = [(10, 13), (20, 22), (5, 6)]
+    data_1 = np.random.RandomState(0).randint(0, 2, (2, 4, 3))
+    header_2 = [(0, 1), (0, 1), (0, 2)]
+    data_2 = np.ones((3, 2, 2), dtype=np.uint8)
+
+    path = tmp_path / 'written.les'
+    assert write_les_file(path, [(header_1, data_1), {'header': header_2, 'data': data_2}]) == 12 + 24 + 12 + 12
+
+    maps = LesFile(path)
+    assert maps.headers == [header_1, header_2]
+    np.testing.assert_array_equal(maps[0]['data'], data_1)
+    np.testing.assert_array_equal(maps[1]['data'], data_2)
+
+
+def test_write_les_file_raises_for_mismatching_shape():
+    with pytest.raises(AssertionError):
+        encode_les_file([([(10, 13), (20, 22), (5, 6)], np.zeros((2, 3, 4)))])
+
+
+@pytest.fixture
+def overlapping_maps():
+    data_1 = np.ones((2, 4, 3), dtype=np.uint8)
+    data_2 = np.zeros((3, 2, 2), dtype=np.uint8)
+    data_2[:, 0] = 1
+    # second lesion overlaps the first one and crosses the volume border along x
+    return [{'header': [(1, 4), (2, 4), (0, 1)], 'data': data_1},
+            {'header': [(4, 5), (4, 5), (1, 3)], 'data': data_2}]
+
+
+def test_compose_label_volume(overlapping_maps):
+    shape = (3, 8, 5)
+    expected = np.zeros(shape, dtype=np.uint8)
+    expected[0:2, 1:5, 2:5] = 1
+    expected[1:3, 4, 4] = 2
+
+    volume = compose_label_volume(overlapping_maps, shape=shape)
+    np.testing.assert_array_equal(volume, expected)
+
+    union = compose_label_volume(overlapping_maps, shape=shape, multi_label=False)
+    assert union.dtype == bool
+    np.testing.assert_array_equal(union, expected != 0)
+
+    out = np.zeros(shape, dtype=np.int16)
+    assert compose_label_volume(overlapping_maps, shape=shape, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_compose_label_volume_from_file():
+    path = os.path.join(os.path.dirname(__file__), '../resources/TCGA-AO-A0JI-1.les')
+    item = read_all_maps_from_les_file(path)[0]
+    (ymin, ymax), (xmin, xmax), (zmin, zmax) = item['header']
+
+    expected = np.zeros((34, 256, 256), dtype=np.uint8)
+    expected[zmin:zmax + 1, ymin:ymax + 1, xmin:xmax + 1] = item['data']
+
+    np.testing.assert_array_equal(compose_label_volume(path, shape=expected.shape), expected)
+    np.testing.assert_array_equal(
+        compose_label_volume(read_all_maps_from_les_file(path, sparse=True), shape=expected.shape), expected)
+
+
+def test_crop_lesion_patches(overlapping_maps):
+    volume = np.arange(3 * 8 * 5).reshape(3, 8, 5)
+
+    patches = crop_lesion_patches(overlapping_maps, volume, margin=1)
+
+    assert len(patches) == 2
+    for patch in patches:
+        assert np.shares_memory(patch['image'], volume)
+        np.testing.assert_array_equal(patch['image'], volume[patch['slices']])
+        assert patch['mask'].shape == patch['image'].shape
+    assert patches[0]['slices'] == (slice(0, 3), slice(0, 6), slice(1, 5))
+    np.testing.assert_array_equal(patches[0]['mask'][:2, 1:5, 1:4], 1)
+    assert patches[0]['mask'].sum() == 24
+    assert patches[1]['slices'] == (slice(0, 3), slice(3, 7), slice(3, 5))
+    np.testing.assert_array_equal(patches[1]['mask'][1:3, 1, 1], 1)
+    assert patches[1]['mask'].sum() == 2
@@ -1,12 +1,228 @@
 # Created by ohad at 7/27/21
+import gc
 import os
+import shutil
+import threading
+import time
 
 import numpy as np
-from common.utils import read_dicom_images
+import pytest
+import SimpleITK as sitk
+
+import common.utils
+from common.utils import read_dicom_images, scan_dicom_series, read_dicom_series_slices, load_dicom_series, \
+    DicomVolumeCache, convert_intensities
 from loguru import logger
 
+DICOM_DIR = os.path.join(os.path.dirname(__file__), "../resources/dcm_files")
+
 
 def test_read_dicom_images():
-    dcm_images = read_dicom_images(os.path.join(os.path.dirname(__file__), "../resources/dcm_files"))
+    dcm_images = read_dicom_images(DICOM_DIR)
     assert isinstance(dcm_images, np.ndarray)
     assert dcm_images.shape == (34, 256, 256)
+
+
+def test_read_dicom_images_conversions():
+    reference = read_dicom_images(DICOM_DIR)
+
+    as_float = read_dicom_images(DICOM_DIR, dtype=np.float32)
+    assert as_float.dtype == np.float32
+    np.testing.assert_array_equal(as_float, reference)
+
+    windowed = read_dicom_images(DICOM_DIR, dtype=np.int16, window=(100, 300))
+    assert windowed.dtype == np.int16
+    np.testing.assert_array_equal(windowed, np.clip(reference, 100, 300))
+
+    normalized = read_dicom_images(DICOM_DIR, dtype=np.float16, window=(100, 300), normalize=True)
+    assert normalized.dtype == np.float16
+    np.testing.assert_allclose(normalized, (np.clip(reference, 100, 300) - 100) / 200, atol=1e-3)
+
+    with pytest.raises(AssertionError):
+        read_dicom_images(DICOM_DIR, dtype=np.int16, normalize=True)
+
+
+def test_convert_intensities_dtypes():
+    view = np.array([-300, -1, 0, 100, 300, 32767], dtype=np.int16)
+
+    as_float = convert_intensities(view, dtype=np.dtype('float32'))
+    assert as_float.dtype == np.float32
+    np.testing.assert_array_equal(as_float, view)
+
+    # narrowing integer casts saturate rather than wrap around
+    np.testing.assert_array_equal(convert_intensities(view, dtype=np.uint8), [0, 0, 0, 100, 255, 255])
+    np.testing.assert_array_equal(convert_intensities(view, dtype=np.int8), [-128, -1, 0, 100, 127, 127])
+    np.testing.assert_array_equal(convert_intensities(view, dtype=np.uint8, window=(-10, 200)),
+                                  [0, 0, 0, 100, 200, 200])
+    np.testing.assert_array_equal(convert_intensities(view.astype(np.float64) * 1000, dtype=np.int16),
+                                  [-32768, -1000, 0, 32767, 32767, 32767])
+    np.testing.assert_array_equal(convert_intensities(view, dtype=np.int32), view)
+
+    reference = read_dicom_images(DICOM_DIR)
+    assert read_dicom_images(DICOM_DIR, dtype=np.dtype('float32'), copy=False).dtype == np.float32
+    np.testing.assert_array_equal(read_dicom_images(DICOM_DIR, dtype=np.dtype('uint8')), np.clip(reference, 0, 255))
+
+
+def test_read_dicom_images_view():
+    view = read_dicom_images(DICOM_DIR, copy=False)
+
+    assert isinstance(view, np.ndarray)
+    assert view.dtype == read_dicom_images(DICOM_DIR).dtype
+    # the view must remain valid after the SimpleITK image went out of scope
+    gc.collect()
+    np.testing.assert_array_equal(view[5:10], read_dicom_images(DICOM_DIR)[5:10])
+
+
+def test_scan_dicom_series():
+    series = scan_dicom_series(os.path.join(DICOM_DIR, '..'))
+
+    assert len(series) == 1
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(DICOM_DIR))
+    image = reader.Execute()
+
+    assert series[0]['slice_count'] == 34
+    assert series[0]['size'] == list(image.GetSize())
+    np.testing.assert_allclose(series[0]['spacing'], image.GetSpacing(), rtol=1e-5)
+    np.testing.assert_allclose(series[0]['origin'], image.GetOrigin(), rtol=1e-5)
+    np.testing.assert_allclose(series[0]['direction'], image.GetDirection())
+    assert series[0]['modality'] == 'MR'
+
+
+def test_scan_dicom_series_index(tmp_path, monkeypatch):
+    index_path = (tmp_path / 'index.json').as_posix()
+
+    series = scan_dicom_series(DICOM_DIR, index_path=index_path)
+    assert os.path.exists(index_path)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('unchanged directories must be served from the index')
+
+    monkeypatch.setattr(common.utils, '_read_dicom_series_info', fail)
+    assert scan_dicom_series(DICOM_DIR, index_path=index_path) == series
+    monkeypatch.undo()
+
+    # rewriting a file in place leaves the modification time of the directory unchanged, but not the index entry
+    dicom_dir = (tmp_path / 'dcm_files').as_posix()
+    shutil.copytree(DICOM_DIR, dicom_dir)
+    scan_dicom_series(dicom_dir, index_path=index_path)
+    directory_mtime = os.stat(dicom_dir).st_mtime_ns
+    first_file = os.path.join(dicom_dir, sorted(os.listdir(dicom_dir))[0])
+    os.utime(first_file, ns=(0, os.stat(first_file).st_mtime_ns + 10 ** 9))
+    assert os.stat(dicom_dir).st_mtime_ns == directory_mtime
+    calls = []
+    read_info = common.utils._read_dicom_series_info
+    monkeypatch.setattr(common.utils, '_read_dicom_series_info', lambda *args: calls.append(args) or read_info(*args))
+    assert scan_dicom_series(dicom_dir, index_path=index_path)[0]['slice_count'] == 34
+    assert len(calls) == 1
+
+
+def test_read_dicom_series_slices():
+    series = scan_dicom_series(DICOM_DIR)[0]
+
+    np.testing.assert_array_equal(read_dicom_series_slices(series, 10, 14), read_dicom_images(DICOM_DIR)[10:14])
+
+    with pytest.raises(AssertionError):
+        read_dicom_series_slices(series, 40)
+
+
+def test_load_dicom_series():
+    series = scan_dicom_series(DICOM_DIR)[0]
+    expected = read_dicom_images(DICOM_DIR)
+
+    results = list(load_dicom_series([DICOM_DIR, series, series], max_workers=2))
+
+    assert len(results) == 3
+    assert sorted(isinstance(result.source, dict) for result in results) == [False, True, True]
+    for result in results:
+        np.testing.assert_array_equal(result.image, expected)
+        assert result.nbytes == expected.nbytes
+        assert result.elapsed > 0
+
+
+def test_load_dicom_series_without_series(tmp_path):
+    (tmp_path / 'notes.txt').write_text('not a dicom file')
+
+    with pytest.raises(AssertionError, match=str(tmp_path)):
+        list(load_dicom_series([str(tmp_path)]))
+
+
+def test_load_dicom_series_respects_memory_budget(monkeypatch):
+    series = scan_dicom_series(DICOM_DIR)[0]
+    decode = common.utils._decode_dicom_series
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def tracked_decode(file_names):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        try:
+            return decode(file_names)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(common.utils, '_decode_dicom_series', tracked_decode)
+    nbytes = 34 * 256 * 256 * 2
+
+    assert len(list(load_dicom_series([series] * 4, max_workers=4, max_inflight_bytes=2 * nbytes))) == 4
+    assert running[1] == 2
+
+    # a series larger than the budget is loaded on its own
+    running[1] = 0
+    assert len(list(load_dicom_series([series] * 2, max_workers=4, max_inflight_bytes=nbytes // 2))) == 2
+    assert running[1] == 1
+
+
+@pytest.fixture
+def dicom_dirs(tmp_path):
+    dirs = [(tmp_path / name).as_posix() for name in ('first', 'second')]
+    for dicom_dir in dirs:
+        shutil.copytree(DICOM_DIR, dicom_dir)
+    return dirs
+
+
+def test_dicom_volume_cache(tmp_path, dicom_dirs, monkeypatch):
+    cache = DicomVolumeCache((tmp_path / 'cache').as_posix())
+    expected = read_dicom_images(DICOM_DIR)
+
+    volume, meta = cache.get(dicom_dirs[0])
+    assert isinstance(volume, np.memmap)
+    np.testing.assert_array_equal(volume, expected)
+    assert meta['spacing'] == [0.703125, 0.703125, 3.0]
+    assert cache.nbytes > expected.nbytes
+
+    def fail(*args, **kwargs):
+        raise AssertionError('cached series must not be decoded again')
+
+    monkeypatch.setattr(DicomVolumeCache, '_store', fail)
+    np.testing.assert_array_equal(cache.get(dicom_dirs[0])[0], expected)
+    monkeypatch.undo()
+
+    # modifying a file of the series invalidates the cached entry
+    first_file = os.path.join(dicom_dirs[0], '000000.dcm')
+    os.utime(first_file, ns=(0, os.stat(first_file).st_mtime_ns + 10 ** 9))
+    calls = []
+    store = DicomVolumeCache._store
+    monkeypatch.setattr(DicomVolumeCache, '_store', lambda self, *args: calls.append(args) or store(self, *args))
+    cache.get(dicom_dirs[0])
+    assert len(calls) == 1
+
+    cache.invalidate(dicom_dirs[0])
+    assert cache.nbytes == 0
+
+
+def test_dicom_volume_cache_eviction(tmp_path, dicom_dirs):
+    cache = DicomVolumeCache((tmp_path / 'cache').as_posix(), max_bytes=int(1.5 * 34 * 256 * 256 * 2))
+
+    cache.get(dicom_dirs[0])
+    cache.get(dicom_dirs[1])
+
+    entries = cache._entries()
+    assert len(entries) == 1
+    assert entries[0][1] == cache._paths(dicom_dirs[1])[0]
+
+    cache.clear()
+    assert cache._entries() == []